@@ -0,0 +1,128 @@
+from functools import lru_cache
+from typing import Any, Callable
+
+from fhirpathpy import compile
+
+
+@lru_cache(maxsize=None)
+def compile_path(path: str) -> Callable[[Any], list]:
+    """Compiles a FHIRPath expression once per distinct expression."""
+    return compile(path)
+
+
+class CompiledFeature:
+    """The expressions of a feature as ids in the expression table of an
+    extraction plan."""
+
+    def __init__(
+        self,
+        target_ids: dict[str, list[int]],
+        conditional_ids: dict[str, list[tuple[int, int]]],
+    ):
+        self.target_ids = target_ids
+        self.conditional_ids = conditional_ids
+
+
+class ExtractionPlan:
+    """The features of one resource type compiled against a shared table of
+    distinct FHIRPath expressions. Target paths and conditions that several
+    features use are evaluated once per resource, results are kept in a
+    values dict per resource that the caller passes in. Expressions are
+    evaluated lazily, so conditions after the first match and target paths
+    after the first value are not evaluated."""
+
+    def __init__(self, resource_type: str):
+        self.resource_type = resource_type
+        self._expressions: list[Callable[[Any], list]] = []
+        self._expression_ids: dict[str, int] = {}
+        self._features: dict[str, CompiledFeature] = {}
+
+    @property
+    def feature_names(self) -> list[str]:
+        return list(self._features)
+
+    @property
+    def n_expressions(self) -> int:
+        return len(self._expressions)
+
+    def _get_expression_id(self, path: str) -> int:
+        if path not in self._expression_ids:
+            self._expression_ids[path] = len(self._expressions)
+            self._expressions.append(compile_path(path))
+        return self._expression_ids[path]
+
+    def add_feature(
+        self,
+        feature_name: str,
+        target_paths: dict[str, list[str]],
+        conditional_target_paths: dict[str, list[dict[str, str]]] = None,
+    ):
+        target_ids = {
+            targ_n: [self._get_expression_id(path) for path in targ_paths]
+            for targ_n, targ_paths in target_paths.items()
+        }
+        conditional_ids = (
+            {
+                targ_n: [
+                    (self._get_expression_id(cond), self._get_expression_id(targ))
+                    for cond, targ in cond_paths.items()
+                ]
+                for targ_n, cond_paths in conditional_target_paths.items()
+            }
+            if conditional_target_paths
+            else {}
+        )
+        self._features[feature_name] = CompiledFeature(target_ids, conditional_ids)
+
+    def evaluate(self, expression_id: int, resource: Any, values: dict) -> list:
+        if expression_id not in values:
+            values[expression_id] = self._expressions[expression_id](resource)
+        return values[expression_id]
+
+    def get_target(
+        self, feature_name: str, resource: Any, values: dict = None
+    ) -> dict[str, Any]:
+        """Returns the target of a feature for a resource. The value of a
+        conditional path whose condition holds comes first, otherwise the
+        first non-empty value of the target paths."""
+        values = values if values is not None else {}
+        feature = self._features[feature_name]
+        target = {}
+        for targ_n, pairs in feature.conditional_ids.items():
+            temp_target = None
+            for cond_id, targ_id in pairs:
+                if self.evaluate(cond_id, resource, values):
+                    temp_target = self.evaluate(targ_id, resource, values)[0]
+                    break
+            if temp_target:
+                target[targ_n] = temp_target
+        if not target:
+            for targ_n, targ_ids in feature.target_ids.items():
+                temp_target = None
+                for targ_id in targ_ids:
+                    result = self.evaluate(targ_id, resource, values)
+                    if not len(result) > 0:
+                        continue
+                    if result[0]:
+                        temp_target = result[0]
+                        break
+                target[targ_n] = temp_target if temp_target else None
+        return target
+
+
+def build_extraction_plans(
+    feature_specs: dict[str, dict],
+) -> dict[str, ExtractionPlan]:
+    """Compiles feature specs, as kept by FeatureSelector, into an extraction
+    plan per resource type."""
+    plans = {}
+    for feature_name, spec in feature_specs.items():
+        for resource_type in spec["resource_types"]:
+            if resource_type not in plans:
+                plans[resource_type] = ExtractionPlan(resource_type)
+            plans[resource_type].add_feature(
+                feature_name,
+                spec["target_paths"],
+                spec["conditional_target_paths"],
+            )
+    return plans
@@ -0,0 +1,118 @@
+from typing import Any, Union
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+LONG_COLUMNS = ["patient_id", "feature", "code", "system", "value", "numeric_value"]
+CATEGORICAL_COLUMNS = ["patient_id", "feature", "code", "system", "value"]
+
+
+def _to_float(value: Any) -> float:
+    if isinstance(value, bool):
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _to_categorical(values: list[Union[str, None]]) -> pd.Categorical:
+    categories = pd.Index(
+        pd.unique(np.asarray([v for v in values if v is not None], dtype=object)),
+        dtype=object,
+    )
+    return pd.Categorical(values, categories=categories)
+
+
+def get_long_feature_df(
+    patient_features: dict[str, dict[str, list]], feature_names: list[str] = None
+) -> pd.DataFrame:
+    """Returns one row per extracted feature value with the columns patient_id,
+    feature, code, system, value and numeric_value. All but numeric_value are
+    categorical, numeric_value holds the value as float where it is numeric."""
+    columns = {column: [] for column in LONG_COLUMNS}
+    for patient_id, features_dic in patient_features.items():
+        for feature_name, features in features_dic.items():
+            if feature_names is not None and feature_name not in feature_names:
+                continue
+            for feature in features:
+                if isinstance(feature, dict):
+                    code = feature.get("code", None)
+                    system = feature.get("system", None)
+                    value = feature.get("value", None)
+                else:
+                    code = None
+                    system = None
+                    value = feature
+                columns["patient_id"].append(patient_id)
+                columns["feature"].append(feature_name)
+                columns["code"].append(None if code is None else str(code))
+                columns["system"].append(system)
+                columns["value"].append(None if value is None else str(value))
+                columns["numeric_value"].append(_to_float(value))
+    long_df = pd.DataFrame(
+        {
+            column: (
+                _to_categorical(values)
+                if column in CATEGORICAL_COLUMNS
+                else np.asarray(values, dtype=np.float64)
+            )
+            for column, values in columns.items()
+        }
+    )
+    return long_df
+
+
+def get_one_hot_df(long_df: pd.DataFrame, binary: bool = True) -> pd.DataFrame:
+    """Returns a sparse patient x code frame of all rows with a code. Columns
+    are a (feature, system, code) MultiIndex. With binary=False the cells
+    count how often a patient has a code."""
+    if scipy is None:
+        raise ImportError(
+            "scipy is required for one hot matrices, install fhir_analyzer[export]."
+        )
+    coded_df = long_df[long_df["code"].notna()]
+    patient_codes = long_df["patient_id"].cat.categories
+    column_df = coded_df[["feature", "system", "code"]].astype(object)
+    column_index = pd.MultiIndex.from_frame(column_df.fillna(""))
+    column_codes, columns = pd.factorize(column_index)
+    matrix = scipy.sparse.coo_matrix(
+        (
+            np.ones(len(coded_df), dtype=np.float32),
+            (coded_df["patient_id"].cat.codes.to_numpy(), column_codes),
+        ),
+        shape=(len(patient_codes), len(columns)),
+    ).tocsr()
+    if binary:
+        matrix.data[:] = 1
+    return pd.DataFrame.sparse.from_spmatrix(
+        matrix,
+        index=pd.Index(patient_codes, name="patient_id"),
+        columns=pd.MultiIndex.from_tuples(columns, names=["feature", "system", "code"]),
+    )
+
+
+def to_arrow_table(long_df: pd.DataFrame):
+    """Converts the long feature frame to an Arrow table. Categorical columns
+    become dictionary arrays, the numeric column is not copied."""
+    if pyarrow is None:
+        raise ImportError(
+            "pyarrow is required for Arrow export, install fhir_analyzer[export]."
+        )
+    return pyarrow.Table.from_pandas(long_df, preserve_index=False)
+
+
+def write_parquet(long_df: pd.DataFrame, path: str, **kwargs):
+    table = to_arrow_table(long_df)
+    pyarrow.parquet.write_table(table, path, **kwargs)
@@ -1,31 +1,176 @@
 from typing import Any, Callable, Union
 
-from fhirpathpy import compile
 import pandas as pd
 
-from fhir_analyzer.fhirstore import Fhirstore
+from fhir_analyzer.extraction_plan import (
+    ExtractionPlan,
+    build_extraction_plans,
+)
 
+from fhir_analyzer.feature_export import (
+    get_long_feature_df,
+    get_one_hot_df,
+    to_arrow_table,
+    write_parquet,
+)
+from fhir_analyzer.fhirstore import Fhirstore, FhirstoreSnapshot
+from fhir_analyzer.progress import (
+    EXTRACTION,
+    CancellationToken,
+    Progress,
+    ProgressTracker,
+)
+from fhir_analyzer.projection import Projection
+from fhir_analyzer.time_index import validate_time_filter
 
-def evaluate_cond_fns(resource: dict, fns: list[dict[Callable, Callable]]) -> str:
-    for fns_dic in fns:
-        for cond_fn, targ_fn in fns_dic.items():
-            if cond_fn(resource):
-                res = targ_fn(resource)
-                if res:
-                    return res
-    return None
+
+def aggregate_targets(targets: list[dict[str, Any]], aggregate: str) -> list[dict]:
+    """Aggregates the numerical values of targets, per code if the targets
+    have one. The aggregated target is the last target of its code with the
+    aggregate as value."""
+    groups = {}
+    for target in targets:
+        groups.setdefault(target.get("code", None), []).append(target)
+    result = []
+    for code_targets in groups.values():
+        values = []
+        for target in code_targets:
+            try:
+                values.append(float(target["value"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+        if aggregate == "count":
+            value = len(code_targets)
+        elif not values:
+            continue
+        elif aggregate == "mean":
+            value = sum(values) / len(values)
+        elif aggregate == "min":
+            value = min(values)
+        elif aggregate == "max":
+            value = max(values)
+        else:
+            value = sum(values)
+        result.append({**code_targets[-1], "value": value})
+    return result
 
 
 class FeatureSelector:
-    def __init__(self, fhirstore: Fhirstore = None):
+    def __init__(
+        self,
+        fhirstore: Fhirstore = None,
+        batch_size: int = 500,
+        validate_features: Callable[
+            [dict[str, str], list[dict[str, list[dict]]]], Any
+        ] = None,
+    ):
+        self._batch_size = batch_size
+        self._validate_features = validate_features
         self._feature_names: list[str] = []
         self._feature_types: dict[str, str] = {}
+        self._feature_specs: dict[str, dict] = {}
         self._patient_features: list[dict[str, list[str]]] = {}
+        self._extraction_plans: Union[dict[str, ExtractionPlan], None] = None
+        self._dirty_patient_ids: set[str] = set()
+        self._features_version = 0
+        self._export_cache: dict[str, tuple[int, Any]] = {}
         self._fhirstore = fhirstore if fhirstore else Fhirstore()
+        self._fhirstore.subscribe(self._mark_dirty)
 
     @property
     def feature_df(self):
-        return pd.DataFrame(self._patient_features).T
+        return self._get_cached_export(
+            "feature_df", lambda: pd.DataFrame(self._patient_features).T
+        )
+
+    @property
+    def long_feature_df(self) -> pd.DataFrame:
+        """Feature values in long format with categorical columns."""
+        return self._get_cached_export(
+            "long_feature_df", lambda: get_long_feature_df(self._patient_features)
+        )
+
+    def get_one_hot_df(self, binary: bool = True) -> pd.DataFrame:
+        """Sparse patient x (feature, system, code) frame of all coded features."""
+        return self._get_cached_export(
+            f"one_hot_df_{binary}",
+            lambda: get_one_hot_df(self.long_feature_df, binary=binary),
+        )
+
+    def to_arrow(self):
+        return to_arrow_table(self.long_feature_df)
+
+    def to_parquet(self, path: str, **kwargs):
+        write_parquet(self.long_feature_df, path, **kwargs)
+
+    def _get_cached_export(self, name: str, build_fn: Callable[[], Any]) -> Any:
+        version, result = self._export_cache.get(name, (None, None))
+        if version != self._features_version:
+            result = build_fn()
+            self._export_cache[name] = (self._features_version, result)
+        return result
+
+    @property
+    def dirty_patient_ids(self) -> set[str]:
+        return self._dirty_patient_ids
+
+    def _mark_dirty(self, patient_ids: set[str]):
+        # Without features there is nothing to re-extract, the first feature
+        # is extracted for all patients.
+        if self._feature_specs:
+            self._dirty_patient_ids |= patient_ids
+
+    def refresh(
+        self,
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
+    ):
+        """Re-extracts all features for the patients whose resources changed
+        since the features were extracted. Extraction reads from a snapshot,
+        changes that arrive meanwhile are picked up by the next refresh. If
+        cancel is cancelled, the patients stay marked as changed and
+        OperationCancelled is raised."""
+        with self._fhirstore._lock:
+            dirty_patient_ids = self._dirty_patient_ids
+            if not dirty_patient_ids:
+                return
+            self._dirty_patient_ids = set()
+            store = self._get_snapshot()
+        try:
+            patient_ids = [
+                patient_id
+                for patient_id in dirty_patient_ids
+                if store._storage.has_patient(patient_id)
+            ]
+            for patient_id in dirty_patient_ids.difference(patient_ids):
+                self._patient_features.pop(patient_id, None)
+            self._extract_features(
+                list(self._feature_specs),
+                patient_ids=patient_ids,
+                store=store,
+                tracker=ProgressTracker(EXTRACTION, len(patient_ids), progress, cancel),
+            )
+            self._validate_extracted_features(list(self._feature_specs), patient_ids)
+        except Exception:
+            self._dirty_patient_ids |= dirty_patient_ids
+            raise
+        finally:
+            self._close_snapshot(store)
+
+    def _get_snapshot(self) -> Union[Fhirstore, FhirstoreSnapshot]:
+        try:
+            return self._fhirstore.snapshot()
+        except NotImplementedError:
+            return self._fhirstore
+
+    def _close_snapshot(self, store: Union[Fhirstore, FhirstoreSnapshot]):
+        if store is not self._fhirstore:
+            store.close()
+
+    def get_projection(self, **kwargs) -> Projection:
+        """Returns a projection that keeps only the parts of resources the
+        registered features need."""
+        return Projection.from_feature_specs(self._feature_specs, **kwargs)
 
     def add_feature(
         self,
@@ -33,6 +178,7 @@ class FeatureSelector:
         resource_types: list[str],
         target_paths: list[str],
         conditional_target_paths: list[dict[str, str]] = None,
+        time_filter: dict = None,
     ):
         target_paths = {"value": target_paths}
         self._add_feature(
@@ -42,6 +188,7 @@ class FeatureSelector:
             target_paths=target_paths,
             conditional_target_paths=conditional_target_paths,
             include_target_names=False,
+            time_filter=time_filter,
         )
 
     def _add_feature(
@@ -52,110 +199,242 @@ class FeatureSelector:
         target_paths: dict[str, list[str]],
         conditional_target_paths: dict[str, list[dict[str, str]]] = None,
         include_target_names=False,
+        time_filter: dict = None,
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
     ):
-        if feature_name not in self._feature_names:
-            self._add_feature_metadata(feature_name, feature_type)
-
-        target_fns = {
-            targ_n: [compile(targ_path) for targ_path in targ_paths]
-            for targ_n, targ_paths in target_paths.items()
-        }
+        """Registers a feature and extracts it for all patients. A time filter
+        restricts extraction to the resources whose clinical time is inside a
+        window, given by start, end and lookback_days. It can further select
+        the latest or first value or aggregate the values (mean, min, max, sum
+        or count), per code for coded features.
 
-        conditional_fns = (
+        progress is called with the number of processed patients. If cancel
+        is cancelled, the remaining patients are marked as changed, so the
+        next refresh completes the extraction, and OperationCancelled is
+        raised."""
+        self._register_feature(
+            feature_name,
             {
-                targ_n: [
-                    (compile(cond), compile(targ)) for cond, targ in cond_paths.items()
-                ]
-                for targ_n, cond_paths in conditional_target_paths.items()
-            }
-            if conditional_target_paths
-            else {}
+                "type": feature_type,
+                "resource_types": target_resource_types,
+                "target_paths": target_paths,
+                "conditional_target_paths": conditional_target_paths,
+                "include_target_names": include_target_names,
+                "time_filter": time_filter,
+            },
         )
+        self._extract_new_features([feature_name], progress, cancel)
 
-        if not target_fns and not conditional_fns:
+    def _add_features(
+        self,
+        feature_specs: dict[str, dict],
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
+    ):
+        """Registers several features, given as specs like in _feature_specs,
+        and extracts them in one pass over the patients, so expressions they
+        share are evaluated once per resource."""
+        for feature_name, spec in feature_specs.items():
+            self._register_feature(feature_name, spec)
+        self._extract_new_features(list(feature_specs), progress, cancel)
+
+    def _register_feature(self, feature_name: str, spec: dict):
+        spec = {**spec, "time_filter": validate_time_filter(spec.get("time_filter"))}
+        if not spec["target_paths"] and not spec["conditional_target_paths"]:
             raise ValueError("No target paths or conditional target paths provided.")
+        # Compiling the plans first raises on invalid paths before the
+        # feature is registered.
+        extraction_plans = build_extraction_plans(
+            {**self._feature_specs, feature_name: spec}
+        )
+        if feature_name not in self._feature_names:
+            self._add_feature_metadata(feature_name, spec["type"])
+        self._feature_specs[feature_name] = spec
+        self._extraction_plans = extraction_plans
 
-        self._process_target_resources(
-            target_fns,
-            conditional_fns,
-            feature_name,
-            target_resource_types,
-            include_target_names,
+    def _extract_new_features(
+        self,
+        feature_names: list[str],
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
+    ):
+        with self._fhirstore._lock:
+            store = self._get_snapshot()
+        try:
+            self._extract_features(
+                feature_names,
+                store=store,
+                tracker=ProgressTracker(
+                    EXTRACTION, len(store.patient_ids), progress, cancel
+                ),
+            )
+        finally:
+            self._close_snapshot(store)
+        try:
+            self._validate_extracted_features(feature_names)
+        except ValueError:
+            for feature_name in feature_names:
+                self.remove_feature(feature_name)
+            raise
+
+    def _validate_extracted_features(
+        self, feature_names: list[str], patient_ids: list[str] = None
+    ):
+        """Passes the types and the extracted values of the features to the
+        validator hook, which raises a ValueError to reject them."""
+        if self._validate_features is None:
+            return
+        self._validate_features(
+            {
+                feature_name: self._feature_types[feature_name]
+                for feature_name in feature_names
+            },
+            [
+                self._patient_features.get(patient_id, {})
+                for patient_id in (
+                    self._patient_features if patient_ids is None else patient_ids
+                )
+            ],
         )
 
+    def remove_feature(self, feature_name: str):
+        """Removes a feature and its extracted values."""
+        if feature_name not in self._feature_names:
+            raise ValueError(f"Unknown feature: {feature_name}")
+        self._feature_names.remove(feature_name)
+        self._feature_types.pop(feature_name, None)
+        self._feature_specs.pop(feature_name, None)
+        self._extraction_plans = None
+        if not self._feature_specs:
+            self._dirty_patient_ids = set()
+        for features in self._patient_features.values():
+            features.pop(feature_name, None)
+        self._features_version += 1
+
     def _add_feature_metadata(self, feature_name: str, feature_type: str):
         self._feature_names.append(feature_name)
         self._feature_types[feature_name] = feature_type
 
-    def _process_target_resources(
+    def _get_extraction_plans(self) -> dict[str, ExtractionPlan]:
+        if self._extraction_plans is None:
+            self._extraction_plans = build_extraction_plans(self._feature_specs)
+        return self._extraction_plans
+
+    def _extract_features(
         self,
-        target_fns: list[Callable[[Any], Any]],
-        conditional_fns: dict[
-            str, list[tuple[Callable[[Any], bool], Callable[[Any], Any]]]
-        ],
-        feature_name: str,
-        target_resource_types: list[str],
-        include_target_names,
+        feature_names: list[str],
+        patient_ids: list[str] = None,
+        store: Union[Fhirstore, FhirstoreSnapshot] = None,
+        tracker: ProgressTracker = None,
     ):
-        for (
-            patient_id,
-            patient_resources,
-        ) in self._fhirstore._patient_connections.items():
-            self._patient_features.setdefault(patient_id, {})
-            if feature_name not in self._patient_features[patient_id]:
-                self._patient_features[patient_id][feature_name] = []
-            for resource_type in target_resource_types:
-                if resource_type in patient_resources:
-                    for resource in patient_resources[resource_type]:
-                        target = self._get_target(resource, target_fns, conditional_fns)
+        """Extracts features in one pass over the patients. Every resource is
+        evaluated with the extraction plan of its resource type, which shares
+        the results of expressions between the features."""
+        self._features_version += 1
+        store = store if store else self._fhirstore
+        plans = self._get_extraction_plans()
+        if patient_ids is None:
+            patients = store.iter_patient_resources(batch_size=self._batch_size)
+        else:
+            patients = (
+                (patient_id, store.get_patient_resources(patient_id))
+                for patient_id in patient_ids
+            )
+        processed_patient_ids = set()
+        for patient_id, patient_resources in patients:
+            if tracker is not None and tracker.is_cancelled:
+                all_patient_ids = (
+                    store.patient_ids if patient_ids is None else patient_ids
+                )
+                with self._fhirstore._lock:
+                    self._mark_dirty(
+                        set(all_patient_ids).difference(processed_patient_ids)
+                    )
+                tracker.check()
+            patient_features = self._patient_features.setdefault(patient_id, {})
+            # Expression results per resource, shared by all features.
+            resource_values = {}
+            for feature_name in feature_names:
+                spec = self._feature_specs[feature_name]
+                if patient_ids is not None or feature_name not in patient_features:
+                    patient_features[feature_name] = []
+                for resource_type in spec["resource_types"]:
+                    if resource_type not in patient_resources:
+                        continue
+                    plan = plans[resource_type]
+                    resources = patient_resources[resource_type]
+
+                    def get_target(resource: Any) -> dict[str, Any]:
+                        return plan.get_target(
+                            feature_name,
+                            resource,
+                            resource_values.setdefault(id(resource), {}),
+                        )
+
+                    if spec.get("time_filter", None):
+                        targets = self._get_time_filtered_targets(
+                            store,
+                            patient_id,
+                            resource_type,
+                            resources,
+                            get_target,
+                            spec["time_filter"],
+                        )
+                    else:
+                        targets = (get_target(resource) for resource in resources)
+                    for target in targets:
                         self._update_patient_features(
-                            patient_id, feature_name, target, include_target_names
+                            patient_id,
+                            feature_name,
+                            target,
+                            spec["include_target_names"],
                         )
+            processed_patient_ids.add(patient_id)
+            if tracker is not None:
+                tracker.update()
 
-    def _get_target(
+    def _get_time_filtered_targets(
         self,
-        resource: Any,
-        target_fns: Union[list[Callable[[Any], Any]], dict[str, Callable[[Any], Any]]],
-        conditional_fns: Union[
-            list[tuple[Callable[[Any], bool], Callable[[Any], Any]]],
-            dict[str, tuple[Callable[[Any], bool], Callable[[Any], Any]]],
-        ],
-    ):
-        target = {}
-        if conditional_fns:
-            for targ_n, cond_fns in conditional_fns.items():
-                temp_target = self._evaluate_conditional_functions(resource, cond_fns)
-                if temp_target:
-                    target[targ_n] = temp_target
-        if not target:
-            for targ_n, targ_fns in target_fns.items():
-                temp_target = self._evaluate_target_functions(resource, targ_fns)
-                if temp_target:
-                    target[targ_n] = temp_target
-                else:
-                    target[targ_n] = None
-        return target
-
-    def _evaluate_conditional_functions(
-        self,
-        resource: Any,
-        conditional_fns: list[tuple[Callable[[Any], bool], Callable[[Any], Any]]],
-    ):
-        for cond_fn, targ_fn in conditional_fns:
-            if cond_fn(resource):
-                return targ_fn(resource)[0]
-        return None
-
-    def _evaluate_target_functions(
-        self, resource: Any, target_fns: list[Callable[[Any], Any]]
-    ):
-        for target_fn in target_fns:
-            if not len(target_fn(resource)) > 0:
+        store: Union[Fhirstore, FhirstoreSnapshot],
+        patient_id: str,
+        resource_type: str,
+        resources: list[dict],
+        get_target: Callable[[Any], dict[str, Any]],
+        time_filter: dict,
+    ) -> list[dict[str, Any]]:
+        window = store.time_index.get_window(
+            patient_id,
+            resource_type,
+            resources,
+            start=time_filter.get("start", None),
+            end=time_filter.get("end", None),
+            lookback_days=time_filter.get("lookback_days", None),
+            generation=store.generation,
+        )
+        select = time_filter.get("select", None)
+        if select == "latest":
+            window = reversed(window)
+        targets = []
+        selected_codes = set()
+        for resource in window:
+            target = get_target(resource)
+            if not select:
+                targets.append(target)
+                continue
+            if not any(value is not None for value in target.values()):
+                continue
+            code = target.get("code", None)
+            if code in selected_codes:
                 continue
-            target = target_fn(resource)[0]
-            if target:
-                return target
-        return None
+            selected_codes.add(code)
+            targets.append(target)
+            if "code" not in target:
+                break
+        aggregate = time_filter.get("aggregate", None)
+        if aggregate:
+            targets = aggregate_targets(targets, aggregate)
+        return targets
 
     def _update_patient_features(
         self,
@@ -1,82 +1,615 @@
-from fhir_analyzer.helper import gather_references_for_resource
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from typing import Any, Callable, Generator, Union
+
+from fhir_analyzer.helper import get_delete_target, get_reference_strings, load_json
+from fhir_analyzer.mapped_file import (
+    IndexEntry,
+    MappedFile,
+    build_offset_index,
+    materialize,
+)
+from fhir_analyzer.progress import (
+    INGEST,
+    CancellationToken,
+    Progress,
+    ProgressTracker,
+)
+from fhir_analyzer.projection import Projection
+from fhir_analyzer.reference_index import ReferenceIndex
+from fhir_analyzer.storage import MemoryStorage, StorageBackend
+from fhir_analyzer.time_index import TimeIndex, parse_fhir_datetime
+
+
+def _load_bundle_file(
+    path: str, projection: Projection = None
+) -> tuple[str, list[dict], list[Union[str, None]], list[list[str]], str]:
+    """Parses a bundle file and extracts the references of its resources.
+    Returns the path, the resources, their full urls, their references and an
+    error message if the file could not be loaded."""
+    try:
+        with open(path, "rb") as f:
+            bundle = load_json(f.read())
+        Fhirstore.validate_bundle_input(bundle)
+        resources = []
+        full_urls = []
+        for entry in bundle["entry"]:
+            resource = entry["resource"]
+            if projection:
+                resource = projection.project(resource)
+                if resource is None:
+                    continue
+            resources.append(resource)
+            full_urls.append(entry.get("fullUrl", None))
+        references = [get_reference_strings(resource) for resource in resources]
+    except Exception as e:
+        return path, [], [], [], f"{type(e).__name__}: {e}"
+    return path, resources, full_urls, references, None
+
+
+def _index_file(
+    path: str,
+) -> tuple[str, list[IndexEntry], list[tuple[str, str]], Union[str, None]]:
+    """Builds the offset index of a file. Returns the path, the index entries,
+    the deleted resources and an error message if the file could not be
+    indexed."""
+    try:
+        entries, deletes = build_offset_index(path)
+    except Exception as e:
+        return path, [], [], f"{type(e).__name__}: {e}"
+    return path, entries, deletes, None
+
+
+def is_newer_version(resource: dict, existing_resource: dict) -> bool:
+    """Checks if a resource is a newer version of an existing resource based on
+    numeric meta.versionIds or else meta.lastUpdated. If neither orders the
+    two, the existing resource is kept, unless it has no version at all."""
+    meta = resource.get("meta", {})
+    existing_meta = existing_resource.get("meta", {})
+    version_id = meta.get("versionId", None)
+    existing_version_id = existing_meta.get("versionId", None)
+    if version_id is not None and existing_version_id is not None:
+        if str(version_id).isdigit() and str(existing_version_id).isdigit():
+            return int(version_id) > int(existing_version_id)
+    last_updated = parse_fhir_datetime(meta.get("lastUpdated", None))
+    existing_last_updated = parse_fhir_datetime(existing_meta.get("lastUpdated", None))
+    if last_updated is not None and existing_last_updated is not None:
+        return last_updated > existing_last_updated
+    return existing_version_id is None and existing_last_updated is None
+
+
+class FhirstoreSnapshot:
+    """Read-only view of a Fhirstore at one generation. Writes to the store
+    after the snapshot was taken are not visible."""
+
+    def __init__(
+        self, storage: StorageBackend, generation: int, time_index: TimeIndex = None
+    ):
+        self._storage = storage
+        self._generation = generation
+        self._time_index = time_index if time_index else TimeIndex()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def patient_ids(self) -> list[str]:
+        return self._storage.get_patient_ids()
+
+    @property
+    def time_index(self) -> TimeIndex:
+        return self._time_index
+
+    def get_patient_resources(self, patient_id: str) -> dict[str, list[dict]]:
+        return self._storage.get_patient_resources(patient_id)
+
+    def iter_patient_resources(
+        self, batch_size: int = 500
+    ) -> Generator[tuple[str, dict[str, list[dict]]], None, None]:
+        yield from self._storage.iter_patient_resources(batch_size=batch_size)
+
+    def close(self):
+        self._storage.close()
+
+    def __enter__(self) -> "FhirstoreSnapshot":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class Fhirstore:
-    def __init__(self, bundle: dict = None, resources: list[dict] = None):
-        self._resources = []
-        self._patient_ids = []
-        self._patient_connections = {}
+    def __init__(
+        self,
+        bundle: dict = None,
+        resources: list[dict] = None,
+        storage: StorageBackend = None,
+        projection: Projection = None,
+        linkage_chains: dict[str, list[str]] = None,
+    ):
+        self._storage = storage if storage else MemoryStorage()
+        self._reference_index = ReferenceIndex(linkage_chains)
+        self._load_errors: dict[str, str] = {}
+        self._listeners: list[Callable[[set[str]], None]] = []
+        self._generation = 0
+        self._fingerprint: tuple[int, str] = None
+        self._lock = threading.RLock()
+        self._time_index = TimeIndex()
+        self._mapped_files: list[MappedFile] = []
+        self._projection = None
+        if projection:
+            self.set_projection(projection)
+        new_resources = []
+        full_urls = []
         if bundle:
             self.validate_bundle_input(bundle)
-            self._resources += [entry["resource"] for entry in bundle["entry"]]
+            new_resources += [entry["resource"] for entry in bundle["entry"]]
+            full_urls += [entry.get("fullUrl", None) for entry in bundle["entry"]]
         if resources:
             self.validate_resources_input(resources)
-            self._resources += resources
-        if len(self._resources) > 0:
-            self._update_patient_dicts(self._resources)
+            new_resources += resources
+            full_urls += [None] * len(resources)
+        if len(new_resources) > 0:
+            self._add_new_resources(new_resources, full_urls)
 
-    def _update_patient_dicts(self, resources: list[dict]):
-        for resource in resources:
-            resource_id = resource["id"]
-            resource_type = resource.get("resourceType", None)
-            if resource_type == "Patient":
-                if not resource_id in self._patient_ids:
-                    self._patient_ids.append(resource_id)
-                self._patient_connections[resource_id] = {resource_type: [resource]}
+    @classmethod
+    def from_directory(
+        cls,
+        path: str,
+        workers: int = None,
+        pattern: str = "*.json",
+        storage: StorageBackend = None,
+        projection: Projection = None,
+        linkage_chains: dict[str, list[str]] = None,
+        lazy: bool = False,
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
+    ) -> "Fhirstore":
+        """Creates a Fhirstore from a directory of bundle files. Files that
+        fail to load are listed in load_errors."""
+        fhirstore = cls(
+            storage=storage, projection=projection, linkage_chains=linkage_chains
+        )
+        fhirstore.add_directory(
+            path,
+            workers=workers,
+            pattern=pattern,
+            lazy=lazy,
+            progress=progress,
+            cancel=cancel,
+        )
+        return fhirstore
+
+    @property
+    def load_errors(self) -> dict[str, str]:
+        return self._load_errors
+
+    @property
+    def _resources(self) -> list[dict]:
+        return list(self._storage.iter_resources())
+
+    @property
+    def _patient_ids(self) -> list[str]:
+        return self._storage.get_patient_ids()
+
+    @property
+    def _patient_connections(self) -> dict[str, dict[str, list[dict]]]:
+        return dict(self._storage.iter_patient_resources())
+
+    @property
+    def patient_ids(self) -> list[str]:
+        return self._storage.get_patient_ids()
+
+    def get_patient_resources(self, patient_id: str) -> dict[str, list[dict]]:
+        return self._storage.get_patient_resources(patient_id)
+
+    def iter_patient_resources(
+        self, batch_size: int = 500
+    ) -> Generator[tuple[str, dict[str, list[dict]]], None, None]:
+        yield from self._storage.iter_patient_resources(batch_size=batch_size)
+
+    @property
+    def time_index(self) -> TimeIndex:
+        """Index of the resources of each patient sorted by clinical time."""
+        return self._time_index
+
+    @property
+    def generation(self) -> int:
+        """Counter that is incremented on every change of the stored
+        resources."""
+        return self._generation
+
+    def snapshot(self) -> FhirstoreSnapshot:
+        """Returns a consistent read-only view of the current state. Readers of
+        the snapshot are not blocked by and do not see later writes, so
+        features can be extracted while another thread keeps adding
+        resources."""
+        with self._lock:
+            return FhirstoreSnapshot(
+                self._storage.snapshot(), self._generation, self._time_index
+            )
+
+    def fingerprint(self) -> str:
+        """Returns a content hash of all stored resources that does not depend
+        on the order in which they were added."""
+        with self._lock:
+            if self._fingerprint and self._fingerprint[0] == self._generation:
+                return self._fingerprint[1]
+            generation = self._generation
+            try:
+                storage = self._storage.snapshot()
+            except NotImplementedError:
+                return self._compute_fingerprint(self._storage, generation)
+        fingerprint = self._compute_fingerprint(storage, generation)
+        storage.close()
+        return fingerprint
+
+    def _compute_fingerprint(self, storage: StorageBackend, generation: int) -> str:
+        digest_sum = 0
+        for resource in storage.iter_resources():
+            resource_digest = hashlib.sha256(
+                json.dumps(materialize(resource), sort_keys=True, default=str).encode()
+            ).digest()
+            digest_sum = (digest_sum + int.from_bytes(resource_digest, "big")) % (
+                2**256
+            )
+        fingerprint = f"{digest_sum:064x}"
+        self._fingerprint = (generation, fingerprint)
+        return fingerprint
 
+    def subscribe(self, callback: Callable[[set[str]], None]):
+        """Registers a callback that is called with the ids of the patients
+        whose resources changed."""
+        self._listeners.append(callback)
+
+    def _notify(self, patient_ids: set[str]):
+        self._generation += 1
+        if not patient_ids:
+            return
+        self._time_index.invalidate(patient_ids, self._generation)
+        for callback in self._listeners:
+            callback(patient_ids)
+
+    def _update_patient_dicts(
+        self,
+        resources: list[dict],
+        full_urls: list[Union[str, None]] = None,
+        references: list[list[str]] = None,
+    ) -> set[str]:
+        resource_dict = {
+            (resource["resourceType"], resource["id"]): resource
+            for resource in resources
+        }
         for resource in resources:
-            resource_type = resource.get("resourceType", None)
-            references = gather_references_for_resource(resource)
-            for reference in references:
-                if reference.reference in self._patient_ids:
-                    patient_connection = self._patient_connections.setdefault(
-                        reference.reference, {}
-                    )
-                    if not resource_type in patient_connection:
-                        patient_connection[resource_type] = []
-                    patient_connection[resource_type].append(resource)
+            if resource["resourceType"] == "Patient":
+                self._storage.add_patient(resource["id"])
+        links = self._reference_index.add_resources(resources, full_urls, references)
+        for patient_id, key in links:
+            resource = resource_dict.get(key, None)
+            if resource is None:
+                resource = self._storage.get_resource(*key)
+            self._storage.add_patient_connection(patient_id, resource)
+        return {patient_id for patient_id, _ in links}
 
     def add_bundle(self, bundle: dict):
         self.validate_bundle_input(bundle)
-        new_resources = [
-            entry["resource"]
-            for entry in bundle["entry"]
-            if not self._resource_exists(entry["resource"])
-        ]
-        if len(new_resources) == 0:
-            return
-        self._resources += new_resources
-        self._update_patient_dicts(new_resources)
+        with self._lock:
+            self._add_bundle_entries(bundle)
+
+    def _add_bundle_entries(self, bundle: dict):
+        entries = []
+        for entry in bundle["entry"]:
+            request = entry.get("request", {})
+            if request.get("method", None) == "DELETE":
+                target = get_delete_target(request.get("url", ""))
+                if target:
+                    self.delete_resource(*target)
+            else:
+                entries.append(entry)
+        if entries:
+            self._add_new_resources(
+                [entry["resource"] for entry in entries],
+                [entry.get("fullUrl", None) for entry in entries],
+            )
+
+    def add_directory(
+        self,
+        path: str,
+        workers: int = None,
+        pattern: str = "*.json",
+        merge_batch_size: int = 64,
+        lazy: bool = False,
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
+    ) -> dict[str, str]:
+        """Loads all bundle files in a directory. Files are parsed in a process
+        pool if workers is greater than one and merged into the store in
+        batches. With lazy, the files are memory mapped and added as lazy
+        resources, see add_mapped_file. Returns the errors of the files that
+        could not be loaded.
+
+        progress is called with the number of loaded files. If cancel is
+        cancelled, the files that were already parsed are merged and
+        OperationCancelled is raised, so the store holds whole files only."""
+        paths = sorted(glob(os.path.join(path, pattern)))
+        errors = {}
+        tracker = ProgressTracker(INGEST, len(paths), progress, cancel)
+        executor = None
+        try:
+            if lazy:
+                if workers and workers > 1:
+                    executor = ProcessPoolExecutor(max_workers=workers)
+                    results = executor.map(_index_file, paths)
+                else:
+                    results = (_index_file(p) for p in paths)
+                for file_path, entries, deletes, error in results:
+                    if error:
+                        errors[file_path] = error
+                    else:
+                        self._add_mapped_entries(file_path, entries, deletes)
+                    tracker.update()
+                    tracker.check()
+            else:
+                if workers and workers > 1:
+                    executor = ProcessPoolExecutor(max_workers=workers)
+                    results = executor.map(
+                        _load_bundle_file,
+                        paths,
+                        [self._projection] * len(paths),
+                        chunksize=max(1, len(paths) // (workers * 4)),
+                    )
+                else:
+                    results = (_load_bundle_file(p, self._projection) for p in paths)
+                self._merge_loaded_files(results, merge_batch_size, errors, tracker)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=tracker.is_cancelled)
+            self._load_errors.update(errors)
+        return errors
+
+    def _merge_loaded_files(
+        self,
+        results,
+        merge_batch_size: int,
+        errors: dict,
+        tracker: ProgressTracker = None,
+    ):
+        batch = []
+        for result in results:
+            batch.append(result)
+            if len(batch) >= merge_batch_size:
+                self._merge_loaded_batch(batch, errors)
+                batch = []
+            if tracker is not None:
+                tracker.update()
+                if tracker.is_cancelled:
+                    break
+        if batch:
+            self._merge_loaded_batch(batch, errors)
+        if tracker is not None:
+            tracker.check()
+
+    def _merge_loaded_batch(self, batch: list[tuple], errors: dict):
+        resources = []
+        full_urls = []
+        references = []
+        for path, file_resources, file_full_urls, file_references, error in batch:
+            if error:
+                errors[path] = error
+                continue
+            resources += file_resources
+            full_urls += file_full_urls
+            references += file_references
+        if resources:
+            self._add_new_resources(resources, full_urls, references, projected=True)
+
+    def add_mapped_file(self, path: str):
+        """Adds the resources of a bundle or NDJSON (.ndjson, .jsonl) file
+        without keeping them in memory. The file is parsed once to index the
+        byte range and the references of every resource, the store holds lazy
+        resources that are parsed again from the memory mapped file when an
+        element other than resourceType or id is accessed. Projections are not
+        applied to lazy resources."""
+        _, entries, deletes, error = _index_file(path)
+        if error:
+            raise ValueError(f"Could not index {path}: {error}")
+        self._add_mapped_entries(path, entries, deletes)
+
+    def close_mapped_files(self):
+        """Closes the memory maps of the files added with add_mapped_file or
+        lazy add_directory. Their resources stay readable and reopen the file
+        when they are accessed."""
+        for mapped_file in self._mapped_files:
+            mapped_file.close()
+
+    def _add_mapped_entries(
+        self,
+        path: str,
+        entries: list[IndexEntry],
+        deletes: list[tuple[str, str]],
+    ):
+        with self._lock:
+            for resource_type, resource_id in deletes:
+                self._delete_resource(resource_type, resource_id)
+            if entries:
+                mapped_file = MappedFile(path)
+                self._mapped_files.append(mapped_file)
+                self._add_new_resources(
+                    mapped_file.get_resources(entries),
+                    [entry.full_url for entry in entries],
+                    [entry.references for entry in entries],
+                    projected=True,
+                )
 
     def add_resources(self, resources: list[dict]):
-        resources = [
-            resource for resource in resources if not self._resource_exists(resource)
-        ]
-        if len(resources) == 0:
-            return
         self.validate_resources_input(resources)
-        self._resources += resources
-        self._update_patient_dicts(resources)
+        self._add_new_resources(resources)
+
+    def upsert_resources(self, resources: list[dict]):
+        """Adds resources and replaces existing resources with the same type
+        and id regardless of their version."""
+        self.validate_resources_input(resources)
+        self._add_new_resources(resources, upsert=True)
+
+    def delete_resource(self, resource_type: str, resource_id: str):
+        with self._lock:
+            self._delete_resource(resource_type, resource_id)
+
+    def _delete_resource(self, resource_type: str, resource_id: str):
+        if not self._storage.has_resource(resource_type, resource_id):
+            return
+        unlinks = self._reference_index.remove_resource(resource_type, resource_id)
+        for patient_id, key in unlinks:
+            self._storage.remove_patient_connection(patient_id, *key)
+        changed_patient_ids = {patient_id for patient_id, _ in unlinks}
+        if resource_type == "Patient":
+            connected_resources = [
+                resource
+                for resources in self._storage.get_patient_resources(
+                    resource_id
+                ).values()
+                for resource in resources
+            ]
+            self._reference_index.remove_patient(resource_id, connected_resources)
+            self._storage.remove_patient(resource_id)
+            changed_patient_ids.add(resource_id)
+        self._storage.remove_resource(resource_type, resource_id)
+        self._storage.flush()
+        self._notify(changed_patient_ids)
+
+    def _update_resource(
+        self,
+        resource: dict,
+        full_url: Union[str, None] = None,
+        references: list[str] = None,
+    ) -> set[str]:
+        key = (resource["resourceType"], resource["id"])
+        unlinks = self._reference_index.remove_resource(*key)
+        links = self._reference_index.add_resources(
+            [resource], [full_url], [references]
+        )
+        unlink_set = set(unlinks)
+        link_set = set(links)
+        kept_patient_ids = [
+            patient_id
+            for patient_id, linked_key in unlinks
+            if linked_key == key and (patient_id, linked_key) in link_set
+        ]
+        self._storage.replace_resource(resource, kept_patient_ids)
+        for patient_id, linked_key in unlinks:
+            if (patient_id, linked_key) not in link_set:
+                self._storage.remove_patient_connection(patient_id, *linked_key)
+        for patient_id, linked_key in links:
+            if (patient_id, linked_key) not in unlink_set:
+                linked_resource = (
+                    resource
+                    if linked_key == key
+                    else self._storage.get_resource(*linked_key)
+                )
+                self._storage.add_patient_connection(patient_id, linked_resource)
+        return {patient_id for patient_id, _ in unlinks + links}
 
     def add_feature(self):
         pass
 
+    def set_projection(self, projection: Projection):
+        """Sets the projection that is applied to all resources added from now
+        on. Resources that are already stored are not changed."""
+        for resource_type in self._reference_index.linked_types:
+            projection.keep_resource_type(resource_type)
+        self._projection = projection
+
+    def _add_new_resources(
+        self,
+        resources: list[dict],
+        full_urls: list[Union[str, None]] = None,
+        references: list[list[str]] = None,
+        projected: bool = False,
+        upsert: bool = False,
+    ):
+        with self._lock:
+            self._add_resources_locked(
+                resources, full_urls, references, projected, upsert
+            )
+
+    def _add_resources_locked(
+        self,
+        resources: list[dict],
+        full_urls: list[Union[str, None]] = None,
+        references: list[list[str]] = None,
+        projected: bool = False,
+        upsert: bool = False,
+    ):
+        full_urls = full_urls if full_urls else [None] * len(resources)
+        references = references if references else [None] * len(resources)
+        new_resources = []
+        new_full_urls = []
+        new_references = []
+        updated_resources = []
+        seen_keys = set()
+        for resource, full_url, resource_references in zip(
+            resources, full_urls, references
+        ):
+            key = (resource["resourceType"], resource["id"])
+            if key in seen_keys:
+                continue
+            seen_keys.add(key)
+            exists = self._resource_exists(resource)
+            if exists and not (upsert or self._has_newer_version(resource)):
+                continue
+            if self._projection and not projected:
+                resource = self._projection.project(resource)
+                if resource is None:
+                    continue
+            if resource_references is None:
+                resource_references = get_reference_strings(resource)
+            if exists:
+                updated_resources.append((resource, full_url, resource_references))
+                continue
+            new_resources.append(resource)
+            new_full_urls.append(full_url)
+            new_references.append(resource_references)
+        changed_patient_ids = set()
+        if new_resources:
+            for resource in new_resources:
+                self._storage.add_resource(resource)
+            changed_patient_ids |= self._update_patient_dicts(
+                new_resources, new_full_urls, new_references
+            )
+        for resource, full_url, resource_references in updated_resources:
+            changed_patient_ids |= self._update_resource(
+                resource, full_url, resource_references
+            )
+        if new_resources or updated_resources:
+            self._storage.flush()
+            self._notify(changed_patient_ids)
+
+    def _has_newer_version(self, resource: dict) -> bool:
+        meta = resource.get("meta", {})
+        if "versionId" not in meta and "lastUpdated" not in meta:
+            return False
+        existing_resource = self._storage.get_resource(
+            resource["resourceType"], resource["id"]
+        )
+        return is_newer_version(resource, existing_resource)
+
     def _resource_exists(self, resource: dict) -> bool:
-        for existing_resource in self._resources:
-            if (
-                existing_resource["id"] == resource["id"]
-                and existing_resource["resourceType"] == resource["resourceType"]
-            ):
-                return True
-        return False
-
-    def validate_bundle_input(self, bundle: dict):
+        return self._storage.has_resource(resource["resourceType"], resource["id"])
+
+    @staticmethod
+    def validate_bundle_input(bundle: dict):
         if not isinstance(bundle, dict):
             raise ValueError("Bundle input is not a dict.")
         if not bundle.get("entry", None):
             raise ValueError("Bundle input does not contain entry.")
 
-    def validate_resources_input(self, resources: list[dict]):
+    @staticmethod
+    def validate_resources_input(resources: list[dict]):
         if not isinstance(resources, list):
             raise ValueError("Input is not a list.")
         if len(resources) == 0:
@@ -1,11 +1,35 @@
+import json
 import math
-from typing import Generator, Iterable
+import re
+from typing import Any, Generator, Iterable, Union
 from urllib.parse import urlparse
 from uuid import UUID
 from fhir.resources.reference import Reference
 
 from fhir_analyzer.constants import RESOURCE_LIST
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_delete_url_pattern = re.compile(r"(?:^|/)([A-Za-z]+)/([A-Za-z0-9\-.]{1,64})$")
+
+
+def get_delete_target(url: str) -> Union[tuple[str, str], None]:
+    """Returns the resource type and id of the url of a DELETE request, or
+    None for conditional deletes (Type?search), which are not supported."""
+    match = _delete_url_pattern.search(url)
+    return match.groups() if match else None
+
+
+def load_json(data: Union[str, bytes]) -> Any:
+    """Parses JSON with orjson if it is installed and falls back to json."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 def get_references_generator(input: Iterable) -> Generator[Reference, None, None]:
     """Returns a generator for all values in a dictionary of the specified key.
@@ -24,6 +48,23 @@ def get_references_generator(input: Iterable) -> Generator[Reference, None, None
                 yield from get_references_generator(v)
 
 
+def get_reference_strings(resource: dict) -> list[str]:
+    """Returns the raw values of all references in a resource without
+    building Reference objects."""
+    result = []
+    stack = [resource]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            reference = item.get("reference", None)
+            if isinstance(reference, str):
+                result.append(reference)
+            stack.extend(v for v in item.values() if isinstance(v, (dict, list)))
+        elif isinstance(item, list):
+            stack.extend(v for v in item if isinstance(v, (dict, list)))
+    return result
+
+
 def gather_references_for_resource(resource: dict) -> list[Reference]:
     result = []
     for reference in get_references_generator(resource):
@@ -68,6 +109,14 @@ def inputs_to_lists(*args):
     return tuple([arg if isinstance(arg, list) else [arg] for arg in args])
 
 
+def get_blocks(items: list, block_size: int) -> Generator[list, None, None]:
+    """Splits a list into consecutive blocks of at most block_size items."""
+    if block_size < 1:
+        raise ValueError("Block size must be at least 1.")
+    for i in range(0, len(items), block_size):
+        yield items[i : i + block_size]
+
+
 def cdf(x, mean, std):
     # Compute the z-score
     z = (x - mean) / std
@@ -0,0 +1,248 @@
+import json
+import mmap
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+from typing import Any, Callable, Iterator, Union
+
+from fhir_analyzer.helper import get_delete_target, get_reference_strings, load_json
+
+ndjson_suffixes = (".ndjson", ".jsonl")
+patient_reference_elements = ["subject", "patient", "beneficiary"]
+
+IndexEntry = namedtuple(
+    "IndexEntry",
+    [
+        "resource_type",
+        "resource_id",
+        "patient_reference",
+        "start",
+        "end",
+        "full_url",
+        "references",
+    ],
+)
+
+_json_decoder = json.JSONDecoder()
+_whitespace_pattern = re.compile(r"[ \t\n\r]*")
+
+# Number of memory maps that are kept open at the same time. Lazy resources
+# of other files reopen their map when they are read.
+max_open_files = 64
+_open_files: "OrderedDict[MappedFile, None]" = OrderedDict()
+_open_files_lock = threading.Lock()
+
+
+def get_patient_reference(resource: dict) -> Union[str, None]:
+    if resource.get("resourceType", None) == "Patient":
+        return f"Patient/{resource.get('id', None)}"
+    for element in patient_reference_elements:
+        value = resource.get(element, None)
+        if isinstance(value, dict) and isinstance(value.get("reference", None), str):
+            return value["reference"]
+    return None
+
+
+def _get_index_entry(
+    resource: dict, start: int, end: int, full_url: Union[str, None]
+) -> IndexEntry:
+    return IndexEntry(
+        resource_type=resource["resourceType"],
+        resource_id=resource["id"],
+        patient_reference=get_patient_reference(resource),
+        start=start,
+        end=end,
+        full_url=full_url,
+        references=get_reference_strings(resource),
+    )
+
+
+def _iter_ndjson_ranges(buffer: mmap.mmap) -> Iterator[tuple[int, int]]:
+    position = 0
+    size = len(buffer)
+    while position < size:
+        end = buffer.find(b"\n", position)
+        end = size if end == -1 else end
+        if buffer[position:end].strip():
+            yield position, end
+        position = end + 1
+
+
+def _skip_whitespace(text: str, index: int) -> int:
+    return _whitespace_pattern.match(text, index).end()
+
+
+def _get_byte_offset_fn(data: bytes, text: str) -> Callable[[int], int]:
+    """Returns a function that maps increasing character offsets of the
+    decoded text to byte offsets of data."""
+    if len(text) == len(data):
+        return lambda index: index
+    position = [0, 0]
+
+    def to_byte_offset(index: int) -> int:
+        position[1] += len(text[position[0] : index].encode("utf-8"))
+        position[0] = index
+        return position[1]
+
+    return to_byte_offset
+
+
+def _iter_bundle_entries(data: bytes) -> Iterator[tuple[int, int, dict]]:
+    """Parses a bundle once and yields the byte range and the parsed object of
+    every entry. The top level object is walked value by value with the C
+    scanner of the json module, which returns where each value ends."""
+    text = data.decode("utf-8")
+    to_byte_offset = _get_byte_offset_fn(data, text)
+    index = _skip_whitespace(text, 0)
+    if text[index : index + 1] != "{":
+        raise ValueError("Bundle is not a JSON object.")
+    index = _skip_whitespace(text, index + 1)
+    while text[index] != "}":
+        if text[index] == ",":
+            index = _skip_whitespace(text, index + 1)
+        key, index = _json_decoder.raw_decode(text, index)
+        index = _skip_whitespace(text, index)
+        if text[index] != ":":
+            raise ValueError(f"Expected ':' at position {index}.")
+        index = _skip_whitespace(text, index + 1)
+        if key == "entry" and text[index] == "[":
+            index = _skip_whitespace(text, index + 1)
+            while text[index] != "]":
+                if text[index] == ",":
+                    index = _skip_whitespace(text, index + 1)
+                entry, end = _json_decoder.raw_decode(text, index)
+                yield to_byte_offset(index), to_byte_offset(end), entry
+                index = _skip_whitespace(text, end)
+            index += 1
+        else:
+            _, index = _json_decoder.raw_decode(text, index)
+        index = _skip_whitespace(text, index)
+
+
+def build_offset_index(path: str) -> tuple[list[IndexEntry], list[tuple[str, str]]]:
+    """Scans a bundle or NDJSON file once and returns an index entry for each
+    resource and the (resource type, id) of DELETE requests in the bundle.
+    Every entry is parsed once during the scan to find its references, but
+    only the index entries are kept."""
+    entries = []
+    deletes = []
+    with open(path, "rb") as f:
+        if f.seek(0, 2) == 0:
+            return entries, deletes
+        if not path.endswith(ndjson_suffixes):
+            f.seek(0)
+            for start, end, entry in _iter_bundle_entries(f.read()):
+                request = entry.get("request", {})
+                if request.get("method", None) == "DELETE":
+                    target = get_delete_target(request.get("url", ""))
+                    if target:
+                        deletes.append(target)
+                elif "resource" in entry:
+                    entries.append(
+                        _get_index_entry(
+                            entry["resource"], start, end, entry.get("fullUrl")
+                        )
+                    )
+            return entries, deletes
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for start, end in _iter_ndjson_ranges(buffer):
+                resource = load_json(buffer[start:end])
+                entries.append(_get_index_entry(resource, start, end, None))
+    return entries, deletes
+
+
+class MappedFile:
+    """Read-only memory map of a bundle or NDJSON file. The map is opened
+    when a resource is read and kept in a least recently used set of at most
+    max_open_files maps, so lazily loaded directories do not hold a file
+    descriptor per file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.is_bundle = not path.endswith(ndjson_suffixes)
+        self._buffer = None
+
+    def load(self, start: int, end: int) -> dict:
+        with _open_files_lock:
+            if self._buffer is None:
+                self._open()
+            _open_files.move_to_end(self)
+            data = self._buffer[start:end]
+        data = load_json(data)
+        return data["resource"] if self.is_bundle else data
+
+    def _open(self):
+        while len(_open_files) >= max_open_files:
+            least_recent, _ = _open_files.popitem(last=False)
+            least_recent._buffer.close()
+            least_recent._buffer = None
+        with open(self.path, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _open_files[self] = None
+
+    def get_resources(self, entries: list[IndexEntry]) -> list["LazyResource"]:
+        return [LazyResource(self, entry) for entry in entries]
+
+    def close(self):
+        """Closes the map. It is opened again if a resource is read."""
+        with _open_files_lock:
+            if self._buffer is not None:
+                _open_files.pop(self, None)
+                self._buffer.close()
+                self._buffer = None
+
+
+class LazyResource(Mapping):
+    """Read-only resource that is parsed from its mapped file the first time
+    an element other than resourceType or id is accessed."""
+
+    __slots__ = ["_file", "_entry", "_resource"]
+
+    def __init__(self, mapped_file: MappedFile, entry: IndexEntry):
+        self._file = mapped_file
+        self._entry = entry
+        self._resource = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._resource is not None
+
+    @property
+    def index_entry(self) -> IndexEntry:
+        return self._entry
+
+    def to_dict(self) -> dict:
+        if self._resource is None:
+            self._resource = self._file.load(self._entry.start, self._entry.end)
+        return self._resource
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "resourceType":
+            return self._entry.resource_type
+        if key == "id":
+            return self._entry.resource_id
+        return self.to_dict()[key]
+
+    def __contains__(self, key: object) -> bool:
+        if key in ("resourceType", "id"):
+            return True
+        return key in self.to_dict()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.to_dict())
+
+    def __len__(self) -> int:
+        return len(self.to_dict())
+
+    def __reduce__(self):
+        return (dict, (self.to_dict(),))
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.is_loaded else "not loaded"
+        return f"LazyResource({self._entry.resource_type}/{self._entry.resource_id}, {state})"
+
+
+def materialize(resource: Mapping) -> dict:
+    """Returns a lazy resource as dict and any other resource unchanged."""
+    return resource.to_dict() if isinstance(resource, LazyResource) else resource
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from typing import Any, Union
+
+
+def get_feature_fingerprint(
+    feature_spec: dict,
+    ontology_version: str,
+    data_fingerprint: str,
+    options: dict = None,
+) -> str:
+    """Returns the cache key of the similarities of one feature."""
+    key_data = {
+        "feature": feature_spec,
+        "ontology_version": ontology_version,
+        "data": data_fingerprint,
+        "options": options if options else {},
+    }
+    return hashlib.sha256(
+        json.dumps(key_data, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class SimilarityCache:
+    """Content addressed on-disk cache of per-feature similarity results.
+    When the directory grows beyond max_bytes, the least recently used
+    entries are removed."""
+
+    file_suffix = ".pkl"
+
+    def __init__(self, directory: str, max_bytes: int = 2**30):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self._directory, f"{key}{self.file_suffix}")
+
+    def get(self, key: str) -> Union[Any, None]:
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(path)
+        return result
+
+    def put(self, key: str, value: Any):
+        file_descriptor, temp_path = tempfile.mkstemp(
+            dir=self._directory, suffix=".tmp"
+        )
+        with os.fdopen(file_descriptor, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self._get_path(key))
+        self._evict()
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._get_path(key))
+
+    @property
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._list_entries())
+
+    def clear(self):
+        for path, _, _ in self._list_entries():
+            os.remove(path)
+
+    def _list_entries(self) -> list[tuple[str, int, float]]:
+        entries = []
+        for file_name in os.listdir(self._directory):
+            if not file_name.endswith(self.file_suffix):
+                continue
+            path = os.path.join(self._directory, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._list_entries(), key=lambda entry: entry[2])
+        total_size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total_size <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
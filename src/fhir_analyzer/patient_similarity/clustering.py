@@ -0,0 +1,157 @@
+import random
+
+import networkx as nx
+
+from fhir_analyzer.patient_similarity.comparator import Comparator
+
+LOUVAIN = "louvain"
+LABEL_PROPAGATION = "label_propagation"
+K_MEDOIDS = "k_medoids"
+
+
+def build_knn_graph(
+    comparator: Comparator,
+    k: int = 10,
+    weights: dict[str, float] = None,
+    patient_ids: list[str] = None,
+    block_size: int = 256,
+) -> nx.Graph:
+    """Builds an undirected graph that connects every patient with its k most
+    similar patients by combined feature similarity. The combined
+    similarities are computed block by block as numpy arrays and only the k
+    best neighbours per patient are kept, so memory grows with the number of
+    patients times k. Neighbours without a positive similarity are left
+    out."""
+    patient_ids = (
+        list(comparator._feature_dict.keys()) if patient_ids is None else patient_ids
+    )
+    graph = nx.Graph()
+    graph.add_nodes_from(patient_ids)
+    neighbours = comparator.compute_combined_similarities(
+        patient_ids,
+        patient_ids,
+        weights=weights,
+        top_k=k,
+        block_size=block_size,
+        output_dict=True,
+    )
+    for patient_id, rows in neighbours.items():
+        for other_id, similarity in rows:
+            if similarity <= 0:
+                continue
+            if (
+                not graph.has_edge(patient_id, other_id)
+                or graph[patient_id][other_id]["weight"] < similarity
+            ):
+                graph.add_edge(patient_id, other_id, weight=similarity)
+    return graph
+
+
+def cluster_graph(
+    graph: nx.Graph,
+    method: str = LOUVAIN,
+    n_clusters: int = None,
+    resolution: float = 1.0,
+    seed: int = None,
+    max_iter: int = 100,
+) -> dict[str, int]:
+    """Clusters the patients of a similarity graph and returns a mapping from
+    patient id to cluster label."""
+    if method == LOUVAIN:
+        communities = nx.community.louvain_communities(
+            graph, weight="weight", resolution=resolution, seed=seed
+        )
+    elif method == LABEL_PROPAGATION:
+        communities = nx.community.asyn_lpa_communities(
+            graph, weight="weight", seed=seed
+        )
+    elif method == K_MEDOIDS:
+        if not n_clusters:
+            raise ValueError("n_clusters is required for k-medoids clustering.")
+        return k_medoids(graph, n_clusters, seed=seed, max_iter=max_iter)
+    else:
+        raise ValueError(f"Unknown clustering method: {method}")
+    communities = sorted(communities, key=lambda c: (-len(c), sorted(c)[0]))
+    return {
+        patient_id: label
+        for label, community in enumerate(communities)
+        for patient_id in community
+    }
+
+
+def k_medoids(
+    graph: nx.Graph, n_clusters: int, seed: int = None, max_iter: int = 100
+) -> dict[str, int]:
+    """k-medoids on a sparse similarity graph. Patients are assigned to the
+    most similar neighbouring medoid, patients without one take the label of
+    their most similar labelled neighbour. Medoids are chosen by the summed
+    similarity to their cluster members along graph edges. Patients that are
+    not connected to any medoid keep the label -1."""
+    nodes = sorted(graph.nodes)
+    if n_clusters > len(nodes):
+        raise ValueError(
+            f"n_clusters ({n_clusters}) is larger than the number of patients ({len(nodes)})."
+        )
+    medoids = random.Random(seed).sample(nodes, n_clusters)
+    labels = {}
+    for _ in range(max_iter):
+        labels = _assign_to_medoids(graph, medoids)
+        members = {}
+        for node, label in labels.items():
+            members.setdefault(label, []).append(node)
+        new_medoids = []
+        for label, medoid in enumerate(medoids):
+            new_medoids.append(
+                max(
+                    members[label],
+                    key=lambda node: (
+                        sum(
+                            data["weight"]
+                            for neighbour, data in graph[node].items()
+                            if labels[neighbour] == label
+                        ),
+                        node == medoid,
+                    ),
+                )
+            )
+        if new_medoids == medoids:
+            break
+        medoids = new_medoids
+    return labels
+
+
+def _assign_to_medoids(graph: nx.Graph, medoids: list[str]) -> dict[str, int]:
+    medoid_labels = {medoid: label for label, medoid in enumerate(medoids)}
+    labels = {}
+    for node in graph.nodes:
+        if node in medoid_labels:
+            labels[node] = medoid_labels[node]
+            continue
+        best = max(
+            (
+                (data["weight"], -medoid_labels[neighbour])
+                for neighbour, data in graph[node].items()
+                if neighbour in medoid_labels
+            ),
+            default=None,
+        )
+        labels[node] = -best[1] if best else -1
+    unlabelled = [node for node, label in labels.items() if label == -1]
+    while unlabelled:
+        new_labels = {}
+        for node in unlabelled:
+            best = max(
+                (
+                    (data["weight"], -labels[neighbour])
+                    for neighbour, data in graph[node].items()
+                    if labels[neighbour] != -1
+                ),
+                default=None,
+            )
+            if best:
+                new_labels[node] = -best[1]
+        if not new_labels:
+            break
+        labels.update(new_labels)
+        unlabelled = [node for node in unlabelled if node not in new_labels]
+    return labels
@@ -1,16 +1,38 @@
-import pickle
+import heapq
 import statistics
-import re
-import pkg_resources
+import sys
+import time
+from typing import Any, Callable, Generator, Union
 
 
 from nxontology import NXOntology
 import networkx as nx
+import numpy as np
 import pandas as pd
 
 from fhir_analyzer.feature_selector import FeatureSelector
-from fhir_analyzer.helper import cdf
+from fhir_analyzer.helper import cdf, get_blocks
+from fhir_analyzer.progress import (
+    COMPARISON,
+    CancellationToken,
+    Progress,
+    ProgressTracker,
+)
 
+from fhir_analyzer.patient_similarity.ontologies import (
+    get_ontology,
+    normalize_code,
+    resolve_system,
+)
+from fhir_analyzer.patient_similarity.sampling import (
+    CODE,
+    COVERAGE,
+    get_code_strata,
+    get_coverage_strata,
+    stratified_sample,
+    summarize_sample_similarities,
+)
+from fhir_analyzer.patient_similarity.stats import FeatureStats
 from fhir_analyzer.patient_similarity.internal_types import (
     CATEGORICAL_STRING,
     CODED_CONCEPT,
@@ -20,38 +42,74 @@ from fhir_analyzer.patient_similarity.internal_types import (
     Numerical,
     CodedConcept,
     CodedNumerical,
+    ConceptProfile,
 )
 
-SNOMED = "snomed"
-ICD10 = "ICD-10"
-LOINC = "LOINC"
-RXNORM = "RxNorm"
-UCUM = "UCUM"
-ICD9 = "ICD-9"
+# Aggregations of the best match similarities of two concept profiles.
+MAX_AGGREGATION = "max"
+BEST_MATCH_AVERAGE = "best_match_average"
+FREQUENCY_WEIGHTED = "frequency_weighted"
+coded_concept_aggregations = [MAX_AGGREGATION, BEST_MATCH_AVERAGE, FREQUENCY_WEIGHTED]
 
-SNOMED_GRAPH_NAME = "snomed_cc_graph.adjlist"
-ICD10_GRAPH_NAME = "icd10_cc_graph.gpickle"
+# Treatment of missing feature similarities when they are combined.
+SKIP_MISSING = "skip"
+ZERO_MISSING = "zero"
+PROPAGATE_MISSING = "propagate"
+missing_policies = [SKIP_MISSING, ZERO_MISSING, PROPAGATE_MISSING]
 
 
-def load_nx_graph(
-    name: str,
-):
-    G = pickle.load(
-        pkg_resources.resource_stream(
-            "fhir_analyzer.patient_similarity", f"nx_graphs/{name}.gpickle"
-        )
-    )
-    G = NXOntology(G)
-    G.freeze()
-    print(
-        f"Loaded {name} graph with {len(G.graph.nodes)} nodes and {len(G.graph.edges)} edges."
+def get_missing_policy(
+    missing: Union[str, float, dict[str, Union[str, float]]], feat_name: str
+) -> Union[str, float]:
+    policy = (
+        missing.get(feat_name, SKIP_MISSING) if isinstance(missing, dict) else missing
     )
-    return G
+    if policy not in missing_policies and not isinstance(policy, (int, float)):
+        raise ValueError(f"Unknown missing value policy: {policy}")
+    return policy
+
+
+def combine_feature_similarities(
+    similarities: dict[str, Union[float, None]],
+    weights: dict[str, float] = None,
+    missing: Union[str, float, dict[str, Union[str, float]]] = SKIP_MISSING,
+) -> Union[float, None]:
+    """Returns the weighted mean of the feature similarities of a patient pair.
+    missing sets how a missing (None) similarity is treated, for all features
+    or per feature: skip leaves it out, zero counts it as 0, propagate makes
+    the overall similarity missing and a number is used in its place. None is
+    returned if all similarities are left out."""
+    total = 0.0
+    normalizer = 0.0
+    for feat_name, similarity in similarities.items():
+        weight = weights.get(feat_name, 1.0) if weights else 1.0
+        if similarity is None:
+            policy = get_missing_policy(missing, feat_name)
+            if policy == SKIP_MISSING:
+                continue
+            if policy == PROPAGATE_MISSING:
+                return None
+            similarity = 0.0 if policy == ZERO_MISSING else float(policy)
+        total += weight * similarity
+        normalizer += weight
+    return total / normalizer if normalizer else None
 
 
 class Comparator:
-    def __init__(self, feature_selector: FeatureSelector = None):
+    def __init__(
+        self,
+        feature_selector: FeatureSelector = None,
+        robust: bool = False,
+        coded_concept_aggregation: str = MAX_AGGREGATION,
+    ):
+        if coded_concept_aggregation not in coded_concept_aggregations:
+            raise ValueError(
+                f"Unknown coded concept aggregation: {coded_concept_aggregation}"
+            )
         self._feature_selector = feature_selector
+        self._robust = robust
+        self._coded_concept_aggregation = coded_concept_aggregation
+        self._feature_types = dict(feature_selector._feature_types)
         self._numerical_stats = {}
         self._coded_numerical_stats = {}
         self._feature_dict = {}
@@ -65,6 +123,22 @@ class Comparator:
             CODED_NUMERICAL: self.compare_coded_numerical,
         }
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_feature_selector"] = None
+        state["_nx_graphs"] = {}
+        del state["_sim_fns"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._sim_fns = {
+            CATEGORICAL_STRING: self.compare_categorical,
+            NUMERICAL: self.compare_numerical,
+            CODED_CONCEPT: self.compare_coded_concepts,
+            CODED_NUMERICAL: self.compare_coded_numerical,
+        }
+
     def compare_categorical(
         self, feature1: list[CategoricalString], feature2: list[CategoricalString]
     ):
@@ -97,15 +171,23 @@ class Comparator:
 
     def compare_coded_concepts(
         self,
-        feature1: list[CodedConcept],
-        feature2: list[CodedConcept],
+        feature1: ConceptProfile,
+        feature2: ConceptProfile,
         ic_metric: str = "intrinsic_ic_sanchez",
         cs_metric: str = "lin",
+        aggregation: str = None,
     ):
+        """Compares two concept profiles by the best match of each distinct
+        code in the other profile. With max aggregation the similarity is the
+        sum of the highest best match in both directions divided by the number
+        of records. best_match_average averages the best matches over the
+        distinct codes, frequency_weighted weights them by their number of
+        records."""
         if len(feature1) == 0 or len(feature2) == 0:
             return None
-        system = feature1[0].system
-        system = self._resolve_system(system=system)
+        aggregation = aggregation if aggregation else self._coded_concept_aggregation
+        system = feature1.system
+        self._get_ontology(system)
 
         node_sim_ab = self.calculate_node_similarities(
             feature1, feature2, system, ic_metric, cs_metric
@@ -117,34 +199,46 @@ class Comparator:
         if not node_sim_ab or not node_sim_ba:
             return 0
 
-        factor = 1 / (len(node_sim_ab) + len(node_sim_ba))
-        result = factor * (max(node_sim_ab, default=0) + max(node_sim_ba, default=0))
-        return result
+        if aggregation == MAX_AGGREGATION:
+            factor = 1 / (feature1.n_records + feature2.n_records)
+            return factor * (
+                max(node_sim_ab.values(), default=0)
+                + max(node_sim_ba.values(), default=0)
+            )
+        if aggregation == BEST_MATCH_AVERAGE:
+            return (sum(node_sim_ab.values()) + sum(node_sim_ba.values())) / (
+                len(node_sim_ab) + len(node_sim_ba)
+            )
+        if aggregation == FREQUENCY_WEIGHTED:
+            total = sum(
+                feature1.counts[code] * sim for code, sim in node_sim_ab.items()
+            ) + sum(feature2.counts[code] * sim for code, sim in node_sim_ba.items())
+            return total / (feature1.n_records + feature2.n_records)
+        raise ValueError(f"Unknown coded concept aggregation: {aggregation}")
 
     def calculate_node_similarities(
         self,
-        feature1: list[CodedConcept],
-        feature2: list[CodedConcept],
+        feature1: ConceptProfile,
+        feature2: ConceptProfile,
         system: str,
         ic_metric: str,
         cs_metric: str,
-    ) -> list[float]:
-        node_sim = []
-        for f1 in feature1:
-            code_a = f1.code
+    ) -> dict[str, float]:
+        """Returns the best match in feature2 for each distinct code of
+        feature1."""
+        ontology = self._nx_graphs[system]
+        node_sim = {}
+        for code_a in feature1.counts:
             node_sim_ab = []
-            for f2 in feature2:
-                code_b = f2.code
+            for code_b in feature2.counts:
                 similarity = None
                 try:
-                    similarity = self._nx_graphs[system].similarity(
-                        code_a, code_b, ic_metric
-                    )
+                    similarity = ontology.similarity(code_a, code_b, ic_metric)
                 except nx.NodeNotFound:
                     continue
                 similarity = getattr(similarity, cs_metric)
                 node_sim_ab.append(similarity)
-            node_sim.append(max(node_sim_ab, default=0))
+            node_sim[code_a] = max(node_sim_ab, default=0)
         return node_sim
 
     def compare_coded_numerical_pair(
@@ -191,66 +285,28 @@ class Comparator:
         return statistics.mean(similarities) if similarities else None
 
     def _add_type_data(self):
-        for name, type in self._feature_selector._feature_types.items():
-            if type == NUMERICAL:
-                self._add_numerical_type_data(name)
-            elif type == CODED_NUMERICAL:
-                self._add_coded_numerical_type_data(name)
-
-    def _add_numerical_type_data(self, name):
-        values = []
-        numerical_stats = {name: {"min_value": None, "max_value": None}}
-        for _, features_dic in self._feature_selector._patient_features.items():
-            for n, features in features_dic.items():
-                if name == n:
-                    for feature in features:
-                        value = feature["value"]
-                        if value is not None:
-                            values.append(feature["value"])
-        if values:
-            min_value = min(values)
-            max_value = max(values)
-            numerical_stats[name].update(
-                {
-                    "min_value": min_value,
-                    "max_value": max_value,
-                }
-            )
-        self._numerical_stats.update(numerical_stats)
-
-    def _add_coded_numerical_type_data(self, name):
-        code_values = {}
-        code_stats = {name: {}}
-        for _, features_dic in self._feature_selector._patient_features.items():
-            for n, features in features_dic.items():
-                if n == name:
-                    for feature in features:
-                        code = feature["code"]
-                        value = feature["value"]
-                        if code not in code_values:
-                            code_values[code] = []
-                        if value:
-                            value = float(value)
-                            code_values[code].append(value)
-        for code, values in code_values.items():
-            if code and len(values) > 1:
-                code_stats[name][code] = {
-                    "mean": statistics.mean(values),
-                    "std_dev": statistics.stdev(values),
-                }
-            else:
-                code_stats[name][code] = {"mean": None, "std_dev": None}
-        self._coded_numerical_stats.update(code_stats)
+        self._feature_stats = FeatureStats.from_patient_features(
+            self._feature_selector._patient_features,
+            self._feature_types,
+            quantiles=self._robust,
+        )
+        self._numerical_stats.update(
+            self._feature_stats.get_numerical_stats(robust=self._robust)
+        )
+        self._coded_numerical_stats.update(
+            self._feature_stats.get_coded_numerical_stats(robust=self._robust)
+        )
 
     def _build_feature_dict(self):
         updated_feature_dic = {}
+        interned = {}
         for (
             patient_id,
             features_dic,
         ) in self._feature_selector._patient_features.items():
             updated_feature_dic[patient_id] = {}
             for name, features in features_dic.items():
-                if self._feature_selector._feature_types[name] == NUMERICAL:
+                if self._feature_types[name] == NUMERICAL:
                     parsed_features = [
                         Numerical(
                             value=float(feature["value"]),
@@ -263,7 +319,7 @@ class Comparator:
                         and self._numerical_stats[name]["min_value"] is not None
                         and self._numerical_stats[name]["max_value"] is not None
                     ]
-                elif self._feature_selector._feature_types[name] == CODED_NUMERICAL:
+                elif self._feature_types[name] == CODED_NUMERICAL:
                     parsed_features = [
                         CodedNumerical(
                             code=feature["code"],
@@ -289,17 +345,19 @@ class Comparator:
                         ]
                         is not None
                     ]
-                elif self._feature_selector._feature_types[name] == CODED_CONCEPT:
-                    parsed_features = [
-                        CodedConcept(
-                            code=feature["code"],
-                            system=feature["system"],
-                            feature_name=name,
-                        )
-                        for feature in features
-                        if feature["code"] is not None and feature["system"] is not None
-                    ]
-                elif self._feature_selector._feature_types[name] == CATEGORICAL_STRING:
+                elif self._feature_types[name] == CODED_CONCEPT:
+                    parsed_features = ConceptProfile.from_coded_concepts(
+                        [
+                            self._get_coded_concept(
+                                feature["code"], feature["system"], name, interned
+                            )
+                            for feature in features
+                            if feature["code"] is not None
+                            and feature["system"] is not None
+                        ],
+                        feature_name=name,
+                    )
+                elif self._feature_types[name] == CATEGORICAL_STRING:
                     parsed_features = [
                         CategoricalString(
                             value=feature["value"],
@@ -311,25 +369,54 @@ class Comparator:
                 updated_feature_dic[patient_id].update({name: parsed_features})
         self._feature_dict.update(updated_feature_dic)
 
-    def _compute_similarities(self, output_dict=False):
+    @staticmethod
+    def _get_coded_concept(
+        code: str, system: str, feature_name: str, interned: dict
+    ) -> CodedConcept:
+        """Resolves the system and normalizes the code once per distinct
+        value, so comparisons only see resolved and interned strings."""
+        key = (code, system)
+        if key not in interned:
+            resolved_system = resolve_system(system)
+            interned[key] = (
+                sys.intern(normalize_code(resolved_system, code)),
+                resolved_system,
+            )
+        code, system = interned[key]
+        return CodedConcept(code=code, system=system, feature_name=feature_name)
+
+    def _compute_similarities(
+        self,
+        output_dict=False,
+        feature_names: list[str] = None,
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
+    ):
+        """Computes the similarities of all patient pairs, one patient row at a
+        time. progress is called with the number of finished rows. If cancel
+        is cancelled, OperationCancelled is raised with the finished rows as
+        partial_result."""
         sim_df_data = {}
-        result_dict = {}
+        patient_ids = list(self._feature_dict.keys())
+        tracker = ProgressTracker(COMPARISON, len(patient_ids), progress, cancel)
         for patient_id1, feature_dic1 in self._feature_dict.items():
-            for feat_name, features in feature_dic1.items():
-                feat_type = self._feature_selector._feature_types[feat_name]
-                sim_fn = self._sim_fns[feat_type]
+            if tracker.is_cancelled:
+                tracker.check(self._format_similarities(sim_df_data, output_dict))
+            for feat_name in feature_dic1.keys():
+                if feature_names is not None and feat_name not in feature_names:
+                    continue
                 sim_df_data.setdefault(feat_name, {})
-                if patient_id1 not in sim_df_data[feat_name]:
-                    sim_df_data[feat_name][patient_id1] = {}
-                for patient_id2, feature_dic2 in self._feature_dict.items():
-                    if patient_id2 not in sim_df_data[feat_name][patient_id1]:
-                        sim_df_data[feat_name][patient_id1][patient_id2] = {}
-                    if patient_id1 == patient_id2:
-                        sim_df_data[feat_name][patient_id1][patient_id2] = 1
-                    else:
-                        sim_df_data[feat_name][patient_id1][patient_id2] = sim_fn(
-                            features, feature_dic2[feat_name]
-                        )
+                sim_df_data[feat_name][patient_id1] = self._compare_patient(
+                    patient_id1, patient_ids, feat_name
+                )
+            tracker.update()
+        return self._format_similarities(sim_df_data, output_dict)
+
+    @staticmethod
+    def _format_similarities(
+        sim_df_data: dict[str, dict], output_dict: bool
+    ) -> dict[str, Union[pd.DataFrame, dict]]:
+        result_dict = {}
         for feat_name, data in sim_df_data.items():
             if output_dict:
                 result_dict.update({feat_name: data})
@@ -337,24 +424,298 @@ class Comparator:
                 result_dict.update({feat_name: pd.DataFrame(data)})
         return result_dict
 
-    def _resolve_system(self, system: str):
-        system = re.sub(r"\W+", "", system)
-        system = system.lower()
-        resolved_system = None
-        if "snomed" in system:
-            resolved_system = SNOMED
-        elif "icd10" in system:
-            resolved_system = ICD10
-        elif "loinc" in system:
-            resolved_system = LOINC
-        elif "rxnorm" in system:
-            resolved_system = RXNORM
-        elif "ucum" in system:
-            resolved_system = UCUM
-        elif "icd9" in system:
-            resolved_system = ICD9
+    def compute_anytime_similarities(
+        self,
+        time_budget: float,
+        priority: Union[list[str], dict[str, float]] = None,
+        reference_ids: list[str] = None,
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
+        output_dict: bool = False,
+    ) -> dict[str, Union[dict, list[str]]]:
+        """Computes patient rows in order of priority until time_budget seconds
+        have passed and returns the finished rows. priority is a list of
+        patient ids in order or a mapping of patient ids to scores, highest
+        first. Patients without a priority follow in their usual order. The
+        rows are returned like Comparator._compute_similarities, along with
+        the completed and pending patient ids."""
+        reference_ids = (
+            list(self._feature_dict.keys()) if reference_ids is None else reference_ids
+        )
+        self._validate_patient_ids(reference_ids)
+        if isinstance(priority, dict):
+            priority = sorted(priority, key=lambda i: priority[i], reverse=True)
+        priority = list(priority) if priority else []
+        self._validate_patient_ids(priority)
+        prioritized = set(priority)
+        query_ids = priority + [i for i in self._feature_dict if i not in prioritized]
+        deadline = time.monotonic() + time_budget
+        tracker = ProgressTracker(COMPARISON, len(query_ids), progress, cancel)
+        sim_df_data = {}
+        completed_ids = []
+        for patient_id in query_ids:
+            if time.monotonic() >= deadline or tracker.is_cancelled:
+                break
+            row = self._compute_block([patient_id], reference_ids, output_dict=True)
+            for feat_name, data in row.items():
+                sim_df_data.setdefault(feat_name, {}).update(data)
+            completed_ids.append(patient_id)
+            tracker.update()
+        result = {
+            "similarities": self._format_similarities(sim_df_data, output_dict),
+            "completed_ids": completed_ids,
+            "pending_ids": query_ids[len(completed_ids) :],
+        }
+        tracker.check(result)
+        return result
+
+    def compute_block_similarities(
+        self,
+        query_ids: list[str],
+        reference_ids: list[str] = None,
+        query_block_size: int = 256,
+        reference_block_size: int = None,
+        output_dict: bool = False,
+    ) -> Generator[dict[str, Union[pd.DataFrame, dict]], None, None]:
+        """Yields the similarities between the query and the reference patients
+        tile by tile. Each tile maps feature names to a frame with the query
+        patients as index and the reference patients as columns. Normalization
+        stats always come from all patients of the feature selector."""
+        reference_ids = (
+            list(self._feature_dict.keys()) if reference_ids is None else reference_ids
+        )
+        self._validate_patient_ids(query_ids)
+        self._validate_patient_ids(reference_ids)
+        reference_block_size = (
+            reference_block_size if reference_block_size else len(reference_ids)
+        )
+        for query_block in get_blocks(query_ids, query_block_size):
+            for reference_block in get_blocks(reference_ids, reference_block_size):
+                yield self._compute_block(query_block, reference_block, output_dict)
+
+    def _compute_block(
+        self,
+        query_ids: list[str],
+        reference_ids: list[str],
+        output_dict: bool = False,
+    ) -> dict[str, Union[pd.DataFrame, dict]]:
+        result_dict = {}
+        for feat_name, feat_type in self._feature_types.items():
+            if feat_type not in self._sim_fns:
+                continue
+            data = {
+                patient_id: self._compare_patient(patient_id, reference_ids, feat_name)
+                for patient_id in query_ids
+            }
+            if output_dict:
+                result_dict[feat_name] = data
+            else:
+                result_dict[feat_name] = pd.DataFrame.from_dict(
+                    data, orient="index", columns=reference_ids
+                )
+        return result_dict
+
+    def compute_combined_similarities(
+        self,
+        query_ids: list[str] = None,
+        reference_ids: list[str] = None,
+        weights: dict[str, float] = None,
+        missing: Union[str, float, dict[str, Union[str, float]]] = SKIP_MISSING,
+        top_k: int = None,
+        block_size: int = 256,
+        output_dict: bool = False,
+    ) -> Union[pd.DataFrame, dict]:
+        """Computes the weighted overall similarity of the query and the
+        reference patients without keeping a matrix per feature. The weighted
+        sum and the normalizer are accumulated feature by feature for one block
+        of query patients at a time. Features with weight 0 are not compared,
+        missing works as in combine_feature_similarities.
+
+        Returns a frame with the query patients as index and the reference
+        patients as columns. With top_k only the top_k most similar other
+        patients of each query patient are kept, as a frame with the columns
+        patient_id, other_id and similarity, or as a dict of (other_id,
+        similarity) lists with output_dict."""
+        query_ids = list(self._feature_dict.keys()) if query_ids is None else query_ids
+        reference_ids = query_ids if reference_ids is None else reference_ids
+        self._validate_patient_ids(query_ids)
+        self._validate_patient_ids(reference_ids)
+        weights = weights if weights else {}
+        unknown_features = set(weights).difference(self._feature_types)
+        if unknown_features:
+            raise ValueError(f"Unknown features: {sorted(unknown_features)}")
+        feature_weights = {
+            feat_name: weights.get(feat_name, 1.0)
+            for feat_name, feat_type in self._feature_types.items()
+            if feat_type in self._sim_fns and weights.get(feat_name, 1.0) != 0
+        }
+        policies = {
+            feat_name: get_missing_policy(missing, feat_name)
+            for feat_name in feature_weights
+        }
+        combined = (
+            None
+            if top_k
+            else np.empty((len(query_ids), len(reference_ids)), dtype=np.float64)
+        )
+        neighbours = {}
+        for block_start in range(0, len(query_ids), block_size):
+            block_ids = query_ids[block_start : block_start + block_size]
+            block = self._compute_combined_block(
+                block_ids, reference_ids, feature_weights, policies
+            )
+            if top_k:
+                neighbours.update(
+                    self._get_top_k(block_ids, reference_ids, block, top_k)
+                )
+            else:
+                combined[block_start : block_start + len(block_ids)] = block
+        if top_k:
+            if output_dict:
+                return neighbours
+            return pd.DataFrame(
+                [
+                    (patient_id, other_id, similarity)
+                    for patient_id, rows in neighbours.items()
+                    for other_id, similarity in rows
+                ],
+                columns=["patient_id", "other_id", "similarity"],
+            )
+        if output_dict:
+            return {
+                patient_id: {
+                    other_id: None if np.isnan(value) else float(value)
+                    for other_id, value in zip(reference_ids, row)
+                }
+                for patient_id, row in zip(query_ids, combined)
+            }
+        return pd.DataFrame(combined, index=query_ids, columns=reference_ids)
+
+    def _compute_combined_block(
+        self,
+        query_ids: list[str],
+        reference_ids: list[str],
+        feature_weights: dict[str, float],
+        policies: dict[str, Union[str, float]],
+    ) -> np.ndarray:
+        shape = (len(query_ids), len(reference_ids))
+        total = np.zeros(shape, dtype=np.float64)
+        normalizer = np.zeros(shape, dtype=np.float64)
+        propagated = np.zeros(shape, dtype=bool)
+        for feat_name, weight in feature_weights.items():
+            values = np.array(
+                [
+                    list(
+                        self._compare_patient(
+                            patient_id, reference_ids, feat_name
+                        ).values()
+                    )
+                    for patient_id in query_ids
+                ],
+                dtype=np.float64,
+            ).reshape(shape)
+            is_missing = np.isnan(values)
+            policy = policies[feat_name]
+            if policy == SKIP_MISSING:
+                total += weight * np.where(is_missing, 0.0, values)
+                normalizer += weight * ~is_missing
+                continue
+            if policy == PROPAGATE_MISSING:
+                propagated |= is_missing
+                fill_value = 0.0
+            else:
+                fill_value = 0.0 if policy == ZERO_MISSING else float(policy)
+            total += weight * np.where(is_missing, fill_value, values)
+            normalizer += weight
+        with np.errstate(divide="ignore", invalid="ignore"):
+            combined = np.where(normalizer != 0, total / normalizer, np.nan)
+        combined[propagated] = np.nan
+        return combined
+
+    @staticmethod
+    def _get_top_k(
+        query_ids: list[str], reference_ids: list[str], block: np.ndarray, k: int
+    ) -> dict[str, list[tuple[str, float]]]:
+        neighbours = {}
+        for patient_id, row in zip(query_ids, block):
+            candidates = [
+                (similarity, other_id)
+                for similarity, other_id in zip(row.tolist(), reference_ids)
+                if other_id != patient_id and not np.isnan(similarity)
+            ]
+            neighbours[patient_id] = [
+                (other_id, similarity)
+                for similarity, other_id in heapq.nlargest(k, candidates)
+            ]
+        return neighbours
+
+    def compute_sample_similarities(
+        self,
+        sample_size: int = 200,
+        stratify_by: str = COVERAGE,
+        feature_name: str = None,
+        seed: int = 0,
+        confidence: float = 0.95,
+        output_dict: bool = False,
+    ) -> dict[str, Union[list[str], dict, pd.DataFrame]]:
+        """Computes the similarities between a reproducible stratified sample
+        of patients only. Patients are stratified by the features they have
+        values for (coverage) or by their most frequent code of feature_name
+        (code). The summary estimates the mean similarity of each feature
+        over all patients with a confidence interval."""
+        patient_features = self._feature_selector._patient_features
+        if stratify_by == COVERAGE:
+            strata = get_coverage_strata(patient_features)
+        elif stratify_by == CODE:
+            if feature_name not in self._feature_types:
+                raise ValueError(f"Unknown feature: {feature_name}")
+            strata = get_code_strata(patient_features, feature_name)
         else:
-            raise ValueError(f"Unknown system: {resolved_system}")
-        if resolved_system not in self._nx_graphs:
-            self._nx_graphs[resolved_system] = load_nx_graph(name=resolved_system)
+            raise ValueError(f"Unknown stratification: {stratify_by}")
+        sample_ids = stratified_sample(strata, sample_size, seed=seed)
+        similarities = self._compute_block(sample_ids, sample_ids, output_dict=True)
+        return {
+            "patient_ids": sample_ids,
+            "similarities": (
+                similarities
+                if output_dict
+                else {
+                    feat_name: pd.DataFrame(data)
+                    for feat_name, data in similarities.items()
+                }
+            ),
+            "summary": summarize_sample_similarities(
+                similarities, strata, confidence=confidence
+            ),
+        }
+
+    def _compare_patient(
+        self, patient_id: str, other_ids: list[str], feat_name: str
+    ) -> dict[str, float]:
+        sim_fn = self._sim_fns[self._feature_types[feat_name]]
+        features = self._feature_dict[patient_id].get(feat_name, [])
+        result = {}
+        for other_id in other_ids:
+            if patient_id == other_id:
+                result[other_id] = 1
+            else:
+                result[other_id] = sim_fn(
+                    features, self._feature_dict[other_id].get(feat_name, [])
+                )
+        return result
+
+    def _validate_patient_ids(self, patient_ids: list[str]):
+        unknown_ids = [i for i in patient_ids if i not in self._feature_dict]
+        if unknown_ids:
+            raise ValueError(f"Unknown patient ids: {unknown_ids}")
+
+    def _get_ontology(self, system: str) -> NXOntology:
+        """Returns the ontology of a resolved system."""
+        if system not in self._nx_graphs:
+            self._nx_graphs[system] = get_ontology(system)
+        return self._nx_graphs[system]
+
+    def _resolve_system(self, system: str):
+        resolved_system = resolve_system(system)
+        self._get_ontology(resolved_system)
         return resolved_system
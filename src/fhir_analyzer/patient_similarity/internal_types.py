@@ -17,6 +17,35 @@ class CodedConcept:
         return f"CodedConcept({self.code}, {self.system})"
 
 
+class ConceptProfile:
+    """Distinct codes of a coded concept feature of a patient with the number
+    of records of each code. The length is the number of records."""
+
+    def __init__(
+        self, system: Union[str, None], counts: dict[str, int], feature_name: str
+    ):
+        self.system = system
+        self.counts = counts
+        self.n_records = sum(counts.values())
+        self.feature_name = feature_name
+
+    @classmethod
+    def from_coded_concepts(
+        cls, concepts: list[CodedConcept], feature_name: str
+    ) -> "ConceptProfile":
+        counts = {}
+        for concept in concepts:
+            counts[concept.code] = counts.get(concept.code, 0) + 1
+        system = concepts[0].system if concepts else None
+        return cls(system=system, counts=counts, feature_name=feature_name)
+
+    def __len__(self):
+        return self.n_records
+
+    def __str__(self):
+        return f"ConceptProfile({self.system}, {self.counts})"
+
+
 class CategoricalString:
     def __init__(self, value: str, feature_name: str):
         self.value = value
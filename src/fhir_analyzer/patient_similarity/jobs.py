@@ -0,0 +1,204 @@
+import json
+import os
+import pickle
+import socket
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union
+
+import pandas as pd
+
+from fhir_analyzer.helper import get_blocks
+from fhir_analyzer.patient_similarity.comparator import Comparator
+
+
+def _run_job_worker(directory: str, comparator: Comparator, worker_id: str) -> int:
+    return SimilarityJob(directory).run(comparator, worker_id=worker_id)
+
+
+class SimilarityJob:
+    """Sharded similarity computation on shared storage.
+
+    The patient x patient matrix is split into row blocks (tiles) that are
+    listed in a manifest. Workers claim tiles with lock files, write each
+    finished tile to disk and skip tiles that are already done, so an
+    interrupted job resumes where it stopped. Several processes or machines
+    can work on the same job directory."""
+
+    manifest_name = "manifest.json"
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        with open(self._get_path(self.manifest_name), "r") as f:
+            self._manifest = json.load(f)
+
+    @classmethod
+    def create(
+        cls,
+        directory: str,
+        patient_ids: list[str],
+        block_size: int = 256,
+        fingerprint: str = None,
+    ) -> "SimilarityJob":
+        """Creates a job or opens the existing job in the directory. An
+        existing job must have the same patients, block size and fingerprint."""
+        os.makedirs(directory, exist_ok=True)
+        manifest = {
+            "patient_ids": patient_ids,
+            "block_size": block_size,
+            "fingerprint": fingerprint,
+            "tiles": [
+                {"id": i, "start": start, "stop": start + len(block)}
+                for i, (start, block) in enumerate(
+                    zip(
+                        range(0, len(patient_ids), block_size),
+                        get_blocks(patient_ids, block_size),
+                    )
+                )
+            ],
+        }
+        manifest_path = os.path.join(directory, cls.manifest_name)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                existing_manifest = json.load(f)
+            if existing_manifest != manifest:
+                raise ValueError(
+                    f"A different similarity job already exists in {directory}."
+                )
+        else:
+            _write_atomic(manifest_path, json.dumps(manifest).encode(), directory)
+        return cls(directory)
+
+    @property
+    def patient_ids(self) -> list[str]:
+        return self._manifest["patient_ids"]
+
+    @property
+    def tiles(self) -> list[dict]:
+        return self._manifest["tiles"]
+
+    @property
+    def pending_tiles(self) -> list[dict]:
+        return [tile for tile in self.tiles if not self.is_tile_done(tile)]
+
+    @property
+    def is_complete(self) -> bool:
+        return not self.pending_tiles
+
+    def is_tile_done(self, tile: dict) -> bool:
+        return os.path.exists(self._get_tile_path(tile))
+
+    def _get_path(self, file_name: str) -> str:
+        return os.path.join(self._directory, file_name)
+
+    def _get_tile_path(self, tile: dict) -> str:
+        return self._get_path(f"tile_{tile['id']}.pkl")
+
+    def _get_lock_path(self, tile: dict) -> str:
+        return self._get_path(f"tile_{tile['id']}.lock")
+
+    def claim_tile(
+        self, worker_id: str = None, lease_seconds: float = 3600
+    ) -> Union[dict, None]:
+        """Claims the next pending tile. Locks older than lease_seconds are
+        treated as abandoned by a crashed worker."""
+        worker_id = worker_id if worker_id else f"{socket.gethostname()}-{os.getpid()}"
+        for tile in self.pending_tiles:
+            lock_path = self._get_lock_path(tile)
+            try:
+                if time.time() - os.path.getmtime(lock_path) > lease_seconds:
+                    os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            try:
+                file_descriptor = os.open(
+                    lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY
+                )
+            except FileExistsError:
+                continue
+            with os.fdopen(file_descriptor, "w") as f:
+                f.write(worker_id)
+            if self.is_tile_done(tile):
+                os.remove(lock_path)
+                continue
+            return tile
+        return None
+
+    def complete_tile(self, tile: dict, result: dict):
+        _write_atomic(
+            self._get_tile_path(tile),
+            pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL),
+            self._directory,
+        )
+        try:
+            os.remove(self._get_lock_path(tile))
+        except FileNotFoundError:
+            pass
+
+    def run(
+        self,
+        comparator: Comparator,
+        worker_id: str = None,
+        max_tiles: int = None,
+        lease_seconds: float = 3600,
+    ) -> int:
+        """Computes tiles until none are left or max_tiles were computed.
+        Returns the number of computed tiles."""
+        computed_tiles = 0
+        while max_tiles is None or computed_tiles < max_tiles:
+            tile = self.claim_tile(worker_id, lease_seconds)
+            if tile is None:
+                break
+            query_ids = self.patient_ids[tile["start"] : tile["stop"]]
+            result = comparator._compute_block(
+                query_ids, self.patient_ids, output_dict=True
+            )
+            self.complete_tile(tile, result)
+            computed_tiles += 1
+        return computed_tiles
+
+    def run_local(self, comparator: Comparator, workers: int = 1) -> int:
+        """Runs the job with several local processes."""
+        if workers <= 1:
+            return self.run(comparator)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _run_job_worker,
+                    self._directory,
+                    comparator,
+                    f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}",
+                )
+                for _ in range(workers)
+            ]
+            return sum(future.result() for future in futures)
+
+    def collect(
+        self, output_dict: bool = False
+    ) -> dict[str, Union[pd.DataFrame, dict]]:
+        """Assembles the finished tiles in the same format as
+        Comparator._compute_similarities."""
+        if not self.is_complete:
+            raise ValueError(
+                f"Similarity job is not complete, {len(self.pending_tiles)} tiles are pending."
+            )
+        sim_df_data = {}
+        for tile in self.tiles:
+            with open(self._get_tile_path(tile), "rb") as f:
+                tile_result = pickle.load(f)
+            for feat_name, data in tile_result.items():
+                sim_df_data.setdefault(feat_name, {}).update(data)
+        if output_dict:
+            return sim_df_data
+        return {
+            feat_name: pd.DataFrame(data) for feat_name, data in sim_df_data.items()
+        }
+
+
+def _write_atomic(path: str, data: bytes, directory: str):
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(file_descriptor, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
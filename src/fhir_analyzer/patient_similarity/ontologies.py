@@ -0,0 +1,270 @@
+import csv
+import hashlib
+import os
+import pickle
+import re
+import threading
+from functools import lru_cache
+from typing import Union
+
+import networkx as nx
+import pkg_resources
+from nxontology import NXOntology
+
+from fhir_analyzer.patient_similarity.internal_types import CODED_CONCEPT
+
+SNOMED = "snomed"
+ICD10 = "ICD-10"
+LOINC = "LOINC"
+RXNORM = "RxNorm"
+UCUM = "UCUM"
+ICD9 = "ICD-9"
+
+SNOMED_IS_A = "116680003"
+
+# Substrings of the normalized system url and the system they resolve to.
+system_patterns = [
+    ("snomed", SNOMED),
+    ("icd10", ICD10),
+    ("loinc", LOINC),
+    ("rxnorm", RXNORM),
+    ("ucum", UCUM),
+    ("icd9", ICD9),
+]
+
+
+@lru_cache(maxsize=None)
+def resolve_system(system: str) -> str:
+    """Maps a code system url like http://snomed.info/sct to the name of its
+    ontology."""
+    normalized_system = re.sub(r"\W+", "", system).lower()
+    for pattern, resolved_system in system_patterns:
+        if pattern in normalized_system:
+            return resolved_system
+    raise ValueError(f"Unknown system: {system}")
+
+
+def build_ontology(graph: nx.DiGraph) -> NXOntology:
+    ontology = NXOntology(graph)
+    ontology.freeze()
+    print(
+        f"Loaded graph with {len(ontology.graph.nodes)} nodes and {len(ontology.graph.edges)} edges."
+    )
+    return ontology
+
+
+class OntologyLoader:
+    """Builds the in-memory ontology of a code system. Edges of the graph
+    point from parent to child concept."""
+
+    def is_available(self) -> bool:
+        raise NotImplementedError
+
+    def load(self) -> NXOntology:
+        raise NotImplementedError
+
+    def version(self) -> str:
+        """Identifies the content the ontology is built from."""
+        raise NotImplementedError
+
+    def normalize_code(self, code: str) -> str:
+        return code
+
+
+class PackagedGraphLoader(OntologyLoader):
+    """Loads a pickled networkx graph that ships in nx_graphs."""
+
+    package = "fhir_analyzer.patient_similarity"
+
+    def __init__(self, name: str):
+        self._resource_name = f"nx_graphs/{name}.gpickle"
+
+    def is_available(self) -> bool:
+        return pkg_resources.resource_exists(self.package, self._resource_name)
+
+    def load(self) -> NXOntology:
+        graph = pickle.load(
+            pkg_resources.resource_stream(self.package, self._resource_name)
+        )
+        return build_ontology(graph)
+
+    def version(self) -> str:
+        return hashlib.sha256(
+            pkg_resources.resource_string(self.package, self._resource_name)
+        ).hexdigest()
+
+
+class FileLoader(OntologyLoader):
+    """Base for loaders that read local files."""
+
+    def __init__(self, *paths: str):
+        self._paths = [path for path in paths if path]
+
+    def is_available(self) -> bool:
+        return all(os.path.exists(path) for path in self._paths)
+
+    def version(self) -> str:
+        parts = []
+        for path in self._paths:
+            stat = os.stat(path)
+            parts.append(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}")
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+
+class GraphFileLoader(FileLoader):
+    """Loads a pickled networkx graph from a local file."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+
+    def load(self) -> NXOntology:
+        with open(self._paths[0], "rb") as f:
+            return build_ontology(pickle.load(f))
+
+
+class SnomedRF2Loader(FileLoader):
+    """Builds the SNOMED CT is-a hierarchy from an RF2 relationship file
+    (sct2_Relationship_Snapshot_*.txt). Only active is-a relationships are
+    used."""
+
+    def __init__(self, relationship_path: str):
+        super().__init__(relationship_path)
+
+    def load(self) -> NXOntology:
+        graph = nx.DiGraph()
+        with open(self._paths[0], "r", encoding="utf-8") as f:
+            reader = csv.DictReader(f, delimiter="\t", quoting=csv.QUOTE_NONE)
+            for row in reader:
+                if row["active"] == "1" and row["typeId"] == SNOMED_IS_A:
+                    graph.add_edge(row["destinationId"], row["sourceId"])
+        return build_ontology(graph)
+
+
+class LoincHierarchyLoader(FileLoader):
+    """Builds the LOINC hierarchy from the multiaxial hierarchy file
+    (MultiAxialHierarchy.csv)."""
+
+    def __init__(self, hierarchy_path: str):
+        super().__init__(hierarchy_path)
+
+    def load(self) -> NXOntology:
+        graph = nx.DiGraph()
+        with open(self._paths[0], "r", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                parent = row["IMMEDIATE_PARENT"]
+                if parent:
+                    graph.add_edge(parent, row["CODE"])
+                else:
+                    graph.add_node(row["CODE"])
+        return build_ontology(graph)
+
+
+class Icd10OrderFileLoader(FileLoader):
+    """Builds the ICD-10 hierarchy from a fixed width order file
+    (e.g. icd10cm_order_2024.txt). The parent of a code is the longest other
+    code that is a prefix of it. Codes are stored without dots."""
+
+    def __init__(self, order_path: str):
+        super().__init__(order_path)
+
+    def load(self) -> NXOntology:
+        codes = []
+        with open(self._paths[0], "r", encoding="utf-8") as f:
+            for line in f:
+                code = line[6:13].strip()
+                if code:
+                    codes.append(code)
+        code_set = set(codes)
+        graph = nx.DiGraph()
+        for code in codes:
+            graph.add_node(code)
+            for length in range(len(code) - 1, 2, -1):
+                if code[:length] in code_set:
+                    graph.add_edge(code[:length], code)
+                    break
+        return build_ontology(graph)
+
+    def normalize_code(self, code: str) -> str:
+        return code.replace(".", "")
+
+
+class PackagedIcd10Loader(PackagedGraphLoader):
+    def normalize_code(self, code: str) -> str:
+        return code.replace(".", "")
+
+
+_ontology_loaders: dict[str, OntologyLoader] = {
+    SNOMED: PackagedGraphLoader("snomed"),
+    ICD10: PackagedIcd10Loader("icd10_nx"),
+}
+_ontologies: dict[str, NXOntology] = {}
+_ontology_lock = threading.Lock()
+
+
+def register_ontology_loader(system: str, loader: OntologyLoader):
+    """Registers the loader of a resolved system, e.g.
+    register_ontology_loader(SNOMED, SnomedRF2Loader(path)). A loaded ontology
+    of the system is replaced on next use."""
+    with _ontology_lock:
+        _ontology_loaders[system] = loader
+        _ontologies.pop(system, None)
+    get_ontology_version.cache_clear()
+
+
+def get_ontology_loader(system: str) -> Union[OntologyLoader, None]:
+    return _ontology_loaders.get(system, None)
+
+
+def get_ontology(system: str) -> NXOntology:
+    """Returns the ontology of a resolved system and loads it on first use."""
+    with _ontology_lock:
+        if system not in _ontologies:
+            loader = _ontology_loaders.get(system, None)
+            if loader is None or not loader.is_available():
+                raise ValueError(f"No ontology available for system {system}.")
+            _ontologies[system] = loader.load()
+        return _ontologies[system]
+
+
+def check_feature_ontologies(
+    feature_types: dict[str, str], patient_features: list[dict[str, list[dict]]]
+):
+    """Resolves the code systems of extracted coded concept features and
+    loads their ontologies, so a missing ontology fails when a feature is
+    registered or refreshed and not during the comparison. Used as the
+    validator hook of the FeatureSelector."""
+    feature_names = [
+        feature_name
+        for feature_name, feature_type in feature_types.items()
+        if feature_type == CODED_CONCEPT
+    ]
+    if not feature_names:
+        return
+    systems = {}
+    for features in patient_features:
+        for feature_name in feature_names:
+            for feature in features.get(feature_name, []):
+                if feature.get("system", None) is not None:
+                    systems.setdefault(feature["system"], feature_name)
+    for system, feature_name in systems.items():
+        try:
+            get_ontology(resolve_system(system))
+        except ValueError as e:
+            raise ValueError(f"Feature {feature_name}: {e}") from e
+
+
+def normalize_code(system: str, code: str) -> str:
+    loader = _ontology_loaders.get(system, None)
+    return loader.normalize_code(code) if loader else code
+
+
+@lru_cache(maxsize=None)
+def get_ontology_version() -> str:
+    """Returns a hash of the content of all available ontologies."""
+    ontology_hash = hashlib.sha256()
+    for system in sorted(_ontology_loaders):
+        loader = _ontology_loaders[system]
+        if loader.is_available():
+            ontology_hash.update(system.encode())
+            ontology_hash.update(loader.version().encode())
+    return ontology_hash.hexdigest()
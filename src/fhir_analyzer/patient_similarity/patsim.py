@@ -1,13 +1,36 @@
-from typing import Union
+from typing import Any, Callable, Union
+
+import pandas as pd
+
 from fhir_analyzer.feature_selector import FeatureSelector
 
 from fhir_analyzer.fhirstore import Fhirstore
+from fhir_analyzer.progress import CancellationToken, Progress
 from fhir_analyzer.constants import (
     default_target_paths,
     default_system_paths,
     default_code_paths,
 )
-from fhir_analyzer.patient_similarity.comparator import Comparator
+from fhir_analyzer.patient_similarity.cache import (
+    SimilarityCache,
+    get_feature_fingerprint,
+)
+from fhir_analyzer.patient_similarity.comparator import (
+    SKIP_MISSING,
+    Comparator,
+)
+from fhir_analyzer.patient_similarity.clustering import (
+    LOUVAIN,
+    build_knn_graph,
+    cluster_graph,
+)
+from fhir_analyzer.patient_similarity.jobs import SimilarityJob
+from fhir_analyzer.patient_similarity.ontologies import (
+    check_feature_ontologies,
+    get_ontology_version,
+)
+from fhir_analyzer.patient_similarity.planner import ExecutionPlan, ExecutionPlanner
+from fhir_analyzer.patient_similarity.sampling import COVERAGE
 from fhir_analyzer.patient_similarity.internal_types import (
     CATEGORICAL_STRING,
     CODED_CONCEPT,
@@ -51,7 +74,9 @@ def validate_paths(paths: list[str], resource_types: list[str], default_fn, path
 class Patsim:
     def __init__(self, fhirstore: Fhirstore = None):
         self._fhirstore = fhirstore if fhirstore else Fhirstore()
-        self._feature_selector = FeatureSelector(self._fhirstore)
+        self._feature_selector = FeatureSelector(
+            self._fhirstore, validate_features=check_feature_ontologies
+        )
 
     def add_feature(self, type: str, *args, **kwargs):
         if type == CATEGORICAL_STRING:
@@ -73,6 +98,9 @@ class Patsim:
         conditional_target_paths: Union[
             list[dict[str, str]], dict[str, str], None
         ] = None,
+        time_filter: dict = None,
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
     ):
         if isinstance(resource_types, str):
             resource_types = [resource_types]
@@ -98,6 +126,9 @@ class Patsim:
             target_paths=target_paths,
             conditional_target_paths=conditional_target_paths,
             include_target_names=True,
+            time_filter=time_filter,
+            progress=progress,
+            cancel=cancel,
         )
 
     def add_numerical_feature(
@@ -108,6 +139,9 @@ class Patsim:
         conditional_target_paths: Union[
             list[dict[str, str]], dict[str, str], None
         ] = None,
+        time_filter: dict = None,
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
     ):
         if isinstance(resource_types, str):
             resource_types = [resource_types]
@@ -131,6 +165,9 @@ class Patsim:
             target_paths=target_paths,
             conditional_target_paths=conditional_target_paths,
             include_target_names=True,
+            time_filter=time_filter,
+            progress=progress,
+            cancel=cancel,
         )
 
     def add_coded_concept_feature(
@@ -145,6 +182,9 @@ class Patsim:
         conditional_system_paths: Union[
             list[dict[str, str]], dict[str, str], None
         ] = None,
+        time_filter: dict = None,
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
     ):
         if isinstance(resource_types, str):
             resource_types = [resource_types]
@@ -191,6 +231,9 @@ class Patsim:
             target_paths=target_paths,
             conditional_target_paths=conditional_target_paths,
             include_target_names=True,
+            time_filter=time_filter,
+            progress=progress,
+            cancel=cancel,
         )
 
     def add_coded_numerical_feature(
@@ -205,6 +248,9 @@ class Patsim:
         conditional_code_paths: Union[
             list[dict[str, str]], dict[str, str], None
         ] = None,
+        time_filter: dict = None,
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
     ):
         if isinstance(resource_types, str):
             resource_types = [resource_types]
@@ -251,18 +297,243 @@ class Patsim:
             target_paths=target_paths,
             conditional_target_paths=conditional_target_paths,
             include_target_names=True,
+            time_filter=time_filter,
+            progress=progress,
+            cancel=cancel,
         )
 
     @property
     def feature_df(self):
         return self._feature_selector.feature_df
 
-    def compute_similarities(self, output_dict: bool = False):
+    def get_projection(self, **kwargs):
+        return self._feature_selector.get_projection(**kwargs)
+
+    def refresh_features(self):
+        self._feature_selector.refresh()
+
+    def compute_similarities(
+        self,
+        output_dict: bool = False,
+        cache: SimilarityCache = None,
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
+    ):
+        """Computes the similarities of all patient pairs per feature. progress
+        is called for the extraction of changed patients and for the
+        comparison. If cancel is cancelled, OperationCancelled is raised, with
+        the finished patient rows as partial_result during the comparison."""
+        self._feature_selector.refresh(progress=progress, cancel=cancel)
+        if cache is None:
+            self._comparator = Comparator(feature_selector=self._feature_selector)
+            return self._comparator._compute_similarities(
+                output_dict=output_dict, progress=progress, cancel=cancel
+            )
+        feature_keys = self._get_feature_cache_keys()
+        result_dict = {}
+        for feat_name, key in feature_keys.items():
+            data = cache.get(key)
+            if data is not None:
+                result_dict[feat_name] = data
+        missing_feature_names = [
+            feat_name for feat_name in feature_keys if feat_name not in result_dict
+        ]
+        if missing_feature_names:
+            self._comparator = Comparator(feature_selector=self._feature_selector)
+            computed = self._comparator._compute_similarities(
+                output_dict=True,
+                feature_names=missing_feature_names,
+                progress=progress,
+                cancel=cancel,
+            )
+            for feat_name, data in computed.items():
+                cache.put(feature_keys[feat_name], data)
+                result_dict[feat_name] = data
+        if not output_dict:
+            result_dict = {
+                feat_name: pd.DataFrame(data) for feat_name, data in result_dict.items()
+            }
+        return result_dict
+
+    def compute_anytime_similarities(
+        self,
+        time_budget: float,
+        priority: Union[list[str], dict[str, float]] = None,
+        progress: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
+        output_dict: bool = False,
+    ) -> dict[str, Union[dict, list[str]]]:
+        """Computes the similarity rows of the patients in order of priority
+        (a list of patient ids or a mapping of patient ids to scores) and
+        returns the rows that are finished after time_budget seconds, with
+        the completed and pending patient ids."""
+        self._feature_selector.refresh(progress=progress, cancel=cancel)
         self._comparator = Comparator(feature_selector=self._feature_selector)
-        return self._comparator._compute_similarities(output_dict=output_dict)
+        return self._comparator.compute_anytime_similarities(
+            time_budget,
+            priority=priority,
+            progress=progress,
+            cancel=cancel,
+            output_dict=output_dict,
+        )
+
+    def compute_similarities_job(
+        self,
+        directory: str,
+        block_size: int = 256,
+        workers: int = 1,
+        output_dict: bool = False,
+    ):
+        """Computes the similarities as a resumable job in directory. Tiles
+        that were finished by an earlier run are not computed again."""
+        self._feature_selector.refresh()
+        fingerprint = get_feature_fingerprint(
+            feature_spec=self._feature_selector._feature_specs,
+            ontology_version=get_ontology_version(),
+            data_fingerprint=self._fhirstore.fingerprint(),
+        )
+        self._comparator = Comparator(feature_selector=self._feature_selector)
+        job = SimilarityJob.create(
+            directory,
+            patient_ids=list(self._comparator._feature_dict.keys()),
+            block_size=block_size,
+            fingerprint=fingerprint,
+        )
+        if not job.is_complete:
+            job.run_local(self._comparator, workers=workers)
+        return job.collect(output_dict=output_dict)
+
+    def _get_feature_cache_keys(self) -> dict[str, str]:
+        ontology_version = get_ontology_version()
+        data_fingerprint = self._fhirstore.fingerprint()
+        return {
+            feat_name: get_feature_fingerprint(
+                feature_spec=spec,
+                ontology_version=ontology_version,
+                data_fingerprint=data_fingerprint,
+            )
+            for feat_name, spec in self._feature_selector._feature_specs.items()
+        }
+
+    def compute_cohort_similarities(
+        self,
+        query_ids: list[str],
+        reference_ids: list[str] = None,
+        query_block_size: int = 256,
+        reference_block_size: int = None,
+        output_dict: bool = False,
+    ):
+        self._feature_selector.refresh()
+        self._comparator = Comparator(feature_selector=self._feature_selector)
+        return self._comparator.compute_block_similarities(
+            query_ids=query_ids,
+            reference_ids=reference_ids,
+            query_block_size=query_block_size,
+            reference_block_size=reference_block_size,
+            output_dict=output_dict,
+        )
+
+    def compute_combined_similarities(
+        self,
+        weights: dict[str, float] = None,
+        missing: Union[str, float, dict[str, Union[str, float]]] = SKIP_MISSING,
+        top_k: int = None,
+        query_ids: list[str] = None,
+        reference_ids: list[str] = None,
+        block_size: int = 256,
+        output_dict: bool = False,
+    ):
+        """Computes the weighted overall similarity of all patients, or of the
+        query and reference patients, without a matrix per feature. Missing
+        feature similarities are skipped, counted as zero ("zero"), make the
+        pair missing ("propagate") or are replaced by a number, for all
+        features or per feature. With top_k only the top_k most similar
+        patients of each patient are returned."""
+        self._feature_selector.refresh()
+        self._comparator = Comparator(feature_selector=self._feature_selector)
+        return self._comparator.compute_combined_similarities(
+            query_ids=query_ids,
+            reference_ids=reference_ids,
+            weights=weights,
+            missing=missing,
+            top_k=top_k,
+            block_size=block_size,
+            output_dict=output_dict,
+        )
+
+    def plan_similarities(
+        self,
+        memory_budget: Union[int, str] = None,
+        cpu_budget: int = None,
+        directory: str = None,
+        top_k: int = 10,
+        weights: dict[str, float] = None,
+    ) -> ExecutionPlan:
+        """Plans the similarity computation for a memory budget (bytes or a
+        size like "8GB", the physical memory by default) and a number of
+        cores. Call explain() on the plan to see the estimated time and peak
+        memory and run() to compute the similarities."""
+        self._feature_selector.refresh()
+        self._comparator = Comparator(feature_selector=self._feature_selector)
+        planner = ExecutionPlanner(
+            self._comparator, memory_budget=memory_budget, cpu_budget=cpu_budget
+        )
+        return planner.plan(directory=directory, top_k=top_k, weights=weights)
+
+    def compute_sample_similarities(
+        self,
+        sample_size: int = 200,
+        stratify_by: str = COVERAGE,
+        feature_name: str = None,
+        seed: int = 0,
+        confidence: float = 0.95,
+        output_dict: bool = False,
+    ):
+        self._feature_selector.refresh()
+        self._comparator = Comparator(feature_selector=self._feature_selector)
+        return self._comparator.compute_sample_similarities(
+            sample_size=sample_size,
+            stratify_by=stratify_by,
+            feature_name=feature_name,
+            seed=seed,
+            confidence=confidence,
+            output_dict=output_dict,
+        )
+
+    def build_knn_graph(
+        self, k: int = 10, weights: dict[str, float] = None, block_size: int = 256
+    ):
+        self._feature_selector.refresh()
+        self._comparator = Comparator(feature_selector=self._feature_selector)
+        return build_knn_graph(
+            self._comparator, k=k, weights=weights, block_size=block_size
+        )
+
+    def cluster_patients(
+        self,
+        k: int = 10,
+        method: str = LOUVAIN,
+        n_clusters: int = None,
+        weights: dict[str, float] = None,
+        block_size: int = 256,
+        seed: int = None,
+        **kwargs,
+    ) -> dict[str, int]:
+        """Clusters the patients on their k nearest neighbour graph with
+        louvain, label_propagation or k_medoids."""
+        graph = self.build_knn_graph(k=k, weights=weights, block_size=block_size)
+        return cluster_graph(
+            graph, method=method, n_clusters=n_clusters, seed=seed, **kwargs
+        )
 
     def add_resources(self, resource: list[dict]):
         self._fhirstore.add_resources(resource)
 
     def add_bundle(self, bundle: dict):
         self._fhirstore.add_bundle(bundle)
+
+    def upsert_resources(self, resources: list[dict]):
+        self._fhirstore.upsert_resources(resources)
+
+    def delete_resource(self, resource_type: str, resource_id: str):
+        self._fhirstore.delete_resource(resource_type, resource_id)
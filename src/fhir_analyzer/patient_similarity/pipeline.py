@@ -0,0 +1,324 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from itertools import repeat
+from typing import Any, Union
+
+import pandas as pd
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from fhir_analyzer.feature_selector import FeatureSelector
+from fhir_analyzer.fhirstore import Fhirstore
+from fhir_analyzer.helper import get_blocks
+from fhir_analyzer.projection import Projection
+from fhir_analyzer.storage import MemoryStorage
+from fhir_analyzer.patient_similarity.comparator import (
+    MAX_AGGREGATION,
+    Comparator,
+)
+from fhir_analyzer.patient_similarity.jobs import SimilarityJob, _write_atomic
+from fhir_analyzer.patient_similarity.ontologies import (
+    check_feature_ontologies,
+    get_ontology_version,
+)
+from fhir_analyzer.patient_similarity.patsim import Patsim
+
+INGEST = "ingest"
+EXTRACTION = "extraction"
+STATS = "stats"
+SIMILARITY = "similarity"
+STAGES = [INGEST, EXTRACTION, STATS, SIMILARITY]
+
+OUTPUT_FORMATS = ["csv", "pickle", "parquet"]
+
+
+def load_spec(path: str) -> dict:
+    """Loads a pipeline spec from a JSON or YAML file."""
+    with open(path, "r") as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ImportError(
+                    "pyyaml is required for YAML specs, install fhir_analyzer[pipeline]."
+                )
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def get_stage_key(*parts: Any) -> str:
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def get_file_hash(path: str, chunk_size: int = 1024**2) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _extract_patient_features(
+    feature_specs: dict[str, dict], patients: list[tuple[str, dict[str, list[dict]]]]
+) -> dict[str, dict[str, list]]:
+    storage = MemoryStorage()
+    for patient_id, patient_resources in patients:
+        storage.add_patient(patient_id)
+        for resources in patient_resources.values():
+            for resource in resources:
+                storage.add_patient_connection(patient_id, resource)
+    feature_selector = FeatureSelector(
+        Fhirstore(storage=storage), validate_features=check_feature_ontologies
+    )
+    feature_selector._add_features(feature_specs)
+    return feature_selector._patient_features
+
+
+class Pipeline:
+    """Runs a pipeline spec as the stages ingest, extraction, stats and
+    similarity. The artifact of every stage is cached on disk under a key
+    that is derived from the inputs of the stage and the keys of the stages
+    before it, so only stages whose inputs changed are run again.
+
+    A spec looks like:
+
+        {
+            "input": {"directory": "bundles", "pattern": "*.json", "workers": 4},
+            "features": [
+                {"type": "categorical_string", "name": "gender",
+                 "resource_types": "Patient", "target_paths": "Patient.gender"}
+            ],
+            "extraction": {"workers": 4},
+            "stats": {"robust": false, "coded_concept_aggregation": "max"},
+            "similarity": {"workers": 4, "block_size": 256},
+            "output": {"directory": "results", "format": "csv"}
+        }
+
+    The features take the same arguments as Patsim.add_feature. With
+    "project": true in input, resources are reduced to the paths the
+    features need while they are loaded."""
+
+    def __init__(
+        self, spec: dict, cache_directory: str = None, force: list[str] = None
+    ):
+        self._spec = spec
+        self._input_spec = spec["input"]
+        self._cache_directory = (
+            cache_directory
+            if cache_directory
+            else spec.get("cache_directory", ".pipeline_cache")
+        )
+        force = set(force) if force else set()
+        unknown_stages = force.difference(STAGES)
+        if unknown_stages:
+            raise ValueError(f"Unknown stages: {sorted(unknown_stages)}")
+        self._force = {
+            stage
+            for i, stage in enumerate(STAGES)
+            if force.intersection(STAGES[: i + 1])
+        }
+        os.makedirs(self._cache_directory, exist_ok=True)
+        self._feature_specs = self._get_feature_specs(spec["features"])
+        self._keys = self._get_stage_keys()
+        self._artifacts = {}
+        self.stage_status: dict[str, str] = {}
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> "Pipeline":
+        return cls(load_spec(path), **kwargs)
+
+    @staticmethod
+    def _get_feature_specs(features: list[dict]) -> dict[str, dict]:
+        patsim = Patsim()
+        for feature in features:
+            patsim.add_feature(**feature)
+        return patsim._feature_selector._feature_specs
+
+    def _get_input_files(self) -> list[tuple[str, str]]:
+        """Names and content hashes of the input files. Hashing the content
+        keeps touched files from rerunning the stages and rewritten files
+        with unchanged size and mtime from being served stale artifacts."""
+        paths = sorted(
+            glob(
+                os.path.join(
+                    self._input_spec["directory"],
+                    self._input_spec.get("pattern", "*.json"),
+                )
+            )
+        )
+        return [(os.path.basename(path), get_file_hash(path)) for path in paths]
+
+    def _get_stage_keys(self) -> dict[str, str]:
+        input_options = {
+            k: v for k, v in self._input_spec.items() if k not in ("workers",)
+        }
+        keys = {}
+        keys[INGEST] = get_stage_key(
+            INGEST,
+            input_options,
+            self._get_input_files(),
+            self._feature_specs if self._input_spec.get("project", False) else None,
+        )
+        keys[EXTRACTION] = get_stage_key(EXTRACTION, keys[INGEST], self._feature_specs)
+        keys[STATS] = get_stage_key(STATS, keys[EXTRACTION], self._spec.get(STATS, {}))
+        keys[SIMILARITY] = get_stage_key(
+            SIMILARITY, keys[STATS], get_ontology_version()
+        )
+        return keys
+
+    def _get_artifact_path(self, stage: str) -> str:
+        return os.path.join(self._cache_directory, f"{stage}-{self._keys[stage]}.pkl")
+
+    def _load_artifact(self, stage: str) -> Union[Any, None]:
+        if stage in self._force:
+            return None
+        try:
+            with open(self._get_artifact_path(stage), "rb") as f:
+                artifact = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        self.stage_status[stage] = "cached"
+        return artifact
+
+    def _save_artifact(self, stage: str, artifact: Any):
+        _write_atomic(
+            self._get_artifact_path(stage),
+            pickle.dumps(artifact, protocol=pickle.HIGHEST_PROTOCOL),
+            self._cache_directory,
+        )
+        self.stage_status[stage] = "computed"
+
+    def _get_stage(self, stage: str) -> Any:
+        if stage not in self._artifacts:
+            artifact = self._load_artifact(stage)
+            if artifact is None:
+                artifact = getattr(self, f"_run_{stage}")()
+                self._save_artifact(stage, artifact)
+            self._artifacts[stage] = artifact
+        return self._artifacts[stage]
+
+    def _run_ingest(self) -> MemoryStorage:
+        projection = None
+        if self._input_spec.get("project", False):
+            projection = Projection.from_feature_specs(self._feature_specs)
+        fhirstore = Fhirstore.from_directory(
+            self._input_spec["directory"],
+            workers=self._input_spec.get("workers", None),
+            pattern=self._input_spec.get("pattern", "*.json"),
+            projection=projection,
+            linkage_chains=self._input_spec.get("linkage_chains", None),
+        )
+        return fhirstore._storage
+
+    def _run_extraction(self) -> dict[str, dict[str, list]]:
+        storage = self._get_stage(INGEST)
+        workers = self._spec.get(EXTRACTION, {}).get("workers", None)
+        batch_size = self._spec.get(EXTRACTION, {}).get("batch_size", 500)
+        if not workers or workers <= 1:
+            return _extract_patient_features(
+                self._feature_specs, list(storage.iter_patient_resources())
+            )
+        patient_features = {}
+        patients = list(storage.iter_patient_resources())
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(
+                _extract_patient_features,
+                repeat(self._feature_specs),
+                get_blocks(patients, batch_size),
+            ):
+                patient_features.update(result)
+        return patient_features
+
+    def _get_feature_selector(self) -> FeatureSelector:
+        feature_selector = FeatureSelector()
+        feature_selector._patient_features = self._get_stage(EXTRACTION)
+        for feature_name, spec in self._feature_specs.items():
+            feature_selector._add_feature_metadata(feature_name, spec["type"])
+            feature_selector._feature_specs[feature_name] = spec
+        return feature_selector
+
+    def _run_stats(self) -> Comparator:
+        stats_spec = self._spec.get(STATS, {})
+        return Comparator(
+            feature_selector=self._get_feature_selector(),
+            robust=stats_spec.get("robust", False),
+            coded_concept_aggregation=stats_spec.get(
+                "coded_concept_aggregation", MAX_AGGREGATION
+            ),
+        )
+
+    def _run_similarity(self) -> dict[str, dict]:
+        comparator = self._get_stage(STATS)
+        similarity_spec = self._spec.get(SIMILARITY, {})
+        job_directory = os.path.join(
+            self._cache_directory, f"{SIMILARITY}-{self._keys[SIMILARITY]}"
+        )
+        if SIMILARITY in self._force and os.path.exists(job_directory):
+            shutil.rmtree(job_directory)
+        job = SimilarityJob.create(
+            job_directory,
+            patient_ids=list(comparator._feature_dict.keys()),
+            block_size=similarity_spec.get("block_size", 256),
+            fingerprint=self._keys[SIMILARITY],
+        )
+        job.run_local(comparator, workers=similarity_spec.get("workers", 1))
+        return job.collect(output_dict=True)
+
+    def run(self) -> dict[str, pd.DataFrame]:
+        """Runs all stages that are not cached and writes the similarities to
+        the output directory if one is given."""
+        result = {
+            feat_name: pd.DataFrame(data)
+            for feat_name, data in self._get_stage(SIMILARITY).items()
+        }
+        output_spec = self._spec.get("output", None)
+        if output_spec:
+            self._write_output(result, output_spec)
+        return result
+
+    def _write_output(self, result: dict[str, pd.DataFrame], output_spec: dict):
+        output_format = output_spec.get("format", "csv")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}")
+        os.makedirs(output_spec["directory"], exist_ok=True)
+        for feat_name, df in result.items():
+            path = os.path.join(
+                output_spec["directory"], f"{feat_name}.{output_format}"
+            )
+            if output_format == "csv":
+                df.to_csv(path)
+            elif output_format == "pickle":
+                df.to_pickle(path)
+            else:
+                df.to_parquet(path)
+
+
+def main(args: list[str] = None):
+    parser = argparse.ArgumentParser(description="Run a patient similarity pipeline.")
+    parser.add_argument("spec", help="JSON or YAML pipeline spec.")
+    parser.add_argument("--cache-directory", default=None)
+    parser.add_argument(
+        "--force", nargs="*", default=[], choices=STAGES, help="Stages to rerun."
+    )
+    parsed_args = parser.parse_args(args)
+    pipeline = Pipeline.from_file(
+        parsed_args.spec,
+        cache_directory=parsed_args.cache_directory,
+        force=parsed_args.force,
+    )
+    pipeline.run()
+    for stage in STAGES:
+        print(f"{stage}: {pipeline.stage_status.get(stage, 'skipped')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+import os
+import random
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Generator, Union
+
+import numpy as np
+import pandas as pd
+
+from fhir_analyzer.helper import get_blocks
+from fhir_analyzer.patient_similarity.comparator import Comparator
+from fhir_analyzer.patient_similarity.internal_types import (
+    CODED_CONCEPT,
+    CODED_NUMERICAL,
+)
+from fhir_analyzer.patient_similarity.jobs import SimilarityJob
+
+DENSE = "dense"
+TILED = "tiled"
+SPARSE = "sparse"
+
+dtypes = {"float64": np.float64, "float32": np.float32}
+block_sizes = [1024, 512, 256, 128, 64, 32, 16, 8, 4, 2, 1]
+
+# Approximate memory of one similarity in the dict tiles of a block, one
+# extracted value in the state of a comparator and one top-k neighbour.
+DICT_CELL_BYTES = 56
+STATE_ITEM_BYTES = 200
+NEIGHBOUR_BYTES = 120
+# Share of the memory budget the plan may use.
+MEMORY_HEADROOM = 0.8
+
+_byte_units = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_bytes(value: Union[int, str]) -> int:
+    """Parses a size like 512MB or 16G to bytes."""
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.match(r"^\s*([\d.]+)\s*([KMGT]?)i?B?\s*$", value, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    return int(float(match.group(1)) * _byte_units[match.group(2).upper()])
+
+
+def format_bytes(value: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if value < 1024:
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} TB"
+
+
+def format_seconds(value: float) -> str:
+    if value < 60:
+        return f"{value:.1f} s"
+    if value < 3600:
+        return f"{value / 60:.1f} min"
+    return f"{value / 3600:.1f} h"
+
+
+def get_available_memory() -> int:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        raise ValueError("The memory budget could not be detected, pass it explicitly.")
+
+
+def _compute_block_worker(
+    comparator: Comparator, query_ids: list[str], reference_ids: list[str]
+) -> dict[str, dict]:
+    return comparator._compute_block(query_ids, reference_ids, output_dict=True)
+
+
+def _compute_top_k_worker(
+    comparator: Comparator,
+    query_ids: list[str],
+    reference_ids: list[str],
+    weights: dict[str, float],
+    top_k: int,
+) -> dict[str, list[tuple[str, float]]]:
+    return comparator.compute_combined_similarities(
+        query_ids,
+        reference_ids,
+        weights=weights,
+        top_k=top_k,
+        block_size=len(query_ids),
+        output_dict=True,
+    )
+
+
+class ExecutionPlan:
+    """Strategy for computing the similarities of a comparator, as chosen by
+    an ExecutionPlanner. explain() describes the plan with its estimated
+    time and peak memory, run() executes it."""
+
+    def __init__(
+        self,
+        comparator: Comparator,
+        strategy: str,
+        dtype: str,
+        block_size: int,
+        workers: int,
+        estimated_seconds: float,
+        estimated_peak_bytes: float,
+        memory_budget: int,
+        details: dict,
+        top_k: int = None,
+        weights: dict[str, float] = None,
+        directory: str = None,
+    ):
+        self._comparator = comparator
+        self.strategy = strategy
+        self.dtype = dtype
+        self.block_size = block_size
+        self.workers = workers
+        self.estimated_seconds = estimated_seconds
+        self.estimated_peak_bytes = estimated_peak_bytes
+        self.memory_budget = memory_budget
+        self.details = details
+        self.top_k = top_k
+        self.weights = weights
+        self.directory = directory
+
+    def explain(self) -> str:
+        """Prints and returns a description of the plan without running it."""
+        lines = [
+            f"Strategy: {self.strategy}",
+            f"Patients: {self.details['n_patients']}, "
+            f"features: {self.details['n_features']}",
+            f"Storage: {self.dtype}, block size: {self.block_size}, "
+            f"workers: {self.workers}",
+            f"Estimated time: {format_seconds(self.estimated_seconds)} "
+            f"({self.details['pair_seconds'] * 1e6:.1f} us per pair)",
+            f"Estimated peak memory: {format_bytes(self.estimated_peak_bytes)} "
+            f"of {format_bytes(self.memory_budget)}",
+        ]
+        for feat_name, cardinality in self.details["code_cardinalities"].items():
+            lines.append(f"Mean distinct codes of {feat_name}: {cardinality:.1f}")
+        if self.strategy == TILED:
+            lines.append(
+                f"Tiles are written to {self.directory}, "
+                f"about {format_bytes(self.details['disk_bytes'])} on disk."
+            )
+        if self.strategy == SPARSE:
+            lines.append(f"Only the top {self.top_k} overall similarities are kept.")
+        explanation = "\n".join(lines)
+        print(explanation)
+        return explanation
+
+    def run(self) -> Union[dict[str, pd.DataFrame], pd.DataFrame, SimilarityJob]:
+        """Runs the plan. Dense plans return a frame per feature like
+        Patsim.compute_similarities, tiled plans the finished SimilarityJob
+        and sparse plans the top-k frame of compute_combined_similarities."""
+        if self.strategy == DENSE:
+            return self._run_dense()
+        if self.strategy == TILED:
+            job = SimilarityJob.create(
+                self.directory,
+                patient_ids=list(self._comparator._feature_dict.keys()),
+                block_size=self.block_size,
+            )
+            job.run_local(self._comparator, workers=self.workers)
+            return job
+        return self._run_sparse()
+
+    def _run_dense(self) -> dict[str, pd.DataFrame]:
+        patient_ids = list(self._comparator._feature_dict.keys())
+        positions = {patient_id: i for i, patient_id in enumerate(patient_ids)}
+        arrays = {}
+        blocks = list(get_blocks(patient_ids, self.block_size))
+        if self.workers > 1:
+            executor = ProcessPoolExecutor(max_workers=self.workers)
+            results = self._iter_parallel_blocks(
+                executor, _compute_block_worker, blocks, patient_ids
+            )
+        else:
+            executor = None
+            results = (
+                self._comparator._compute_block(block, patient_ids, output_dict=True)
+                for block in blocks
+            )
+        try:
+            for block, block_result in zip(blocks, results):
+                rows = [positions[patient_id] for patient_id in block]
+                for feat_name, data in block_result.items():
+                    if feat_name not in arrays:
+                        arrays[feat_name] = np.empty(
+                            (len(patient_ids), len(patient_ids)),
+                            dtype=dtypes[self.dtype],
+                        )
+                    arrays[feat_name][rows] = np.array(
+                        [list(data[patient_id].values()) for patient_id in block],
+                        dtype=np.float64,
+                    )
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        # Columns are the query patients, as in Comparator._compute_similarities.
+        # The frames share the arrays, the planner counts the output once.
+        return {
+            feat_name: pd.DataFrame(
+                array.T, index=patient_ids, columns=patient_ids, copy=False
+            )
+            for feat_name, array in arrays.items()
+        }
+
+    def _run_sparse(self) -> pd.DataFrame:
+        """Keeps the top-k overall similarities of each block of query
+        patients. With several workers each computes whole blocks against all
+        patients, so merging their neighbours needs no further ranking."""
+        patient_ids = list(self._comparator._feature_dict.keys())
+        blocks = list(get_blocks(patient_ids, self.block_size))
+        if self.workers > 1:
+            executor = ProcessPoolExecutor(max_workers=self.workers)
+            results = self._iter_parallel_blocks(
+                executor,
+                _compute_top_k_worker,
+                blocks,
+                patient_ids,
+                self.weights,
+                self.top_k,
+            )
+        else:
+            executor = None
+            results = (
+                _compute_top_k_worker(
+                    self._comparator, block, patient_ids, self.weights, self.top_k
+                )
+                for block in blocks
+            )
+        neighbours = {}
+        try:
+            for block_result in results:
+                neighbours.update(block_result)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        result = pd.DataFrame(
+            [
+                (patient_id, other_id, similarity)
+                for patient_id, rows in neighbours.items()
+                for other_id, similarity in rows
+            ],
+            columns=["patient_id", "other_id", "similarity"],
+        )
+        result["similarity"] = result["similarity"].astype(dtypes[self.dtype])
+        return result
+
+    def _iter_parallel_blocks(
+        self,
+        executor: ProcessPoolExecutor,
+        worker_fn: Callable[..., Any],
+        blocks: list[list[str]],
+        *args: Any,
+    ) -> Generator[Any, None, None]:
+        """Yields the results of worker_fn(comparator, block, *args) for the
+        blocks in order. At most one block per worker is in flight, so
+        finished tiles do not pile up beyond the estimate of the planner."""
+        futures = deque()
+        for block in blocks:
+            futures.append(executor.submit(worker_fn, self._comparator, block, *args))
+            if len(futures) >= self.workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+class ExecutionPlanner:
+    """Chooses how to compute the similarities of a comparator within a
+    memory and CPU budget.
+
+    The time per pair is measured on a sample of patient pairs, memory is
+    estimated from the number of patients and features and the number of
+    values and distinct codes per patient. The planner prefers a dense
+    matrix per feature, in float64 and else float32. If that does not fit it
+    writes tiles to disk when a directory is given, and otherwise only keeps
+    the top-k overall similarities per patient."""
+
+    def __init__(
+        self,
+        comparator: Comparator,
+        memory_budget: Union[int, str] = None,
+        cpu_budget: int = None,
+        sample_pairs: int = 200,
+        seed: int = 0,
+    ):
+        self._comparator = comparator
+        self._memory_budget = (
+            parse_bytes(memory_budget) if memory_budget else get_available_memory()
+        )
+        self._cpu_budget = max(
+            1, min(cpu_budget if cpu_budget else os.cpu_count(), os.cpu_count())
+        )
+        self._sample_pairs = sample_pairs
+        self._seed = seed
+        self._patient_ids = list(comparator._feature_dict.keys())
+        self._feature_names = [
+            feat_name
+            for feat_name, feat_type in comparator._feature_types.items()
+            if feat_type in comparator._sim_fns
+        ]
+
+    def get_code_cardinalities(self) -> dict[str, float]:
+        """Returns the mean number of distinct codes per patient of the coded
+        features."""
+        cardinalities = {}
+        for feat_name in self._feature_names:
+            feat_type = self._comparator._feature_types[feat_name]
+            if feat_type not in (CODED_CONCEPT, CODED_NUMERICAL):
+                continue
+            counts = []
+            for features_dic in self._comparator._feature_dict.values():
+                features = features_dic.get(feat_name, [])
+                if feat_type == CODED_CONCEPT:
+                    counts.append(len(features.counts) if len(features) else 0)
+                else:
+                    counts.append(len({feature.code for feature in features}))
+            cardinalities[feat_name] = sum(counts) / len(counts) if counts else 0.0
+        return cardinalities
+
+    def get_state_bytes(self) -> float:
+        """Estimates the memory of a copy of the comparator, as held by every
+        worker process."""
+        n_items = 0
+        for features_dic in self._comparator._feature_dict.values():
+            for feat_name, features in features_dic.items():
+                if self._comparator._feature_types[feat_name] == CODED_CONCEPT:
+                    n_items += len(features.counts) if len(features) else 0
+                else:
+                    n_items += len(features)
+        return n_items * STATE_ITEM_BYTES
+
+    def estimate_pair_seconds(self) -> dict[str, float]:
+        """Measures the mean time to compare a patient pair per feature."""
+        if len(self._patient_ids) < 2:
+            return {feat_name: 0.0 for feat_name in self._feature_names}
+        rng = random.Random(self._seed)
+        pairs = [
+            tuple(rng.sample(self._patient_ids, 2)) for _ in range(self._sample_pairs)
+        ]
+        pair_seconds = {}
+        for feat_name in self._feature_names:
+            start = time.perf_counter()
+            for patient_id, other_id in pairs:
+                self._comparator._compare_patient(patient_id, [other_id], feat_name)
+            pair_seconds[feat_name] = (time.perf_counter() - start) / len(pairs)
+        return pair_seconds
+
+    def plan(
+        self,
+        directory: str = None,
+        top_k: int = 10,
+        weights: dict[str, float] = None,
+    ) -> ExecutionPlan:
+        """Chooses the strategy, storage type, block size and number of
+        workers. Tiled output is only considered with a directory."""
+        n_patients = len(self._patient_ids)
+        n_features = len(self._feature_names)
+        budget = self._memory_budget * MEMORY_HEADROOM
+        state_bytes = self.get_state_bytes()
+        pair_seconds = self.estimate_pair_seconds()
+        details = {
+            "n_patients": n_patients,
+            "n_features": n_features,
+            "pair_seconds": sum(pair_seconds.values()),
+            "feature_pair_seconds": pair_seconds,
+            "code_cardinalities": self.get_code_cardinalities(),
+            "state_bytes": state_bytes,
+        }
+        n_pairs = n_patients * n_patients
+
+        def get_tile_bytes(block_size: int, workers: int) -> float:
+            block_size = min(block_size, max(n_patients, 1))
+            tile_bytes = block_size * n_patients * n_features * DICT_CELL_BYTES
+            if workers > 1:
+                return workers * (tile_bytes + state_bytes) + tile_bytes
+            return tile_bytes
+
+        def get_seconds(workers: int, feature_names: list[str]) -> float:
+            return n_pairs * sum(pair_seconds[f] for f in feature_names) / workers
+
+        worker_options = range(self._cpu_budget, 0, -1)
+        for dtype in dtypes:
+            output_bytes = n_features * n_pairs * np.dtype(dtypes[dtype]).itemsize
+            for workers in worker_options:
+                for block_size in block_sizes:
+                    n_blocks = -(-n_patients // block_size)
+                    if workers > 1 and n_blocks < workers:
+                        continue
+                    peak_bytes = (
+                        state_bytes + output_bytes + get_tile_bytes(block_size, workers)
+                    )
+                    if peak_bytes <= budget:
+                        return ExecutionPlan(
+                            self._comparator,
+                            DENSE,
+                            dtype,
+                            block_size,
+                            workers,
+                            get_seconds(workers, self._feature_names),
+                            peak_bytes,
+                            self._memory_budget,
+                            details,
+                        )
+        if directory:
+            for workers in worker_options:
+                for block_size in block_sizes:
+                    peak_bytes = state_bytes + get_tile_bytes(block_size, workers)
+                    if peak_bytes <= budget:
+                        details["disk_bytes"] = n_features * n_pairs * 12
+                        return ExecutionPlan(
+                            self._comparator,
+                            TILED,
+                            "float64",
+                            block_size,
+                            workers,
+                            get_seconds(workers, self._feature_names),
+                            peak_bytes,
+                            self._memory_budget,
+                            details,
+                            directory=directory,
+                        )
+        weighted_features = [
+            f for f in self._feature_names if not weights or weights.get(f, 1.0) != 0
+        ]
+
+        def get_combined_tile_bytes(block_size: int, workers: int) -> float:
+            block_size = min(block_size, max(n_patients, 1))
+            # Sum, normalizer, one feature tile and its array.
+            tile_bytes = (
+                block_size
+                * n_patients
+                * (DICT_CELL_BYTES + 4 * np.dtype(np.float64).itemsize)
+            )
+            if workers > 1:
+                # The main process only merges the neighbours of the workers.
+                return workers * (tile_bytes + state_bytes)
+            return tile_bytes
+
+        neighbour_bytes = n_patients * top_k * NEIGHBOUR_BYTES
+        for workers in worker_options:
+            for block_size in block_sizes:
+                n_blocks = -(-n_patients // block_size)
+                if workers > 1 and n_blocks < workers:
+                    continue
+                peak_bytes = (
+                    state_bytes
+                    + neighbour_bytes
+                    + get_combined_tile_bytes(block_size, workers)
+                )
+                if peak_bytes <= budget:
+                    return ExecutionPlan(
+                        self._comparator,
+                        SPARSE,
+                        "float64",
+                        block_size,
+                        workers,
+                        get_seconds(workers, weighted_features),
+                        peak_bytes,
+                        self._memory_budget,
+                        details,
+                        top_k=top_k,
+                        weights=weights,
+                    )
+        raise ValueError(
+            f"The similarities of {n_patients} patients do not fit in a memory "
+            f"budget of {format_bytes(self._memory_budget)}."
+        )
@@ -0,0 +1,143 @@
+import math
+import random
+import statistics
+from collections import Counter
+from typing import Hashable, Union
+
+import pandas as pd
+
+COVERAGE = "coverage"
+CODE = "code"
+
+
+def get_coverage_strata(
+    patient_features: dict[str, dict[str, list]], feature_names: list[str] = None
+) -> dict[str, tuple[str, ...]]:
+    """Assigns each patient to the stratum of features it has values for."""
+    return {
+        patient_id: tuple(
+            sorted(
+                name
+                for name, features in features_dic.items()
+                if features and (feature_names is None or name in feature_names)
+            )
+        )
+        for patient_id, features_dic in patient_features.items()
+    }
+
+
+def get_code_strata(
+    patient_features: dict[str, dict[str, list]], feature_name: str
+) -> dict[str, Union[str, None]]:
+    """Assigns each patient to the stratum of its most frequent code of a
+    coded feature. Patients without a code share the stratum None."""
+    strata = {}
+    for patient_id, features_dic in patient_features.items():
+        codes = Counter(
+            feature["code"]
+            for feature in features_dic.get(feature_name, [])
+            if isinstance(feature, dict) and feature.get("code") is not None
+        )
+        strata[patient_id] = (
+            min(codes.items(), key=lambda item: (-item[1], str(item[0])))[0]
+            if codes
+            else None
+        )
+    return strata
+
+
+def _group_strata(strata: dict[str, Hashable]) -> dict[Hashable, list[str]]:
+    groups = {}
+    for patient_id in sorted(strata):
+        groups.setdefault(strata[patient_id], []).append(patient_id)
+    return dict(sorted(groups.items(), key=lambda item: str(item[0])))
+
+
+def stratified_sample(
+    strata: dict[str, Hashable], sample_size: int, seed: int = 0
+) -> list[str]:
+    """Draws a reproducible sample with proportional allocation to the strata.
+    Rounding is done with the largest remainder method, so the sample has
+    exactly sample_size patients."""
+    if sample_size >= len(strata):
+        return sorted(strata)
+    groups = _group_strata(strata)
+    quotas = {
+        key: sample_size * len(patient_ids) / len(strata)
+        for key, patient_ids in groups.items()
+    }
+    allocation = {key: math.floor(quota) for key, quota in quotas.items()}
+    remainders = sorted(
+        groups, key=lambda key: (-(quotas[key] - allocation[key]), str(key))
+    )
+    for key in remainders[: sample_size - sum(allocation.values())]:
+        allocation[key] += 1
+    rng = random.Random(seed)
+    sample = []
+    for key, patient_ids in groups.items():
+        sample.extend(rng.sample(patient_ids, allocation[key]))
+    return sample
+
+
+def summarize_sample_similarities(
+    similarities: dict[str, dict[str, dict[str, float]]],
+    strata: dict[str, Hashable],
+    confidence: float = 0.95,
+) -> pd.DataFrame:
+    """Estimates the mean similarity of each feature over all patients from
+    the similarities between the sampled patients. Every sampled patient
+    contributes its mean similarity to the other sampled patients, these are
+    combined with the stratified estimator and its standard error, including
+    the finite population correction. Quantiles are taken over the sampled
+    pairs."""
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    stratum_sizes = Counter(strata.values())
+    rows = {}
+    for feat_name, data in similarities.items():
+        pair_similarities = []
+        patient_means = {}
+        for patient_id, row in data.items():
+            values = [
+                value
+                for other_id, value in row.items()
+                if other_id != patient_id and value is not None
+            ]
+            pair_similarities.extend(values)
+            if values:
+                patient_means.setdefault(strata[patient_id], []).append(
+                    statistics.mean(values)
+                )
+        population = sum(stratum_sizes[key] for key in patient_means)
+        mean = None
+        std_error = None
+        if population:
+            mean = 0.0
+            variance = 0.0
+            for key, means in patient_means.items():
+                weight = stratum_sizes[key] / population
+                mean += weight * statistics.mean(means)
+                if len(means) > 1:
+                    variance += (
+                        weight**2
+                        * statistics.variance(means)
+                        / len(means)
+                        * (1 - len(means) / stratum_sizes[key])
+                    )
+            std_error = math.sqrt(variance)
+        quantiles = (
+            statistics.quantiles(pair_similarities, n=4)
+            if len(pair_similarities) > 1
+            else [None, None, None]
+        )
+        rows[feat_name] = {
+            "mean": mean,
+            "std_error": std_error,
+            "ci_low": None if mean is None else mean - z * std_error,
+            "ci_high": None if mean is None else mean + z * std_error,
+            "n_patients": sum(len(means) for means in patient_means.values()),
+            "n_pairs": len(pair_similarities),
+            "q25": quantiles[0],
+            "median": quantiles[1],
+            "q75": quantiles[2],
+        }
+    return pd.DataFrame(rows).T
@@ -0,0 +1,298 @@
+import argparse
+import heapq
+import json
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Union
+from urllib.parse import parse_qs, urlparse
+
+from fhir_analyzer.fhirstore import Fhirstore
+from fhir_analyzer.patient_similarity.comparator import (
+    Comparator,
+    combine_feature_similarities,
+)
+from fhir_analyzer.patient_similarity.internal_types import CODED_CONCEPT
+from fhir_analyzer.patient_similarity.patsim import Patsim
+
+
+class _Request:
+    def __init__(self, patient_id: str, reference_ids: Union[list[str], None]):
+        self.patient_id = patient_id
+        self.reference_ids = reference_ids
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class PatsimService:
+    """Long-running similarity service that keeps the Fhirstore, the extracted
+    features, the comparison stats and the ontologies of a Patsim in memory.
+
+    Requests that arrive within batch_window seconds are batched: their
+    distinct query patients go through one Comparator._compute_block call,
+    so a patient queried several times in a batch is compared once."""
+
+    def __init__(
+        self,
+        patsim: Patsim,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+        batch_window: float = 0.01,
+        max_batch_size: int = 64,
+    ):
+        self._patsim = patsim
+        self._host = host
+        self._port = port
+        self._batch_window = batch_window
+        self._max_batch_size = max_batch_size
+        self._requests: queue.Queue[_Request] = queue.Queue()
+        self._state_lock = threading.Lock()
+        self._submit_lock = threading.Lock()
+        self._server = None
+        self._batch_thread = None
+        self._running = False
+        self.reload()
+
+    def reload(self):
+        """Re-extracts changed features and rebuilds the comparison state."""
+        self._patsim.refresh_features()
+        comparator = Comparator(feature_selector=self._patsim._feature_selector)
+        self._preload_ontologies(comparator)
+        with self._state_lock:
+            self._comparator = comparator
+            self._patient_ids = list(comparator._feature_dict.keys())
+
+    def _preload_ontologies(self, comparator: Comparator):
+        for feat_name, feat_type in comparator._feature_types.items():
+            if feat_type != CODED_CONCEPT:
+                continue
+            systems = {
+                features_dic[feat_name].system
+                for features_dic in comparator._feature_dict.values()
+                if len(features_dic.get(feat_name, [])) > 0
+            }
+            for system in systems:
+                comparator._get_ontology(system)
+
+    def start(self):
+        self._running = True
+        self._batch_thread = threading.Thread(target=self._process_batches, daemon=True)
+        self._batch_thread.start()
+        self._server = ThreadingHTTPServer(
+            (self._host, self._port), self._get_handler_class()
+        )
+        self._port = self._server.server_address[1]
+
+    def serve_forever(self):
+        if not self._running:
+            self.start()
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """Stops the server and the batch thread. Requests that were not
+        answered yet fail with a RuntimeError."""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        with self._submit_lock:
+            self._running = False
+        if self._batch_thread:
+            self._batch_thread.join()
+            self._batch_thread = None
+        while True:
+            try:
+                request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            request.error = RuntimeError("The similarity service was shut down.")
+            request.done.set()
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self._host, self._port
+
+    def pair(self, patient_id1: str, patient_id2: str) -> dict[str, Any]:
+        similarities = self._submit(patient_id1, [patient_id2])[patient_id2]
+        return {
+            "patient_id1": patient_id1,
+            "patient_id2": patient_id2,
+            "similarities": similarities,
+            "overall": combine_feature_similarities(similarities),
+        }
+
+    def similar(
+        self, patient_id: str, k: int = 10, weights: dict[str, float] = None
+    ) -> list[dict[str, Any]]:
+        rows = self._submit(patient_id, None)
+        scores = [
+            (combine_feature_similarities(similarities, weights), other_id)
+            for other_id, similarities in rows.items()
+            if other_id != patient_id
+        ]
+        top_k = heapq.nlargest(k, [score for score in scores if score[0] is not None])
+        return [
+            {"patient_id": other_id, "overall": score, "similarities": rows[other_id]}
+            for score, other_id in top_k
+        ]
+
+    def _submit(
+        self, patient_id: str, reference_ids: Union[list[str], None]
+    ) -> dict[str, dict[str, float]]:
+        request = _Request(patient_id, reference_ids)
+        with self._submit_lock:
+            running = self._running
+            if running:
+                self._requests.put(request)
+        if running:
+            request.done.wait()
+        else:
+            self._compute_batch([request])
+        if request.error:
+            raise request.error
+        return request.result
+
+    def _process_batches(self):
+        while self._running:
+            try:
+                batch = [self._requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            while len(batch) < self._max_batch_size:
+                try:
+                    batch.append(self._requests.get(timeout=self._batch_window))
+                except queue.Empty:
+                    break
+            self._compute_batch(batch)
+
+    def _compute_batch(self, batch: list[_Request]):
+        with self._state_lock:
+            comparator = self._comparator
+            all_patient_ids = self._patient_ids
+        valid_requests = []
+        for request in batch:
+            try:
+                comparator._validate_patient_ids(
+                    [request.patient_id] + (request.reference_ids or [])
+                )
+                valid_requests.append(request)
+            except ValueError as e:
+                request.error = e
+                request.done.set()
+        needs_all = {r.patient_id for r in valid_requests if r.reference_ids is None}
+        reference_ids = {}
+        for request in valid_requests:
+            if request.patient_id not in needs_all:
+                reference_ids.setdefault(request.patient_id, set()).update(
+                    request.reference_ids
+                )
+        rows = {}
+        try:
+            if needs_all:
+                block = comparator._compute_block(
+                    list(needs_all), all_patient_ids, output_dict=True
+                )
+                self._add_block_rows(block, rows)
+            for patient_id, patient_reference_ids in reference_ids.items():
+                block = comparator._compute_block(
+                    [patient_id], list(patient_reference_ids), output_dict=True
+                )
+                self._add_block_rows(block, rows)
+        except Exception as e:
+            for request in valid_requests:
+                request.error = e
+                request.done.set()
+            return
+        for request in valid_requests:
+            patient_rows = rows.get(request.patient_id, {})
+            if request.reference_ids is not None:
+                patient_rows = {
+                    other_id: patient_rows[other_id]
+                    for other_id in request.reference_ids
+                }
+            request.result = patient_rows
+            request.done.set()
+
+    def _add_block_rows(self, block: dict, rows: dict):
+        for feat_name, data in block.items():
+            for patient_id, similarities in data.items():
+                patient_rows = rows.setdefault(patient_id, {})
+                for other_id, similarity in similarities.items():
+                    patient_rows.setdefault(other_id, {})[feat_name] = similarity
+
+    def _get_handler_class(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                try:
+                    if url.path == "/health":
+                        self._send(200, {"patients": len(service._patient_ids)})
+                    elif url.path == "/similar":
+                        self._send(
+                            200,
+                            service.similar(
+                                params["patient_id"], k=int(params.get("k", 10))
+                            ),
+                        )
+                    elif url.path == "/pair":
+                        self._send(
+                            200,
+                            service.pair(params["patient_id1"], params["patient_id2"]),
+                        )
+                    else:
+                        self._send(404, {"error": f"Unknown path: {url.path}"})
+                except (KeyError, ValueError) as e:
+                    self._send(400, {"error": str(e)})
+
+            def do_POST(self):
+                if urlparse(self.path).path == "/reload":
+                    service.reload()
+                    self._send(200, {"patients": len(service._patient_ids)})
+                else:
+                    self._send(404, {"error": f"Unknown path: {self.path}"})
+
+            def _send(self, status: int, body: Any):
+                data = json.dumps(body, default=str).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main(args: list[str] = None):
+    parser = argparse.ArgumentParser(description="Patient similarity service.")
+    parser.add_argument("directory", help="Directory with bundle files.")
+    parser.add_argument("features", help="JSON file with a list of features.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=None)
+    parsed_args = parser.parse_args(args)
+
+    patsim = Patsim(
+        Fhirstore.from_directory(parsed_args.directory, parsed_args.workers)
+    )
+    with open(parsed_args.features, "r") as f:
+        for feature in json.load(f):
+            patsim.add_feature(**feature)
+    service = PatsimService(patsim, host=parsed_args.host, port=parsed_args.port)
+    service.start()
+    print(
+        f"Serving patient similarities on http://{service.address[0]}:{service.address[1]}"
+    )
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    main()
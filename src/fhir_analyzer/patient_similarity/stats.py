@@ -0,0 +1,225 @@
+import math
+from typing import Union
+
+from fhir_analyzer.patient_similarity.internal_types import CODED_NUMERICAL, NUMERICAL
+
+
+class RunningStats:
+    """Welford accumulator for count, mean, variance, min and max. Two
+    accumulators can be merged, e.g. when they were filled by different
+    workers."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min_value = None
+        self.max_value = None
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min_value = value if self.min_value is None else min(self.min_value, value)
+        self.max_value = value if self.max_value is None else max(self.max_value, value)
+
+    def merge(self, other: "RunningStats"):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean
+            self.m2 = other.m2
+            self.min_value = other.min_value
+            self.max_value = other.max_value
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min_value = min(self.min_value, other.min_value)
+        self.max_value = max(self.max_value, other.max_value)
+
+    @property
+    def std_dev(self) -> Union[float, None]:
+        """Sample standard deviation like statistics.stdev."""
+        if self.count < 2:
+            return None
+        return math.sqrt(self.m2 / (self.count - 1))
+
+
+class QuantileSketch:
+    """Mergeable streaming quantile sketch. Values are kept in levels of at
+    most k items. A full level is sorted and every second item is promoted to
+    the next level with twice the weight."""
+
+    def __init__(self, k: int = 200):
+        self._k = k
+        self._levels: list[list[float]] = [[]]
+        self._compactions = 0
+        self.count = 0
+
+    def add(self, value: float):
+        self._levels[0].append(value)
+        self.count += 1
+        if len(self._levels[0]) >= self._k:
+            self._compress()
+
+    def merge(self, other: "QuantileSketch"):
+        for level, items in enumerate(other._levels):
+            if level >= len(self._levels):
+                self._levels.append([])
+            self._levels[level].extend(items)
+        self.count += other.count
+        self._compress()
+
+    def _compress(self):
+        level = 0
+        while level < len(self._levels):
+            items = self._levels[level]
+            if len(items) >= self._k:
+                items.sort()
+                offset = self._compactions % 2
+                self._compactions += 1
+                if level + 1 >= len(self._levels):
+                    self._levels.append([])
+                remainder = [items.pop()] if len(items) % 2 else []
+                self._levels[level + 1].extend(items[offset::2])
+                self._levels[level] = remainder
+            level += 1
+
+    def quantile(self, q: float) -> Union[float, None]:
+        weighted_items = sorted(
+            (value, 2**level)
+            for level, items in enumerate(self._levels)
+            for value in items
+        )
+        if not weighted_items:
+            return None
+        total_weight = sum(weight for _, weight in weighted_items)
+        cumulative_weight = 0
+        for value, weight in weighted_items:
+            cumulative_weight += weight
+            if cumulative_weight >= q * total_weight:
+                return value
+        return weighted_items[-1][0]
+
+
+class FeatureStats:
+    """Collects the normalization statistics of all numerical and coded
+    numerical features in a single pass over the patient features. Stats
+    from several shards of patients can be combined with merge."""
+
+    def __init__(self, feature_types: dict[str, str], quantiles: bool = False):
+        self._feature_types = feature_types
+        self._quantiles = quantiles
+        self.numerical: dict[str, RunningStats] = {}
+        self.coded_numerical: dict[str, dict[str, RunningStats]] = {}
+        self.numerical_sketches: dict[str, QuantileSketch] = {}
+        self.coded_numerical_sketches: dict[str, dict[str, QuantileSketch]] = {}
+        for name, feature_type in feature_types.items():
+            if feature_type == NUMERICAL:
+                self.numerical[name] = RunningStats()
+                if quantiles:
+                    self.numerical_sketches[name] = QuantileSketch()
+            elif feature_type == CODED_NUMERICAL:
+                self.coded_numerical[name] = {}
+                if quantiles:
+                    self.coded_numerical_sketches[name] = {}
+
+    @classmethod
+    def from_patient_features(
+        cls,
+        patient_features: dict[str, dict[str, list]],
+        feature_types: dict[str, str],
+        quantiles: bool = False,
+    ) -> "FeatureStats":
+        feature_stats = cls(feature_types, quantiles=quantiles)
+        for features_dic in patient_features.values():
+            feature_stats.add_patient_features(features_dic)
+        return feature_stats
+
+    def add_patient_features(self, features_dic: dict[str, list]):
+        for name, features in features_dic.items():
+            if name in self.numerical:
+                self._add_numerical(name, features)
+            elif name in self.coded_numerical:
+                self._add_coded_numerical(name, features)
+
+    def _add_numerical(self, name: str, features: list[dict]):
+        stats = self.numerical[name]
+        sketch = self.numerical_sketches.get(name, None)
+        for feature in features:
+            value = feature["value"]
+            if value is not None:
+                value = float(value)
+                stats.add(value)
+                if sketch is not None:
+                    sketch.add(value)
+
+    def _add_coded_numerical(self, name: str, features: list[dict]):
+        code_stats = self.coded_numerical[name]
+        code_sketches = self.coded_numerical_sketches.get(name, None)
+        for feature in features:
+            code = feature["code"]
+            value = feature["value"]
+            if code not in code_stats:
+                code_stats[code] = RunningStats()
+                if code_sketches is not None:
+                    code_sketches[code] = QuantileSketch()
+            if value:
+                value = float(value)
+                code_stats[code].add(value)
+                if code_sketches is not None:
+                    code_sketches[code].add(value)
+
+    def merge(self, other: "FeatureStats"):
+        for name, stats in other.numerical.items():
+            self.numerical.setdefault(name, RunningStats()).merge(stats)
+        for name, sketch in other.numerical_sketches.items():
+            self.numerical_sketches.setdefault(name, QuantileSketch()).merge(sketch)
+        for name, code_stats in other.coded_numerical.items():
+            own_code_stats = self.coded_numerical.setdefault(name, {})
+            for code, stats in code_stats.items():
+                own_code_stats.setdefault(code, RunningStats()).merge(stats)
+        for name, code_sketches in other.coded_numerical_sketches.items():
+            own_code_sketches = self.coded_numerical_sketches.setdefault(name, {})
+            for code, sketch in code_sketches.items():
+                own_code_sketches.setdefault(code, QuantileSketch()).merge(sketch)
+
+    def get_numerical_stats(
+        self, robust: bool = False, quantile_range: tuple[float, float] = (0.05, 0.95)
+    ) -> dict[str, dict[str, Union[float, None]]]:
+        result = {}
+        for name, stats in self.numerical.items():
+            if robust and name in self.numerical_sketches and stats.count:
+                sketch = self.numerical_sketches[name]
+                min_value = sketch.quantile(quantile_range[0])
+                max_value = sketch.quantile(quantile_range[1])
+            else:
+                min_value = stats.min_value
+                max_value = stats.max_value
+            result[name] = {"min_value": min_value, "max_value": max_value}
+        return result
+
+    def get_coded_numerical_stats(
+        self, robust: bool = False
+    ) -> dict[str, dict[str, dict[str, Union[float, None]]]]:
+        result = {}
+        for name, code_stats in self.coded_numerical.items():
+            result[name] = {}
+            for code, stats in code_stats.items():
+                if not code or stats.count < 2:
+                    result[name][code] = {"mean": None, "std_dev": None}
+                elif robust and code in self.coded_numerical_sketches.get(name, {}):
+                    sketch = self.coded_numerical_sketches[name][code]
+                    inter_quartile_range = sketch.quantile(0.75) - sketch.quantile(0.25)
+                    result[name][code] = {
+                        "mean": sketch.quantile(0.5),
+                        "std_dev": inter_quartile_range / 1.349,
+                    }
+                else:
+                    result[name][code] = {"mean": stats.mean, "std_dev": stats.std_dev}
+        return result
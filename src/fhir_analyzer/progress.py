@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Callable
+
+INGEST = "ingest"
+EXTRACTION = "extraction"
+COMPARISON = "comparison"
+
+Progress = namedtuple(
+    "Progress", ["stage", "completed", "total", "elapsed_seconds", "eta_seconds"]
+)
+
+
+class OperationCancelled(Exception):
+    """Raised when a cancellation token stops an operation. The operation
+    stops between work items, so its state stays consistent. partial_result
+    holds what was finished if the operation has a result."""
+
+    def __init__(self, message: str = "Operation cancelled.", partial_result=None):
+        super().__init__(message)
+        self.partial_result = partial_result
+
+
+class CancellationToken:
+    """Cooperative cancellation of long running operations. cancel() can be
+    called from another thread, with timeout the token also cancels itself
+    after that many seconds."""
+
+    def __init__(self, timeout: float = None):
+        self._event = threading.Event()
+        self._deadline = time.monotonic() + timeout if timeout is not None else None
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def is_cancelled(self) -> bool:
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            self._event.set()
+        return self._event.is_set()
+
+    def raise_if_cancelled(self, partial_result: Any = None):
+        if self.is_cancelled:
+            raise OperationCancelled(partial_result=partial_result)
+
+
+class ProgressTracker:
+    """Counts the finished work items of a stage and reports them with an
+    estimated time to completion to callback, at most every min_interval
+    seconds and always for the last item."""
+
+    def __init__(
+        self,
+        stage: str,
+        total: int,
+        callback: Callable[[Progress], Any] = None,
+        cancel: CancellationToken = None,
+        min_interval: float = 0.5,
+    ):
+        self.stage = stage
+        self.total = total
+        self.completed = 0
+        self._callback = callback
+        self._cancel = cancel
+        self._min_interval = min_interval
+        self._start = time.monotonic()
+        self._last_report = None
+
+    @property
+    def progress(self) -> Progress:
+        elapsed_seconds = time.monotonic() - self._start
+        eta_seconds = (
+            elapsed_seconds / self.completed * max(self.total - self.completed, 0)
+            if self.completed
+            else None
+        )
+        return Progress(
+            self.stage, self.completed, self.total, elapsed_seconds, eta_seconds
+        )
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._cancel is not None and self._cancel.is_cancelled
+
+    def check(self, partial_result: Any = None):
+        """Raises OperationCancelled if the operation was cancelled."""
+        if self._cancel is not None:
+            self._cancel.raise_if_cancelled(partial_result)
+
+    def update(self, n: int = 1):
+        self.completed += n
+        if self._callback is None:
+            return
+        now = time.monotonic()
+        if (
+            self._last_report is None
+            or now - self._last_report >= self._min_interval
+            or self.completed >= self.total
+        ):
+            self._last_report = now
+            self._callback(self.progress)
@@ -0,0 +1,215 @@
+import re
+from typing import Any, Union
+
+from fhir_analyzer.constants import RESOURCE_LIST
+from fhir_analyzer.time_index import clinical_time_elements
+
+KEEP_ALL = True
+
+always_kept_fields = ["resourceType", "id", "meta"]
+always_kept_resource_types = ["Patient"]
+fhirpath_keywords = [
+    "and",
+    "or",
+    "xor",
+    "implies",
+    "is",
+    "as",
+    "in",
+    "contains",
+    "div",
+    "mod",
+    "true",
+    "false",
+]
+
+_token_pattern = re.compile(
+    r"'(?:[^'\\]|\\.)*'|`[^`]*`|[%$]?[A-Za-z_][A-Za-z0-9_]*|\d+(?:\.\d+)?|\S"
+)
+
+
+def get_path_elements(path: str) -> list[tuple[list[str], bool]]:
+    """Returns the element chains a FHIRPath expression touches. Each chain is
+    returned with a flag that is True if the whole sub-tree below the chain
+    is needed, e.g. because a function is applied to it."""
+    tokens = _token_pattern.findall(path)
+    result = []
+    chain = None
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        next_token = tokens[i + 1] if i + 1 < len(tokens) else None
+        is_identifier = token[0].isalpha() or token[0] in "_`%$"
+        if is_identifier and next_token == "(":
+            result.append((chain if chain is not None else [], KEEP_ALL))
+            chain = None
+            i = _skip_arguments(tokens, i + 1)
+            while i < len(tokens) and tokens[i] == ".":
+                i += 1
+                if i < len(tokens) and i + 1 < len(tokens) and tokens[i + 1] == "(":
+                    i = _skip_arguments(tokens, i + 1)
+                else:
+                    i += 1
+            continue
+        if is_identifier and token in fhirpath_keywords:
+            if chain:
+                result.append((chain, False))
+            chain = None
+        elif is_identifier:
+            if chain is None or (i > 0 and tokens[i - 1] != "."):
+                if chain:
+                    result.append((chain, False))
+                chain = []
+            if not token.startswith(("%", "$")):
+                chain.append(token.strip("`"))
+        elif token != ".":
+            if chain:
+                result.append((chain, False))
+            chain = None
+        i += 1
+    if chain:
+        result.append((chain, False))
+    return result
+
+
+def _skip_arguments(tokens: list[str], start: int) -> int:
+    """Returns the index after the closing bracket of the opening bracket at
+    start."""
+    depth = 0
+    for i in range(start, len(tokens)):
+        if tokens[i] == "(":
+            depth += 1
+        elif tokens[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return len(tokens)
+
+
+def merge_trees(tree: Union[dict, bool], other: Union[dict, bool]) -> Union[dict, bool]:
+    if tree is KEEP_ALL or other is KEEP_ALL:
+        return KEEP_ALL
+    result = dict(tree)
+    for name, sub_tree in other.items():
+        result[name] = (
+            merge_trees(result[name], sub_tree) if name in result else sub_tree
+        )
+    return result
+
+
+class Projection:
+    """Describes the sub-trees of each resource type that are kept when
+    resources are added to a Fhirstore. Resource types without any path are
+    dropped, unless drop_unused_types is False. References are always kept
+    so that patient connections can be resolved."""
+
+    def __init__(
+        self,
+        paths: dict[str, list[str]] = None,
+        drop_unused_types: bool = True,
+        keep_references: bool = True,
+    ):
+        self._trees: dict[str, Union[dict, bool]] = {}
+        self._drop_unused_types = drop_unused_types
+        self._keep_references = keep_references
+        for resource_type in always_kept_resource_types:
+            self.keep_resource_type(resource_type)
+        if paths:
+            for resource_type, type_paths in paths.items():
+                for path in type_paths:
+                    self.add_path(resource_type, path)
+
+    @property
+    def resource_types(self) -> list[str]:
+        return list(self._trees.keys())
+
+    def keep_resource_type(self, resource_type: str, whole: bool = False):
+        tree = KEEP_ALL if whole else {field: KEEP_ALL for field in always_kept_fields}
+        self._trees[resource_type] = merge_trees(
+            self._trees.get(resource_type, {}), tree
+        )
+
+    def add_path(self, resource_type: str, path: str):
+        self.keep_resource_type(resource_type)
+        for chain, keep_all in get_path_elements(path):
+            if chain and chain[0] in RESOURCE_LIST:
+                if chain[0] != resource_type:
+                    continue
+                chain = chain[1:]
+            tree = KEEP_ALL if keep_all else {}
+            for element in reversed(chain):
+                tree = {element: tree if tree != {} else KEEP_ALL}
+            self._trees[resource_type] = merge_trees(self._trees[resource_type], tree)
+
+    @classmethod
+    def from_feature_specs(cls, feature_specs: dict[str, dict], **kwargs):
+        projection = cls(**kwargs)
+        for spec in feature_specs.values():
+            paths = [
+                path
+                for type_paths in spec["target_paths"].values()
+                for path in type_paths or []
+            ]
+            for cond_paths in (spec["conditional_target_paths"] or {}).values():
+                cond_paths = (
+                    cond_paths if isinstance(cond_paths, list) else [cond_paths]
+                )
+                for cond_path_dic in cond_paths:
+                    for cond, targ in cond_path_dic.items():
+                        paths += [cond, targ]
+            if spec.get("time_filter", None):
+                paths += clinical_time_elements
+            for resource_type in spec["resource_types"]:
+                for path in paths:
+                    projection.add_path(resource_type, path)
+        return projection
+
+    def project(self, resource: dict) -> Union[dict, None]:
+        """Returns the projected copy of a resource or None if its type is
+        dropped."""
+        tree = self._trees.get(resource.get("resourceType", None), None)
+        if tree is None:
+            if self._drop_unused_types:
+                return None
+            return resource
+        if tree is KEEP_ALL:
+            return resource
+        return self._project_element(resource, tree)
+
+    def _project_element(self, element: Any, tree: Union[dict, bool, None]) -> Any:
+        if tree is KEEP_ALL:
+            return element
+        if isinstance(element, list):
+            result = [self._project_element(item, tree) for item in element]
+            return [item for item in result if item is not None and item != {}]
+        if not isinstance(element, dict):
+            return element if tree else None
+        if self._keep_references and "reference" in element and not tree:
+            return {"reference": element["reference"]}
+        result = {}
+        for key, value in element.items():
+            sub_tree = self._get_sub_tree(key, tree)
+            if sub_tree is None and not self._keep_references:
+                continue
+            projected = self._project_element(value, sub_tree)
+            if projected is not None and projected != [] and projected != {}:
+                result[key] = projected
+        return result
+
+    def _get_sub_tree(
+        self, key: str, tree: Union[dict, None]
+    ) -> Union[dict, bool, None]:
+        sub_tree = None
+        if not tree:
+            return sub_tree
+        name = key[1:] if key.startswith("_") else key
+        for element, element_tree in tree.items():
+            if name == element or (
+                name.startswith(element) and name[len(element)].isupper()
+            ):
+                sub_tree = (
+                    element_tree
+                    if sub_tree is None
+                    else merge_trees(sub_tree, element_tree)
+                )
+        return sub_tree
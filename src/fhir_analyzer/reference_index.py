@@ -0,0 +1,236 @@
+from typing import Union
+
+from fhir_analyzer.helper import (
+    get_id_from_uuid,
+    get_reference_strings,
+    is_absolute_or_relative_ref,
+    is_uuid,
+)
+
+ResourceKey = tuple[str, str]
+
+
+class ReferenceIndex:
+    """Resolves which patients a resource belongs to from the references
+    between resources.
+
+    A resource is linked to every patient it references directly. Resources
+    of a type listed in linkage_chains are additionally linked through the
+    given chain of intermediate resource types, e.g.
+    {"DiagnosticReport": ["Encounter"]} links a DiagnosticReport to the
+    patients of the Encounters it references. References that cannot be
+    resolved yet are kept pending and resolved when their target arrives."""
+
+    def __init__(self, linkage_chains: dict[str, list[str]] = None):
+        self._linkage_chains = linkage_chains if linkage_chains else {}
+        self._intermediate_types = {
+            resource_type
+            for chain in self._linkage_chains.values()
+            for resource_type in chain
+        }
+        self._linked_types = set(self._linkage_chains.keys()) | self._intermediate_types
+        self._max_chain_length = max(
+            (len(chain) for chain in self._linkage_chains.values()), default=0
+        )
+        self._full_urls: dict[str, ResourceKey] = {}
+        self._patient_ids: set[str] = set()
+        self._references: dict[ResourceKey, list[str]] = {}
+        self._referrers: dict[ResourceKey, set[ResourceKey]] = {}
+        self._pending: dict[str, set[ResourceKey]] = {}
+        self._resource_patients: dict[ResourceKey, set[str]] = {}
+
+    @property
+    def linked_types(self) -> set[str]:
+        return self._linked_types
+
+    def get_patients(self, resource_type: str, resource_id: str) -> set[str]:
+        return self._resource_patients.get((resource_type, resource_id), set())
+
+    def add_resources(
+        self,
+        resources: list[dict],
+        full_urls: list[Union[str, None]] = None,
+        references: list[list[str]] = None,
+    ) -> list[tuple[str, ResourceKey]]:
+        """Adds resources to the index and returns the new (patient id,
+        resource key) links in the order they were found. Optionally takes
+        the full urls of the bundle entries and the precomputed references
+        of each resource."""
+        full_urls = full_urls if full_urls else [None] * len(resources)
+        keys = [(resource["resourceType"], resource["id"]) for resource in resources]
+        for key, full_url in zip(keys, full_urls):
+            self._register_resource(key, full_url)
+
+        links = []
+        for i, key in enumerate(keys):
+            if key[0] == "Patient":
+                self._link(key, {key[1]}, links)
+            resource_references = (
+                references[i] if references else get_reference_strings(resources[i])
+            )
+            self._add_references(key, resource_references)
+            self._update_links(key, links, resource_references)
+
+        for key, full_url in zip(keys, full_urls):
+            self._resolve_pending(key, full_url, links)
+        return links
+
+    def remove_resource(
+        self, resource_type: str, resource_id: str
+    ) -> list[tuple[str, ResourceKey]]:
+        """Removes a resource from the index and returns the (patient id,
+        resource key) links that no longer hold, including the links of
+        resources that were connected through it."""
+        key = (resource_type, resource_id)
+        unlinks = [
+            (patient_id, key)
+            for patient_id in sorted(self._resource_patients.pop(key, set()))
+        ]
+        self._references.pop(key, None)
+        if resource_type in self._intermediate_types:
+            self._remove_referrer_links(key, unlinks, depth=0)
+        return unlinks
+
+    def remove_patient(self, patient_id: str, resources: list[dict]):
+        """Forgets a patient and its links to the given resources. Their
+        references are registered again, so they are linked when the patient
+        is added back."""
+        self._patient_ids.discard(patient_id)
+        patient_key = ("Patient", patient_id)
+        for resource in resources:
+            key = (resource["resourceType"], resource["id"])
+            self._resource_patients.get(key, set()).discard(patient_id)
+            if key == patient_key:
+                continue
+            references = self._references.get(key, None)
+            self._add_references(
+                key, references if references else get_reference_strings(resource)
+            )
+
+    def _remove_referrer_links(
+        self, key: ResourceKey, unlinks: list[tuple[str, ResourceKey]], depth: int
+    ):
+        if depth > self._max_chain_length:
+            return
+        for referrer in self._referrers.get(key, ()):
+            chain = self._linkage_chains.get(referrer[0], [])
+            patients = self._compute_patients(referrer, chain)
+            resource_patients = self._resource_patients.get(referrer, set())
+            for patient_id in sorted(resource_patients - patients):
+                resource_patients.discard(patient_id)
+                unlinks.append((patient_id, referrer))
+            if referrer[0] in self._intermediate_types:
+                self._remove_referrer_links(referrer, unlinks, depth + 1)
+
+    def _register_resource(self, key: ResourceKey, full_url: Union[str, None]):
+        if full_url:
+            self._full_urls[full_url] = key
+        elif is_uuid(key[1]):
+            self._full_urls[f"urn:uuid:{key[1]}"] = key
+        if key[0] == "Patient":
+            self._patient_ids.add(key[1])
+
+    def _add_references(self, key: ResourceKey, references: list[str]):
+        keep_references = key[0] in self._linked_types
+        for reference in references:
+            target = self._resolve_reference(reference)
+            if target is None:
+                if self._is_pendable(reference):
+                    self._pending.setdefault(reference, set()).add(key)
+                    keep_references = True
+            elif target[0] == "Patient" and target[1] not in self._patient_ids:
+                self._referrers.setdefault(target, set()).add(key)
+                keep_references = True
+            elif target[0] in self._intermediate_types and key[0] in self._linked_types:
+                self._referrers.setdefault(target, set()).add(key)
+        if keep_references:
+            self._references[key] = references
+
+    def _resolve_reference(self, reference: str) -> Union[ResourceKey, None]:
+        if reference in self._full_urls:
+            return self._full_urls[reference]
+        if reference.startswith("#"):
+            return None
+        if is_absolute_or_relative_ref(reference):
+            reference_parts = reference.split("/")
+            return (reference_parts[-2], reference_parts[-1])
+        if is_uuid(reference):
+            reference = get_id_from_uuid(reference)
+        if reference in self._patient_ids:
+            return ("Patient", reference)
+        return None
+
+    def _is_pendable(self, reference: str) -> bool:
+        return not reference.startswith("#") and "?" not in reference
+
+    def _get_reference_targets(
+        self, key: ResourceKey, references: list[str] = None
+    ) -> list[ResourceKey]:
+        references = references if references else self._references.get(key, [])
+        targets = [self._resolve_reference(reference) for reference in references]
+        return [target for target in targets if target is not None]
+
+    def _compute_patients(
+        self, key: ResourceKey, chain: list[str], references: list[str] = None
+    ) -> set[str]:
+        patients = set()
+        for target in self._get_reference_targets(key, references):
+            if target[0] == "Patient" and target[1] in self._patient_ids:
+                patients.add(target[1])
+            elif chain and target[0] == chain[0]:
+                patients |= self._compute_patients(target, chain[1:])
+        return patients
+
+    def _update_links(
+        self,
+        key: ResourceKey,
+        links: list[tuple[str, ResourceKey]],
+        references: list[str] = None,
+    ):
+        chain = self._linkage_chains.get(key[0], [])
+        self._link(key, self._compute_patients(key, chain, references), links)
+
+    def _link(
+        self,
+        key: ResourceKey,
+        patients: set[str],
+        links: list[tuple[str, ResourceKey]],
+    ):
+        resource_patients = self._resource_patients.setdefault(key, set())
+        for patient_id in sorted(patients - resource_patients):
+            resource_patients.add(patient_id)
+            links.append((patient_id, key))
+
+    def _resolve_pending(
+        self,
+        key: ResourceKey,
+        full_url: Union[str, None],
+        links: list[tuple[str, ResourceKey]],
+    ):
+        tokens = [full_url, f"urn:uuid:{key[1]}"]
+        if key[0] == "Patient":
+            tokens.append(key[1])
+        for token in tokens:
+            for source in self._pending.pop(token, ()):
+                if (
+                    key[0] in self._intermediate_types
+                    and source[0] in self._linked_types
+                ):
+                    self._referrers.setdefault(key, set()).add(source)
+                self._update_links(source, links)
+                if source[0] in self._intermediate_types:
+                    self._update_referrers(source, links, depth=1)
+        self._update_referrers(key, links, depth=0)
+
+    def _update_referrers(
+        self, key: ResourceKey, links: list[tuple[str, ResourceKey]], depth: int
+    ):
+        if depth > self._max_chain_length:
+            return
+        referrers = self._referrers.get(key, ())
+        if key[0] == "Patient":
+            referrers = self._referrers.pop(key, ())
+        for referrer in referrers:
+            self._update_links(referrer, links)
+            if referrer[0] in self._intermediate_types:
+                self._update_referrers(referrer, links, depth + 1)
@@ -0,0 +1,439 @@
+import json
+import sqlite3
+from collections import OrderedDict
+from typing import Generator, Union
+
+from fhir_analyzer.helper import get_blocks
+from fhir_analyzer.mapped_file import materialize
+
+
+class StorageBackend:
+    """Interface for the resource storage of a Fhirstore."""
+
+    def add_resource(self, resource: dict):
+        raise NotImplementedError
+
+    def get_resource(self, resource_type: str, resource_id: str) -> Union[dict, None]:
+        raise NotImplementedError
+
+    def has_resource(self, resource_type: str, resource_id: str) -> bool:
+        raise NotImplementedError
+
+    def replace_resource(self, resource: dict, patient_ids: list[str]):
+        """Replaces a stored resource with a new version. The patient ids are
+        the patients whose connections keep pointing to the resource."""
+        raise NotImplementedError
+
+    def remove_resource(self, resource_type: str, resource_id: str):
+        raise NotImplementedError
+
+    def iter_resources(self) -> Generator[dict, None, None]:
+        raise NotImplementedError
+
+    def count_resources(self) -> int:
+        raise NotImplementedError
+
+    def add_patient(self, patient_id: str):
+        raise NotImplementedError
+
+    def remove_patient(self, patient_id: str):
+        raise NotImplementedError
+
+    def has_patient(self, patient_id: str) -> bool:
+        raise NotImplementedError
+
+    def get_patient_ids(self) -> list[str]:
+        raise NotImplementedError
+
+    def add_patient_connection(self, patient_id: str, resource: dict):
+        raise NotImplementedError
+
+    def remove_patient_connection(
+        self, patient_id: str, resource_type: str, resource_id: str
+    ):
+        raise NotImplementedError
+
+    def get_patient_resources(self, patient_id: str) -> dict[str, list[dict]]:
+        raise NotImplementedError
+
+    def iter_patient_resources(
+        self, batch_size: int = 500
+    ) -> Generator[tuple[str, dict[str, list[dict]]], None, None]:
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def snapshot(self) -> "StorageBackend":
+        """Returns a read-only view of the current state that is not changed by
+        later writes."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ReadOnlyStorage(StorageBackend):
+    """Exposes only the read methods of a storage."""
+
+    def __init__(self, storage: StorageBackend):
+        self._storage = storage
+
+    def get_resource(self, resource_type: str, resource_id: str) -> Union[dict, None]:
+        return self._storage.get_resource(resource_type, resource_id)
+
+    def has_resource(self, resource_type: str, resource_id: str) -> bool:
+        return self._storage.has_resource(resource_type, resource_id)
+
+    def iter_resources(self) -> Generator[dict, None, None]:
+        yield from self._storage.iter_resources()
+
+    def count_resources(self) -> int:
+        return self._storage.count_resources()
+
+    def has_patient(self, patient_id: str) -> bool:
+        return self._storage.has_patient(patient_id)
+
+    def get_patient_ids(self) -> list[str]:
+        return self._storage.get_patient_ids()
+
+    def get_patient_resources(self, patient_id: str) -> dict[str, list[dict]]:
+        return self._storage.get_patient_resources(patient_id)
+
+    def iter_patient_resources(
+        self, batch_size: int = 500
+    ) -> Generator[tuple[str, dict[str, list[dict]]], None, None]:
+        yield from self._storage.iter_patient_resources(batch_size=batch_size)
+
+    def snapshot(self) -> StorageBackend:
+        return self
+
+    def close(self):
+        self._storage.close()
+
+
+class MemoryStorage(StorageBackend):
+    """Keeps all resources as dicts in memory.
+
+    Snapshots share the containers of the storage. The first write after a
+    snapshot copies the top level containers and each patient's connections
+    are copied the first time they change afterwards (copy on write), so a
+    snapshot costs nothing and readers never see partial writes."""
+
+    def __init__(self):
+        self._resource_index: dict[tuple[str, str], dict] = {}
+        self._patient_ids: list[str] = []
+        self._patient_id_set: set[str] = set()
+        self._patient_connections: dict[str, dict[str, list[dict]]] = {}
+        self._shared = False
+        self._private_patient_ids: Union[set[str], None] = None
+
+    def snapshot(self) -> StorageBackend:
+        view = MemoryStorage()
+        view._resource_index = self._resource_index
+        view._patient_ids = self._patient_ids
+        view._patient_id_set = self._patient_id_set
+        view._patient_connections = self._patient_connections
+        self._shared = True
+        self._private_patient_ids = set()
+        return ReadOnlyStorage(view)
+
+    def _make_private(self):
+        if not self._shared:
+            return
+        self._resource_index = dict(self._resource_index)
+        self._patient_ids = list(self._patient_ids)
+        self._patient_id_set = set(self._patient_id_set)
+        self._patient_connections = dict(self._patient_connections)
+        self._shared = False
+
+    def _get_private_connection(self, patient_id: str) -> dict[str, list[dict]]:
+        self._make_private()
+        patient_connection = self._patient_connections.setdefault(patient_id, {})
+        if self._private_patient_ids is None:
+            return patient_connection
+        if patient_id not in self._private_patient_ids:
+            patient_connection = {
+                resource_type: list(resources)
+                for resource_type, resources in patient_connection.items()
+            }
+            self._patient_connections[patient_id] = patient_connection
+            self._private_patient_ids.add(patient_id)
+        return patient_connection
+
+    def add_resource(self, resource: dict):
+        self._make_private()
+        self._resource_index[(resource["resourceType"], resource["id"])] = resource
+
+    def replace_resource(self, resource: dict, patient_ids: list[str]):
+        self._make_private()
+        key = (resource["resourceType"], resource["id"])
+        old_resource = self._resource_index[key]
+        self._resource_index[key] = resource
+        for patient_id in patient_ids:
+            if patient_id not in self._patient_connections:
+                continue
+            resources = self._get_private_connection(patient_id).get(key[0], [])
+            for i, connected_resource in enumerate(resources):
+                if connected_resource is old_resource:
+                    resources[i] = resource
+
+    def remove_resource(self, resource_type: str, resource_id: str):
+        self._make_private()
+        self._resource_index.pop((resource_type, resource_id), None)
+
+    def get_resource(self, resource_type: str, resource_id: str) -> Union[dict, None]:
+        return self._resource_index.get((resource_type, resource_id), None)
+
+    def has_resource(self, resource_type: str, resource_id: str) -> bool:
+        return (resource_type, resource_id) in self._resource_index
+
+    def iter_resources(self) -> Generator[dict, None, None]:
+        yield from self._resource_index.values()
+
+    def count_resources(self) -> int:
+        return len(self._resource_index)
+
+    def add_patient(self, patient_id: str):
+        if patient_id not in self._patient_id_set:
+            self._make_private()
+            self._patient_ids.append(patient_id)
+            self._patient_id_set.add(patient_id)
+
+    def remove_patient(self, patient_id: str):
+        self._make_private()
+        if patient_id in self._patient_id_set:
+            self._patient_ids.remove(patient_id)
+            self._patient_id_set.discard(patient_id)
+        self._patient_connections.pop(patient_id, None)
+
+    def has_patient(self, patient_id: str) -> bool:
+        return patient_id in self._patient_id_set
+
+    def get_patient_ids(self) -> list[str]:
+        return self._patient_ids
+
+    def add_patient_connection(self, patient_id: str, resource: dict):
+        patient_connection = self._get_private_connection(patient_id)
+        patient_connection.setdefault(resource["resourceType"], []).append(resource)
+
+    def remove_patient_connection(
+        self, patient_id: str, resource_type: str, resource_id: str
+    ):
+        if patient_id not in self._patient_connections:
+            return
+        patient_connection = self._get_private_connection(patient_id)
+        resources = [
+            resource
+            for resource in patient_connection.get(resource_type, [])
+            if resource["id"] != resource_id
+        ]
+        if resources:
+            patient_connection[resource_type] = resources
+        else:
+            patient_connection.pop(resource_type, None)
+
+    def get_patient_resources(self, patient_id: str) -> dict[str, list[dict]]:
+        return self._patient_connections.get(patient_id, {})
+
+    def iter_patient_resources(
+        self, batch_size: int = 500
+    ) -> Generator[tuple[str, dict[str, list[dict]]], None, None]:
+        yield from self._patient_connections.items()
+
+
+class SQLiteStorage(StorageBackend):
+    """Stores resources as JSON blobs in a local SQLite database. Only the
+    resources of the most recently used patients are kept in memory.
+
+    File based databases use write-ahead logging, so snapshots are read
+    transactions on their own connection that do not block the writer."""
+
+    def __init__(self, path: str = ":memory:", cache_size: int = 128):
+        self._path = path
+        self._cache_size = cache_size
+        self._cache: OrderedDict[str, dict[str, list[dict]]] = OrderedDict()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._create_tables()
+
+    def snapshot(self) -> StorageBackend:
+        if self._path == ":memory:":
+            raise NotImplementedError(
+                "Snapshots are only supported for file based SQLite databases."
+            )
+        self.flush()
+        view = SQLiteStorage.__new__(SQLiteStorage)
+        view._path = self._path
+        view._cache_size = self._cache_size
+        view._cache = OrderedDict()
+        view._connection = sqlite3.connect(
+            self._path, check_same_thread=False, isolation_level=None
+        )
+        view._connection.execute("BEGIN")
+        view._connection.execute("SELECT COUNT(*) FROM patients").fetchone()
+        return ReadOnlyStorage(view)
+
+    def _create_tables(self):
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS resources (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                resource_type TEXT NOT NULL,
+                resource_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                UNIQUE (resource_type, resource_id)
+            );
+            CREATE TABLE IF NOT EXISTS patients (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                patient_id TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS patient_resources (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                patient_id TEXT NOT NULL,
+                resource_type TEXT NOT NULL,
+                resource_id TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_patient_resources_patient
+                ON patient_resources (patient_id);
+            """)
+        self._connection.commit()
+
+    def add_resource(self, resource: dict):
+        self._connection.execute(
+            "INSERT INTO resources (resource_type, resource_id, data) VALUES (?, ?, ?)",
+            (
+                resource["resourceType"],
+                resource["id"],
+                json.dumps(materialize(resource)),
+            ),
+        )
+
+    def replace_resource(self, resource: dict, patient_ids: list[str]):
+        self._connection.execute(
+            "UPDATE resources SET data = ? WHERE resource_type = ? AND resource_id = ?",
+            (
+                json.dumps(materialize(resource)),
+                resource["resourceType"],
+                resource["id"],
+            ),
+        )
+        for patient_id in patient_ids:
+            self._cache.pop(patient_id, None)
+
+    def remove_resource(self, resource_type: str, resource_id: str):
+        self._connection.execute(
+            "DELETE FROM resources WHERE resource_type = ? AND resource_id = ?",
+            (resource_type, resource_id),
+        )
+
+    def get_resource(self, resource_type: str, resource_id: str) -> Union[dict, None]:
+        row = self._connection.execute(
+            "SELECT data FROM resources WHERE resource_type = ? AND resource_id = ?",
+            (resource_type, resource_id),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def has_resource(self, resource_type: str, resource_id: str) -> bool:
+        row = self._connection.execute(
+            "SELECT 1 FROM resources WHERE resource_type = ? AND resource_id = ?",
+            (resource_type, resource_id),
+        ).fetchone()
+        return row is not None
+
+    def iter_resources(self) -> Generator[dict, None, None]:
+        for (data,) in self._connection.execute(
+            "SELECT data FROM resources ORDER BY seq"
+        ):
+            yield json.loads(data)
+
+    def count_resources(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM resources").fetchone()[0]
+
+    def add_patient(self, patient_id: str):
+        self._connection.execute(
+            "INSERT OR IGNORE INTO patients (patient_id) VALUES (?)", (patient_id,)
+        )
+
+    def remove_patient(self, patient_id: str):
+        self._connection.execute(
+            "DELETE FROM patients WHERE patient_id = ?", (patient_id,)
+        )
+        self._connection.execute(
+            "DELETE FROM patient_resources WHERE patient_id = ?", (patient_id,)
+        )
+        self._cache.pop(patient_id, None)
+
+    def has_patient(self, patient_id: str) -> bool:
+        row = self._connection.execute(
+            "SELECT 1 FROM patients WHERE patient_id = ?", (patient_id,)
+        ).fetchone()
+        return row is not None
+
+    def get_patient_ids(self) -> list[str]:
+        return [
+            row[0]
+            for row in self._connection.execute(
+                "SELECT patient_id FROM patients ORDER BY seq"
+            )
+        ]
+
+    def add_patient_connection(self, patient_id: str, resource: dict):
+        self._connection.execute(
+            "INSERT INTO patient_resources (patient_id, resource_type, resource_id) "
+            "VALUES (?, ?, ?)",
+            (patient_id, resource["resourceType"], resource["id"]),
+        )
+        self._cache.pop(patient_id, None)
+
+    def remove_patient_connection(
+        self, patient_id: str, resource_type: str, resource_id: str
+    ):
+        self._connection.execute(
+            "DELETE FROM patient_resources "
+            "WHERE patient_id = ? AND resource_type = ? AND resource_id = ?",
+            (patient_id, resource_type, resource_id),
+        )
+        self._cache.pop(patient_id, None)
+
+    def get_patient_resources(self, patient_id: str) -> dict[str, list[dict]]:
+        if patient_id in self._cache:
+            self._cache.move_to_end(patient_id)
+            return self._cache[patient_id]
+        patient_resources = self._load_patient_resources([patient_id]).get(
+            patient_id, {}
+        )
+        self._cache[patient_id] = patient_resources
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return patient_resources
+
+    def iter_patient_resources(
+        self, batch_size: int = 500
+    ) -> Generator[tuple[str, dict[str, list[dict]]], None, None]:
+        for patient_batch in get_blocks(self.get_patient_ids(), batch_size):
+            yield from self._load_patient_resources(patient_batch).items()
+
+    def _load_patient_resources(
+        self, patient_ids: list[str]
+    ) -> dict[str, dict[str, list[dict]]]:
+        placeholders = ", ".join("?" for _ in patient_ids)
+        rows = self._connection.execute(
+            "SELECT l.patient_id, r.resource_type, r.data FROM patient_resources l "
+            "JOIN resources r ON r.resource_type = l.resource_type "
+            "AND r.resource_id = l.resource_id "
+            f"WHERE l.patient_id IN ({placeholders}) ORDER BY l.seq",
+            patient_ids,
+        )
+        result = {}
+        for patient_id, resource_type, data in rows:
+            patient_resources = result.setdefault(patient_id, {})
+            patient_resources.setdefault(resource_type, []).append(json.loads(data))
+        return result
+
+    def flush(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
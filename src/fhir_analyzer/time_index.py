@@ -0,0 +1,193 @@
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from typing import Union
+
+# Elements that hold the clinical time of a resource, in order of preference.
+# Choice types like effective[x] are matched by prefix.
+clinical_time_elements = [
+    "effective",
+    "onset",
+    "period",
+    "performed",
+    "issued",
+    "authoredOn",
+    "recordedDate",
+]
+
+time_filter_selections = ["latest", "first"]
+time_filter_aggregates = ["mean", "min", "max", "sum", "count"]
+time_filter_keys = ["start", "end", "lookback_days", "select", "aggregate"]
+
+_partial_date_pattern = re.compile(r"^\d{4}(-\d{2})?$")
+_fraction_pattern = re.compile(r"(T\d{2}:\d{2}:\d{2})\.(\d+)")
+
+
+def parse_fhir_datetime(value: Union[str, datetime, None]) -> Union[datetime, None]:
+    """Parses a FHIR date, dateTime or instant to an aware datetime in UTC.
+    Partial dates are completed to their first day, values without a time zone
+    are taken as UTC."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        value = value.strip()
+        if _partial_date_pattern.match(value):
+            value = value + "-01" * ((10 - len(value)) // 3)
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        # datetime.fromisoformat before Python 3.11 only accepts 3 or 6
+        # fractional digits, FHIR allows any number.
+        value = _fraction_pattern.sub(
+            lambda match: f"{match.group(1)}.{match.group(2)[:6].ljust(6, '0')}",
+            value,
+        )
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def get_clinical_time(resource: dict) -> Union[datetime, None]:
+    """Returns the clinical time of a resource from effective[x], onset[x],
+    period.start, performed[x], issued, authoredOn or recordedDate."""
+    for element in clinical_time_elements:
+        for key, value in resource.items():
+            if key != element and not (
+                key.startswith(element) and key[len(element) :][:1].isupper()
+            ):
+                continue
+            if isinstance(value, dict):
+                value = value.get("start", None)
+            if isinstance(value, str):
+                parsed = parse_fhir_datetime(value)
+                if parsed is not None:
+                    return parsed
+    return None
+
+
+def validate_time_filter(time_filter: Union[dict, None]) -> Union[dict, None]:
+    """Checks the options of a time filter and returns a copy of it."""
+    if not time_filter:
+        return None
+    unknown_keys = set(time_filter).difference(time_filter_keys)
+    if unknown_keys:
+        raise ValueError(f"Unknown time filter options: {sorted(unknown_keys)}")
+    if time_filter.get("select") and time_filter.get("aggregate"):
+        raise ValueError("A time filter can either select or aggregate.")
+    if time_filter.get("select", None) not in time_filter_selections + [None]:
+        raise ValueError(f"Unknown time filter selection: {time_filter['select']}")
+    if time_filter.get("aggregate", None) not in time_filter_aggregates + [None]:
+        raise ValueError(f"Unknown time filter aggregate: {time_filter['aggregate']}")
+    for key in ["start", "end"]:
+        if (
+            time_filter.get(key) is not None
+            and parse_fhir_datetime(time_filter[key]) is None
+        ):
+            raise ValueError(f"Invalid time filter {key}: {time_filter[key]}")
+    return dict(time_filter)
+
+
+class TimeIndex:
+    """Per patient and resource type index of resources sorted by clinical
+    time. Entries hold the timestamps and the positions of the resources in
+    the list they were built from, not the resources, so the index stays
+    small for storage backends that load resources on demand.
+
+    Entries are built when they are first used and dropped when the
+    resources of a patient change. Snapshots and the live store share the
+    index: entries are keyed by the generation they were built at, and a
+    reader only uses and stores entries if neither its generation nor that
+    of the entry is older than the last change of the patient. Resources
+    without a clinical time are not part of the index."""
+
+    def __init__(self):
+        self._entries: dict[str, dict[str, tuple[int, list[float], list[int]]]] = {}
+        self._changed_generations: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, patient_ids: set[str], generation: int = None):
+        with self._lock:
+            for patient_id in patient_ids:
+                self._entries.pop(patient_id, None)
+                if generation is not None:
+                    self._changed_generations[patient_id] = generation
+
+    def _is_current(self, patient_id: str, generation: Union[int, None]) -> bool:
+        return generation is not None and generation >= (
+            self._changed_generations.get(patient_id, 0)
+        )
+
+    def get_sorted(
+        self,
+        patient_id: str,
+        resource_type: str,
+        resources: list[dict],
+        generation: int = None,
+    ) -> tuple[list[float], list[int]]:
+        """Returns the timestamps and the positions in resources sorted by
+        clinical time. Without the generation of the reader, nothing is
+        cached."""
+        with self._lock:
+            if self._is_current(patient_id, generation):
+                entry = self._entries.get(patient_id, {}).get(resource_type, None)
+                if entry is not None and self._is_current(patient_id, entry[0]):
+                    return entry[1], entry[2]
+        timed_positions = []
+        for i, resource in enumerate(resources):
+            clinical_time = get_clinical_time(resource)
+            if clinical_time is not None:
+                timed_positions.append((clinical_time.timestamp(), i))
+        timed_positions.sort()
+        times = [item[0] for item in timed_positions]
+        positions = [item[1] for item in timed_positions]
+        # The patient may have changed while the entry was built.
+        with self._lock:
+            if self._is_current(patient_id, generation):
+                self._entries.setdefault(patient_id, {})[resource_type] = (
+                    generation,
+                    times,
+                    positions,
+                )
+        return times, positions
+
+    def get_window(
+        self,
+        patient_id: str,
+        resource_type: str,
+        resources: list[dict],
+        start: Union[str, datetime, None] = None,
+        end: Union[str, datetime, None] = None,
+        lookback_days: float = None,
+        generation: int = None,
+    ) -> list[dict]:
+        """Returns the resources with a clinical time in [start, end] in time
+        order. With lookback_days the window starts that many days before end,
+        or before the latest resource if no end is given."""
+        times, positions = self.get_sorted(
+            patient_id, resource_type, resources, generation
+        )
+        if not times:
+            return []
+        end_time = parse_fhir_datetime(end)
+        end_timestamp = end_time.timestamp() if end_time else None
+        start_time = parse_fhir_datetime(start)
+        start_timestamp = start_time.timestamp() if start_time else None
+        if lookback_days is not None:
+            reference = end_timestamp if end_timestamp is not None else times[-1]
+            lookback_start = reference - timedelta(days=lookback_days).total_seconds()
+            start_timestamp = (
+                lookback_start
+                if start_timestamp is None
+                else max(start_timestamp, lookback_start)
+            )
+        low = 0 if start_timestamp is None else bisect_left(times, start_timestamp)
+        high = (
+            len(times) if end_timestamp is None else bisect_right(times, end_timestamp)
+        )
+        return [resources[i] for i in positions[low:high]]